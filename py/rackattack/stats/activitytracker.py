@@ -0,0 +1,36 @@
+import collections
+
+
+class ActivityTracker:
+    """Keeps the time of the latest activity of each key.
+
+    Keys are kept ordered by the time of their latest activity (as long as the given times do not go
+    backwards), so finding the idle keys takes O(1) per idle key, and touching a key and finding the least
+    recently active one take O(1).
+    """
+    def __init__(self):
+        self._last_activity_times = collections.OrderedDict()
+
+    def touch(self, key, now):
+        self._last_activity_times.pop(key, None)
+        self._last_activity_times[key] = now
+
+    def remove(self, key):
+        self._last_activity_times.pop(key, None)
+
+    def idle_keys(self, now, max_idle_time):
+        """The keys which had no activity in the last max_idle_time seconds, least recently active first."""
+        idle_keys = list()
+        for key, last_activity_time in self._last_activity_times.iteritems():
+            if now - last_activity_time < max_idle_time:
+                break
+            idle_keys.append(key)
+        return idle_keys
+
+    def least_recently_active(self):
+        for key in self._last_activity_times:
+            return key
+        return None
+
+    def __len__(self):
+        return len(self._last_activity_times)
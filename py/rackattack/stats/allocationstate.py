@@ -0,0 +1,146 @@
+"""Compact in-memory state of the allocations and hosts tracked by the allocations handler.
+
+Repeated values (pools, image labels, whole requirements dicts) are interned, so that thousands of hosts
+share the same objects. ES documents are built from the state only when they are written.
+"""
+import pytz
+import datetime
+from rackattack.stats import config
+
+
+MAX_NR_INTERNED_VALUES = 100000
+
+
+def datetime_from_timestamp(timestamp):
+    datetime_now = datetime.datetime.fromtimestamp(timestamp)
+    datetime_now = pytz.timezone(config.TIMEZONE).localize(datetime_now)
+    return datetime_now
+
+
+def fingerprint(value):
+    """A hashable value which is equal for equal (possibly nested) dicts, lists and scalars."""
+    if isinstance(value, dict):
+        items = sorted((key, fingerprint(item)) for key, item in value.iteritems())
+        return ("dict",) + tuple(items)
+    if isinstance(value, list):
+        return ("list",) + tuple(fingerprint(item) for item in value)
+    return value
+
+
+class InternTable:
+    """Maps values to a canonical, shared instance of themselves. Shared dicts must not be modified."""
+    def __init__(self, max_nr_values=MAX_NR_INTERNED_VALUES):
+        self._max_nr_values = max_nr_values
+        self._values = dict()
+
+    def intern(self, value):
+        if isinstance(value, basestring):
+            return self._intern_by_key(value, value)
+        if isinstance(value, dict):
+            value = dict((self.intern(key), self.intern(item)) for key, item in value.iteritems())
+            return self._intern_by_key(fingerprint(value), value)
+        if isinstance(value, list):
+            return [self.intern(item) for item in value]
+        return value
+
+    def nr_values(self):
+        return len(self._values)
+
+    def _intern_by_key(self, key, value):
+        if len(self._values) >= self._max_nr_values:
+            # Values which are already shared stay shared; Only new ones stop being deduplicated with them
+            self._values.clear()
+        return self._values.setdefault(key, value)
+
+
+interned = InternTable()
+
+
+class Node(object):
+    __slots__ = ("node_name", "requirements", "server_name")
+
+    def __init__(self, node_name, requirements):
+        self.node_name = interned.intern(node_name)
+        self.requirements = interned.intern(requirements)
+        self.server_name = None
+
+    def to_record(self):
+        record = dict(node_name=self.node_name, requirements=self.requirements)
+        if self.server_name is not None:
+            record["server_name"] = self.server_name
+        return record
+
+
+class AllocationState(object):
+    __slots__ = ("record_id", "allocation_info", "nodes", "nodes_by_name", "highest_phase_reached", "done",
+                 "reason", "request_timestamp", "allocation_id", "creation_timestamp",
+                 "inauguration_duration", "allocation_duration", "test_duration", "done_deadline_exceeded")
+
+    def __init__(self, allocation_info, requirements, request_timestamp):
+        self.record_id = None
+        self.allocation_info = interned.intern(allocation_info)
+        self.nodes = [Node(node_name, node_requirements) for node_name, node_requirements in
+                      requirements.iteritems()]
+        self.nodes_by_name = dict((node.node_name, node) for node in self.nodes)
+        self.highest_phase_reached = "requested"
+        self.done = False
+        self.reason = "Unknown"
+        self.request_timestamp = request_timestamp
+        self.allocation_id = None
+        self.creation_timestamp = None
+        self.inauguration_duration = None
+        self.allocation_duration = 0
+        self.test_duration = None
+        self.done_deadline_exceeded = False
+
+    def to_record(self):
+        record = dict(allocationInfo=self.allocation_info,
+                      nodes=[node.to_record() for node in self.nodes],
+                      nr_nodes=len(self.nodes),
+                      highest_phase_reached=self.highest_phase_reached,
+                      done=self.done,
+                      reason=self.reason,
+                      allocation_duration=self.allocation_duration,
+                      # Not set in states which were checkpointed by earlier versions
+                      done_deadline_exceeded=getattr(self, "done_deadline_exceeded", False),
+                      date=datetime_from_timestamp(self.request_timestamp))
+        if self.allocation_id is not None:
+            record["allocation_id"] = self.allocation_id
+        if self.creation_timestamp is not None:
+            record["creation_time"] = datetime_from_timestamp(self.creation_timestamp)
+        if self.inauguration_duration is not None:
+            record["inauguration_duration"] = self.inauguration_duration
+        if self.test_duration is not None:
+            record["test_duration"] = self.test_duration
+        return record
+
+
+class HostState(object):
+    __slots__ = ("host_id", "name", "allocation_idx", "start_timestamp", "end_timestamp",
+                 "inauguration_done", "latest_chain_count", "requirements", "inauguration_deadline_exceeded")
+
+    def __init__(self, host_id, name, allocation_idx, start_timestamp):
+        self.host_id = host_id
+        self.name = interned.intern(name)
+        self.allocation_idx = allocation_idx
+        self.start_timestamp = start_timestamp
+        self.end_timestamp = None
+        self.inauguration_done = False
+        self.latest_chain_count = None
+        self.requirements = None
+        self.inauguration_deadline_exceeded = False
+
+    def to_record(self):
+        record = dict(start_timestamp=self.start_timestamp,
+                      name=self.name,
+                      allocation_idx=self.allocation_idx,
+                      inauguration_done=self.inauguration_done,
+                      # Not set in states which were checkpointed by earlier versions
+                      inauguration_deadline_exceeded=getattr(self, "inauguration_deadline_exceeded", False))
+        if self.end_timestamp is not None:
+            record["end_timestamp"] = self.end_timestamp
+        if self.latest_chain_count is not None:
+            record["latest_chain_count"] = self.latest_chain_count
+        if self.requirements is not None:
+            record.update(self.requirements)
+        return record
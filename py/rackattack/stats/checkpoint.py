@@ -0,0 +1,96 @@
+import os
+import cPickle
+import logging
+
+
+SNAPSHOT_FILENAME = "snapshot.pickle"
+LOG_FILENAME = "changes.log"
+MIN_LOG_NR_BYTES_TO_COMPACT = 4 * 1024 * 1024
+
+
+class Checkpoint:
+    """A persistent key-value state, stored as a snapshot plus an append-only log of changes.
+
+    Each write appends the changed keys as a pickled frame to the log (a value of None removes the key).
+    Once the log grows larger than both min_log_nr_bytes_to_compact and the snapshot, should_compact()
+    returns True and the caller is expected to pass the whole state to compact(), which replaces the
+    snapshot and empties the log. A frame which was cut short (the process was killed while writing it) is
+    discarded on load.
+    """
+    def __init__(self, dirpath, min_log_nr_bytes_to_compact=MIN_LOG_NR_BYTES_TO_COMPACT):
+        self._snapshot_filepath = os.path.join(dirpath, SNAPSHOT_FILENAME)
+        self._log_filepath = os.path.join(dirpath, LOG_FILENAME)
+        self._min_log_nr_bytes_to_compact = min_log_nr_bytes_to_compact
+        self._snapshot_nr_bytes = 0
+        self._log = None
+        if not os.path.exists(dirpath):
+            logging.info("Creating the checkpoint directory in {}".format(dirpath))
+            os.makedirs(dirpath)
+
+    def load(self):
+        state = dict()
+        if os.path.exists(self._snapshot_filepath):
+            with open(self._snapshot_filepath, "rb") as snapshot:
+                state = cPickle.load(snapshot)
+            self._snapshot_nr_bytes = os.path.getsize(self._snapshot_filepath)
+        nr_frames = 0
+        valid_nr_bytes = 0
+        if os.path.exists(self._log_filepath):
+            with open(self._log_filepath, "rb") as log:
+                while True:
+                    try:
+                        changes = cPickle.load(log)
+                    except EOFError:
+                        break
+                    except Exception:
+                        logging.warn("Discarding a partially written checkpoint frame at offset {}."
+                                     .format(valid_nr_bytes))
+                        break
+                    self._apply(state, changes)
+                    nr_frames += 1
+                    valid_nr_bytes = log.tell()
+        self._log = open(self._log_filepath, "ab")
+        self._log.truncate(valid_nr_bytes)
+        logging.info("Loaded a checkpoint of {} keys ({} changes since the last snapshot).".format(
+            len(state), nr_frames))
+        return state
+
+    def write(self, changes):
+        """changes: a list of (key, value) pairs."""
+        if self._log is None:
+            self._log = open(self._log_filepath, "ab")
+        cPickle.dump(changes, self._log, cPickle.HIGHEST_PROTOCOL)
+        self._log.flush()
+
+    def should_compact(self):
+        if self._log is None:
+            return False
+        log_nr_bytes = os.fstat(self._log.fileno()).st_size
+        return log_nr_bytes >= self._min_log_nr_bytes_to_compact and log_nr_bytes >= self._snapshot_nr_bytes
+
+    def compact(self, state):
+        temp_filepath = self._snapshot_filepath + ".tmp"
+        with open(temp_filepath, "wb") as snapshot:
+            cPickle.dump(state, snapshot, cPickle.HIGHEST_PROTOCOL)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(temp_filepath, self._snapshot_filepath)
+        self._snapshot_nr_bytes = os.path.getsize(self._snapshot_filepath)
+        if self._log is not None:
+            self._log.close()
+        # A crash before the log is emptied is harmless; Replaying it over the new snapshot changes nothing
+        self._log = open(self._log_filepath, "wb")
+        logging.info("Compacted the checkpoint ({} keys).".format(len(state)))
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    @staticmethod
+    def _apply(state, changes):
+        for key, value in changes:
+            if value is None:
+                state.pop(key, None)
+            else:
+                state[key] = value
@@ -0,0 +1,122 @@
+import copy
+import time
+import uuid
+import logging
+import threading
+import collections
+
+
+COALESCING_WINDOW_NR_SECONDS = 10
+MAX_NR_TRACKED_DOCUMENTS = 10000
+
+
+class _PendingAction:
+    def __init__(self, op_type, index, doc_type, id, doc, deadline):
+        self.op_type = op_type
+        self.index = index
+        self.doc_type = doc_type
+        self.id = id
+        self.doc = doc
+        self.deadline = deadline
+
+
+class CoalescingWriter:
+    """Merges successive writes of the same document (by ID) that occur within a time window.
+
+    A document created and then updated within the window is written once, in its final state. Updates
+    contain only the fields that differ from what was already written for that document. Pending writes
+    are emitted to the underlying DB once their window has passed (by a background thread), on flush()
+    for those which are due, and on flush_all() for all of them.
+    """
+    def __init__(self, db, window=COALESCING_WINDOW_NR_SECONDS,
+                 max_nr_tracked_documents=MAX_NR_TRACKED_DOCUMENTS):
+        self._db = db
+        self._window = window
+        self._max_nr_tracked_documents = max_nr_tracked_documents
+        self._lock = threading.RLock()
+        self._pending = collections.OrderedDict()
+        self._written = collections.OrderedDict()
+        self._nr_merged_writes = 0
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._emit_periodically, name="coalescingwriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def create(self, index, doc_type, body, id=None):
+        if id is None:
+            id = uuid.uuid4().hex
+        with self._lock:
+            self._emit(id)
+            self._written.pop(id, None)
+            self._pending[id] = _PendingAction("create", index, doc_type, id, copy.deepcopy(body),
+                                               time.time() + self._window)
+        return dict(_index=index, _type=doc_type, _id=id)
+
+    def update(self, index, doc_type, id, body):
+        with self._lock:
+            if body.keys() != ["doc"]:
+                # Not a partial document (e.g. a script); Nothing to merge it with
+                self._emit(id)
+                return self._db.update(index=index, doc_type=doc_type, id=id, body=body)
+            pending = self._pending.get(id)
+            if pending is None:
+                pending = _PendingAction("update", index, doc_type, id, dict(), time.time() + self._window)
+            else:
+                self._nr_merged_writes += 1
+            written = self._written.get(id, dict())
+            for key, value in body["doc"].iteritems():
+                if key in pending.doc or key not in written or written[key] != value:
+                    pending.doc[key] = copy.deepcopy(value)
+            if pending.doc:
+                self._pending[id] = pending
+        return dict(_index=index, _type=doc_type, _id=id)
+
+    def flush(self):
+        """Emit the pending writes whose window has passed, and flush the underlying DB."""
+        with self._lock:
+            now = time.time()
+            due = [id for id, pending in self._pending.iteritems() if pending.deadline <= now]
+            for id in due:
+                self._emit(id)
+        return self._db.flush()
+
+    def flush_all(self):
+        with self._lock:
+            while self._pending:
+                self._emit(next(iter(self._pending)))
+        return self._db.flush()
+
+    def close(self):
+        self._stop_event.set()
+        self._thread.join()
+        self.flush_all()
+
+    def nr_merged_writes(self):
+        return self._nr_merged_writes
+
+    def handle_disconnection(self):
+        self._db.handle_disconnection()
+
+    def _emit(self, id):
+        pending = self._pending.pop(id, None)
+        if pending is None:
+            return
+        if pending.op_type == "create":
+            self._db.create(index=pending.index, doc_type=pending.doc_type, body=pending.doc, id=id)
+            written = copy.deepcopy(pending.doc)
+        else:
+            self._db.update(index=pending.index, doc_type=pending.doc_type, id=id,
+                            body=dict(doc=pending.doc))
+            written = self._written.pop(id, dict())
+            written.update(copy.deepcopy(pending.doc))
+        self._written[id] = written
+        while len(self._written) > self._max_nr_tracked_documents:
+            self._written.popitem(last=False)
+
+    def _emit_periodically(self):
+        while not self._stop_event.is_set():
+            self._stop_event.wait(max(self._window / 2.0, 0.1))
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Failed emitting pending DB writes.")
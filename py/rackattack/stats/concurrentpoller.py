@@ -0,0 +1,55 @@
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+
+def _call(func):
+    try:
+        return True, func()
+    except Exception:
+        return False, traceback.format_exc()
+
+
+class ConcurrentPoller:
+    """Calls a function per key (e.g. per site) concurrently, and waits for all of them up to a timeout.
+
+    A call which did not return by the timeout is not waited for, and no new call is made for its key until
+    it returns (its result is then dropped), so a slow key neither delays the others nor piles up calls.
+    """
+    def __init__(self, nr_threads, timeout):
+        self._pool = ThreadPool(nr_threads)
+        self._timeout = timeout
+        self._late_calls = dict()
+
+    def poll(self, funcs):
+        """funcs maps keys to functions. Returns the results of the calls which returned (by key), the
+        tracebacks of those which raised (by key), and the keys of the calls which did not return in time
+        (in this poll or in a previous one)."""
+        calls = dict()
+        timed_out = list()
+        for key, func in funcs.iteritems():
+            late_call = self._late_calls.pop(key, None)
+            if late_call is not None and not late_call.ready():
+                self._late_calls[key] = late_call
+                timed_out.append(key)
+                continue
+            calls[key] = self._pool.apply_async(_call, (func,))
+        results = dict()
+        errors = dict()
+        # All the calls run concurrently, so the timeout is waited for once in total
+        deadline = time.time() + self._timeout
+        for key, call in calls.iteritems():
+            call.wait(max(deadline - time.time(), 0))
+            if not call.ready():
+                self._late_calls[key] = call
+                timed_out.append(key)
+                continue
+            is_ok, value = call.get()
+            if is_ok:
+                results[key] = value
+            else:
+                errors[key] = value
+        return results, errors, sorted(timed_out)
+
+    def close(self):
+        self._pool.terminate()
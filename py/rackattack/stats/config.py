@@ -1,3 +1,4 @@
 ELASTICSEARCH_DB_ADDR = "elastic.dc1.strato"
 ELASTICSEARCH_DB_PORT = 9200
 TIMEZONE = 'Asia/Jerusalem'
+SPOOL_DIRPATH = "/var/lib/rackattackstats/spool"
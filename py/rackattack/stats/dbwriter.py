@@ -0,0 +1,102 @@
+import copy
+import uuid
+import Queue
+import logging
+import threading
+
+
+NR_WORKERS = 4
+MAX_NR_IN_FLIGHT = 1000
+
+
+class _FlushBarrier:
+    """Flushes the DB once, by the last worker to reach it, so that buffered actions are sent together."""
+    def __init__(self, db, nr_workers):
+        self._db = db
+        self._nr_remaining_workers = nr_workers
+        self._lock = threading.Lock()
+
+    def flush(self):
+        with self._lock:
+            self._nr_remaining_workers -= 1
+            if self._nr_remaining_workers > 0:
+                return None
+        return self._db.flush()
+
+
+class AsyncDBWriter:
+    """Performs DB writes in background threads, so that callers never wait for the DB.
+
+    Actions on the same document ID are always handled by the same worker, so their order is kept.
+    Submitting an action blocks only when max_nr_in_flight actions are already waiting to be done.
+    Callbacks are called with (result, exception) once their action is done. Bodies are copied on
+    submission, since callers keep modifying their records afterwards.
+    """
+    def __init__(self, db, nr_workers=NR_WORKERS, max_nr_in_flight=MAX_NR_IN_FLIGHT, error_func=None):
+        self._db = db
+        self._error_func = error_func
+        self._in_flight = threading.Semaphore(max_nr_in_flight)
+        self._queues = [Queue.Queue() for _ in xrange(nr_workers)]
+        for worker_idx, queue in enumerate(self._queues):
+            worker = threading.Thread(target=self._work, args=(queue,),
+                                      name="dbwriter-{}".format(worker_idx))
+            worker.daemon = True
+            worker.start()
+
+    def create(self, index, doc_type, body, id=None, callback=None):
+        if id is None:
+            id = uuid.uuid4().hex
+        self._submit(id, self._db.create, dict(index=index, doc_type=doc_type, body=body, id=id), callback)
+        return dict(_index=index, _type=doc_type, _id=id)
+
+    def update(self, index, doc_type, id, body, callback=None):
+        self._submit(id, self._db.update, dict(index=index, doc_type=doc_type, id=id, body=body), callback)
+        return dict(_index=index, _type=doc_type, _id=id)
+
+    def flush(self):
+        """Flush the DB once all actions submitted so far are done (does not wait for it)."""
+        barrier = _FlushBarrier(self._db, len(self._queues))
+        for queue in self._queues:
+            self._in_flight.acquire()
+            queue.put((barrier.flush, dict(), None))
+
+    def join(self):
+        """Wait until all actions submitted so far are done."""
+        for queue in self._queues:
+            queue.join()
+
+    def close(self):
+        self.flush()
+        self.join()
+
+    def handle_disconnection(self):
+        self._db.handle_disconnection()
+
+    def _submit(self, id, func, kwargs, callback):
+        kwargs["body"] = copy.deepcopy(kwargs["body"])
+        self._in_flight.acquire()
+        queue = self._queues[hash(id) % len(self._queues)]
+        queue.put((func, kwargs, callback))
+
+    def _work(self, queue):
+        while True:
+            func, kwargs, callback = queue.get()
+            result = None
+            error = None
+            try:
+                result = func(**kwargs)
+            except Exception as ex:
+                error = ex
+                if callback is None:
+                    msg = "DB action failed ({}): {}".format(func.__name__, kwargs)
+                    logging.exception(msg)
+                    if self._error_func is not None:
+                        self._error_func(msg)
+            finally:
+                self._in_flight.release()
+            if callback is not None:
+                try:
+                    callback(result, error)
+                except Exception:
+                    logging.exception("DB action callback failed.")
+            queue.task_done()
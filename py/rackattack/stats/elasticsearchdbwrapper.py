@@ -1,33 +1,62 @@
+import os
 import time
+import json
+import uuid
 import logging
+import threading
 import traceback
 import elasticsearch
+from rackattack.stats import spool
 from rackattack.stats import config
+from rackattack.stats import metrics
 
 
 DB_RECONNECTION_ATTEMPTS_INTERVAL = 60
+BULK_MAX_NR_ACTIONS = 500
+BULK_MAX_NR_BYTES = 5 * 1024 * 1024
+BULK_MAX_AGE_NR_SECONDS = 5
+# Statuses of requests (or of single items) which failed since the DB is unavailable for a while
+UNAVAILABILITY_STATUS_CODES = (429, 502, 503, 504)
+
+bulk_request_durations = metrics.default_registry.histogram(
+    "rackattack_stats_db_bulk_request_duration_seconds", "Duration of bulk requests to the DB.")
+sent_actions = metrics.default_registry.counter(
+    "rackattack_stats_db_actions_total", "Actions sent to the DB, by result.", label_names=("result",))
+db_reconnections = metrics.default_registry.counter(
+    "rackattack_stats_db_reconnections_total", "Times the connection to the DB was lost.")
 
 
 is_connected = False
 
 
 class ElasticsearchDBWrapper:
-    def __init__(self, alert_func=None):
+    def __init__(self, alert_func=None, wait_for_connection=True):
         self._alert_func = alert_func
         self._db = elasticsearch.Elasticsearch([{"host": config.ELASTICSEARCH_DB_ADDR,
                                                  "port": config.ELASTICSEARCH_DB_PORT}])
         self._was_first_connection_attempt_done_yet = False
-        self._validate()
+        self._validate(wait_for_connection)
         logging.getLogger('elasticsearch.trace').setLevel(logging.WARNING)
         logging.getLogger('elasticsearch').setLevel(logging.WARNING)
 
     def create(self, *args, **kwargs):
-        self._db.create(*args, **kwargs)
+        return self._db.create(*args, **kwargs)
 
     def update(self, *args, **kwargs):
-        self._db.update(*args, **kwargs)
+        return self._db.update(*args, **kwargs)
+
+    def bulk(self, *args, **kwargs):
+        return self._db.bulk(*args, **kwargs)
+
+    def serialize(self, data):
+        return self._db.transport.serializer.dumps(data)
+
+    def flush(self):
+        """Nothing is buffered here; Exists so that all DB objects can be flushed the same way."""
+        return list()
 
     def handle_disconnection(self):
+        db_reconnections.inc()
         msg = "An error occurred while talking to the DB:\n {}. Attempting to reconnect..." \
             .format(traceback.format_exc())
         logging.error(msg)
@@ -38,7 +67,7 @@ class ElasticsearchDBWrapper:
             msg = "Connected to the DB again."
             self._alert_func(msg)
 
-    def _validate(self):
+    def _validate(self, wait_for_connection=True):
         is_connected = False
         is_reconnection = self._was_first_connection_attempt_done_yet
         db_addr = config.ELASTICSEARCH_DB_ADDR
@@ -65,3 +94,213 @@ class ElasticsearchDBWrapper:
                     if self._alert_func is not None:
                         self._alert_func(msg)
                 is_reconnection = True
+                if not wait_for_connection:
+                    logging.info("Not waiting for the DB to be available.")
+                    break
+
+
+class BulkWriter:
+    """Buffers create/update operations and sends them to the DB through the _bulk API.
+
+    The buffer is flushed when it reaches a number of actions, a size in bytes, or when its oldest
+    action gets too old. IDs of created documents are generated here (unless given), so that create()
+    can return them before the document is actually sent.
+
+    If a spool is given, actions that cannot be sent since the DB is unreachable are appended to it
+    instead of blocking, and are replayed in order (before any newer action) once the DB is back.
+    """
+    def __init__(self, db,
+                 max_nr_actions=BULK_MAX_NR_ACTIONS,
+                 max_nr_bytes=BULK_MAX_NR_BYTES,
+                 max_age=BULK_MAX_AGE_NR_SECONDS,
+                 item_error_func=None,
+                 spool=None,
+                 alert_func=None):
+        self._db = db
+        self._max_nr_actions = max_nr_actions
+        self._max_nr_bytes = max_nr_bytes
+        self._max_age = max_age
+        self._item_error_func = item_error_func
+        self._spool = spool
+        self._alert_func = alert_func
+        self._lock = threading.Lock()
+        self._actions = list()
+        self._lines = list()
+        self._nr_bytes = 0
+        self._time_of_oldest_action = None
+        self._time_of_last_db_failure = None
+
+    def create(self, index, doc_type, body, id=None):
+        if id is None:
+            id = uuid.uuid4().hex
+        action = dict(create=dict(_index=index, _type=doc_type, _id=id))
+        self._add(action, body)
+        return dict(_index=index, _type=doc_type, _id=id)
+
+    def update(self, index, doc_type, id, body):
+        action = dict(update=dict(_index=index, _type=doc_type, _id=id))
+        self._add(action, body)
+        return dict(_index=index, _type=doc_type, _id=id)
+
+    def flush(self):
+        """Send all pending actions. Returns the (action, result) pairs of the actions that failed."""
+        with self._lock:
+            return self._flush()
+
+    def nr_pending_actions(self):
+        return len(self._actions)
+
+    def is_db_available(self):
+        return self._time_of_last_db_failure is None
+
+    def handle_disconnection(self):
+        self._db.handle_disconnection()
+
+    def _add(self, action, body):
+        lines = [self._db.serialize(action), self._db.serialize(body)]
+        with self._lock:
+            if not self._actions:
+                self._time_of_oldest_action = time.time()
+            self._actions.append(action)
+            self._lines.extend(lines)
+            self._nr_bytes += sum(len(line) + 1 for line in lines)
+            if self._is_flush_due():
+                self._flush()
+
+    def _is_flush_due(self):
+        return len(self._actions) >= self._max_nr_actions or \
+            self._nr_bytes >= self._max_nr_bytes or \
+            time.time() - self._time_of_oldest_action >= self._max_age
+
+    def _flush(self):
+        if self._spool is None:
+            return self._send_pending_actions()
+        if not self._actions and self._spool.is_empty():
+            return list()
+        if not self._is_time_to_try_the_db():
+            self._spool_pending_actions()
+            return list()
+        try:
+            self._spool.replay(self._send_spooled_lines)
+            failures = self._send_pending_actions()
+        except elasticsearch.TransportError as ex:
+            if not self._is_unavailability_error(ex):
+                raise
+            self._handle_db_unavailability()
+            self._spool_pending_actions()
+            return list()
+        if self._time_of_last_db_failure is not None:
+            self._time_of_last_db_failure = None
+            msg = "Connected to the DB again; Spooled actions were sent."
+            logging.info(msg)
+            if self._alert_func is not None:
+                self._alert_func(msg)
+        return failures
+
+    def _send_pending_actions(self):
+        if not self._actions:
+            return list()
+        # Pending actions are kept if the request fails, so that they are sent again on the next flush
+        failures = self._send(self._actions, self._lines)
+        self._clear_pending_actions()
+        return failures
+
+    def _send_spooled_lines(self, lines):
+        # A line pair may have been sent before the process stopped, so conflicts on creation are expected
+        if len(lines) % 2:
+            lines = lines[:-1]
+        failures = list()
+        for start in xrange(0, len(lines), self._max_nr_actions * 2):
+            chunk = lines[start:start + self._max_nr_actions * 2]
+            actions = [json.loads(line) for line in chunk[::2]]
+            failures.extend(self._send(actions, chunk, is_replay=True))
+        statuses = set(result.get("status") for _, result in failures)
+        unavailability_statuses = statuses.intersection(UNAVAILABILITY_STATUS_CODES)
+        if unavailability_statuses:
+            # The segment is kept, and replayed again as a whole (creations which succeeded now will
+            # conflict then, which is expected on replay)
+            raise elasticsearch.TransportError(min(unavailability_statuses),
+                                               "{} spooled actions were rejected by the DB".format(
+                                                   len(failures)))
+        if failures:
+            logging.error("{} spooled actions were rejected by the DB, and are dropped."
+                          .format(len(failures)))
+
+    def _send(self, actions, lines, is_replay=False):
+        logging.debug("Sending {} actions to the DB...".format(len(actions)))
+        before = time.time()
+        try:
+            response = self._db.bulk(body="\n".join(lines) + "\n")
+        except elasticsearch.TransportError as ex:
+            if self._is_unavailability_error(ex):
+                raise
+            # The request was rejected as a whole (e.g. a malformed body); Sending it again would fail
+            # the same way, so its actions are reported as failed instead of being kept
+            logging.exception("The DB rejected a request of {} actions.".format(len(actions)))
+            result = dict(status=ex.status_code, error=ex.error)
+            return self._report_failures(actions, [(action, result) for action in actions])
+        bulk_request_durations.observe(time.time() - before)
+        if not response.get("errors", False):
+            sent_actions.labels("ok").inc(len(actions))
+            return list()
+        failures = list()
+        for action, item in zip(actions, response["items"]):
+            op_type, result = item.items()[0]
+            status = result.get("status", 200)
+            if status < 300 or (is_replay and op_type == "create" and status == 409):
+                continue
+            failures.append((action, result))
+        return self._report_failures(actions, failures)
+
+    def _report_failures(self, actions, failures):
+        for action, result in failures:
+            logging.error("DB action failed: {}. Result: {}".format(action, result))
+            if self._item_error_func is not None:
+                self._item_error_func(action, result)
+        sent_actions.labels("ok").inc(len(actions) - len(failures))
+        sent_actions.labels("failed").inc(len(failures))
+        return failures
+
+    def _spool_pending_actions(self):
+        if not self._actions:
+            return
+        logging.info("Spooling {} actions to disk...".format(len(self._actions)))
+        self._spool.append(self._lines)
+        self._clear_pending_actions()
+
+    def _clear_pending_actions(self):
+        self._actions = list()
+        self._lines = list()
+        self._nr_bytes = 0
+        self._time_of_oldest_action = None
+
+    def _is_time_to_try_the_db(self):
+        if self._time_of_last_db_failure is None:
+            return True
+        return time.time() - self._time_of_last_db_failure >= DB_RECONNECTION_ATTEMPTS_INTERVAL
+
+    def _handle_db_unavailability(self):
+        is_first_failure = self._time_of_last_db_failure is None
+        self._time_of_last_db_failure = time.time()
+        if is_first_failure:
+            db_reconnections.inc()
+        else:
+            logging.info("The DB is still unreachable. Will try again in {} seconds."
+                         .format(DB_RECONNECTION_ATTEMPTS_INTERVAL))
+            return
+        msg = "The DB is unreachable:\n {}. Spooling actions to disk until it is back..." \
+            .format(traceback.format_exc())
+        logging.error(msg)
+        if self._alert_func is not None:
+            self._alert_func(msg)
+
+    @staticmethod
+    def _is_unavailability_error(ex):
+        return isinstance(ex, elasticsearch.ConnectionError) or ex.status_code in UNAVAILABILITY_STATUS_CODES
+
+
+def create_spooled_bulk_writer(spool_name, alert_func=None):
+    """Create a bulk writer which spools actions to disk while the DB is unreachable."""
+    db = ElasticsearchDBWrapper(alert_func=alert_func, wait_for_connection=False)
+    spool_dirpath = os.path.join(config.SPOOL_DIRPATH, spool_name)
+    return BulkWriter(db, spool=spool.Spool(spool_dirpath), alert_func=alert_func)
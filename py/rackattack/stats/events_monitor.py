@@ -1,17 +1,23 @@
 import time
-import threading
+from rackattack.stats import timerwheel
 
 
 class EventsMonitor:
-    def __init__(self, max_nr_seconds_without_events_before_alerting, alert_info_func, alert_warn_func):
+    def __init__(self, max_nr_seconds_without_events_before_alerting, alert_info_func, alert_warn_func,
+                 timer_wheel=None):
         self._max_nr_seconds_without_events_before_alerting = max_nr_seconds_without_events_before_alerting
-        self._timer = None
         self._time_of_last_event = None
         self._is_no_events_mode_on = False
         self._alert_info_func = alert_info_func
         self._alert_warn_func = alert_warn_func
+        self._is_timer_wheel_owned = timer_wheel is None
+        if self._is_timer_wheel_owned:
+            timer_wheel = timerwheel.TimerWheel()
+        self._timer_wheel = timer_wheel
 
     def start(self):
+        if self._is_timer_wheel_owned:
+            self._timer_wheel.start()
         self._time_of_last_event = time.time()
         self._start_timer(self._max_nr_seconds_without_events_before_alerting)
 
@@ -36,5 +42,4 @@ class EventsMonitor:
             self._start_timer(nr_seconds_till_timeout)
 
     def _start_timer(self, timeout):
-        self._timer = threading.Timer(timeout, self._handle_timeout)
-        self._timer.start()
+        self._timer_wheel.schedule(timeout, self._handle_timeout)
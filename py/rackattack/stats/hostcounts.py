@@ -0,0 +1,38 @@
+"""Counts hosts by combinations of their fields (dimensions), in a single pass over the hosts."""
+import collections
+
+
+INDEX = "host_counts"
+DOC_TYPE = "host_count"
+
+
+def count_hosts(hosts, dimensions):
+    """Returns a dict from each dimension (a tuple of host fields) to the number of hosts of each
+    combination of values of its fields (a tuple as well). Fields which a host lacks count as None."""
+    fields = sorted(set(field for dimension in dimensions for field in dimension))
+    field_indices = dict((field, idx) for idx, field in enumerate(fields))
+    dimension_indices = [(dimension, [field_indices[field] for field in dimension])
+                         for dimension in dimensions]
+    # Hosts of the same values of all fields fall into one bucket, so each dimension is computed from the
+    # buckets (usually much fewer than the hosts) rather than from the hosts
+    nr_hosts_by_values = collections.Counter(tuple(host.get(field) for field in fields) for host in hosts)
+    counts = dict()
+    for dimension, indices in dimension_indices:
+        dimension_counts = counts.setdefault(dimension, collections.Counter())
+        for values, nr_hosts in nr_hosts_by_values.iteritems():
+            dimension_counts[tuple(values[idx] for idx in indices)] += nr_hosts
+    return counts
+
+
+def dimension_name(dimension):
+    return "+".join(dimension)
+
+
+def to_records(counts, date):
+    records = list()
+    for dimension, dimension_counts in sorted(counts.iteritems()):
+        for values, count in sorted(dimension_counts.iteritems()):
+            record = dict(zip(dimension, values))
+            record.update(dimension=dimension_name(dimension), count=count, date=date)
+            records.append(record)
+    return records
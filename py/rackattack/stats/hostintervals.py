@@ -0,0 +1,48 @@
+"""Intervals in which hosts stayed in a state (and pool), computed by diffing consecutive polls.
+
+An interval ends when a host is seen in another state or pool than in the previous poll, or is no longer
+seen at all, and its end is the time of that poll. The start of the intervals which were in progress on
+the first poll is not known, so these intervals start on that poll and are marked as partial.
+"""
+from rackattack.stats import hostsnapshots
+
+
+INDEX = "host_state_intervals"
+DOC_TYPE = "host_state_interval"
+TRACKED_FIELDS = ("state", "pool")
+
+
+class HostIntervals:
+    def __init__(self, fields=TRACKED_FIELDS):
+        self._fields = fields
+        self._previous = None
+        self._start_dates = dict()
+        self._partial_host_ids = set()
+
+    def sample(self, hosts, date):
+        """Returns the records of the intervals which ended by the given poll (date is a datetime)."""
+        current = hostsnapshots.host_fields(hosts, self._fields)
+        if self._previous is None:
+            self._previous = dict()
+            self._partial_host_ids = set(current)
+        changed, removed = hostsnapshots.diff(self._previous, current)
+        records = list()
+        for host_id in changed + removed:
+            if host_id in self._previous:
+                records.append(self._end_interval(host_id, date))
+            if host_id in current:
+                self._start_dates[host_id] = date
+        self._previous = current
+        return records
+
+    def has_previous_sample(self):
+        """Whether the next sample is diffed against a previous one (so intervals can end on it)."""
+        return self._previous is not None
+
+    def _end_interval(self, host_id, end):
+        start = self._start_dates.pop(host_id)
+        record = dict(zip(self._fields, self._previous[host_id]))
+        record.update(host_id=host_id, start=start, end=end, duration=(end - start).total_seconds(),
+                      partial=host_id in self._partial_host_ids)
+        self._partial_host_ids.discard(host_id)
+        return record
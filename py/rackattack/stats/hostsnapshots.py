@@ -0,0 +1,78 @@
+"""Per-host snapshots of RackAttack's status, delta encoded.
+
+Only hosts whose tracked fields changed since the previous poll are written (and hosts which disappeared,
+marked as removed). A keyframe of all hosts is written on the first poll, and then every
+KEYFRAME_INTERVAL_NR_SAMPLES polls. The status of the fleet at some time is rebuilt from the latest
+keyframe before that time, and the deltas written after that keyframe (see rebuild).
+"""
+
+
+INDEX = "host_snapshots"
+DOC_TYPE = "host_snapshot"
+TRACKED_FIELDS = ("state", "pool")
+KEYFRAME_INTERVAL_NR_SAMPLES = 60
+
+
+def host_fields(hosts, fields=TRACKED_FIELDS):
+    """Maps the ID of each host to the values of the given fields (a tuple)."""
+    return dict((host['id'], tuple(host.get(field) for field in fields)) for host in hosts)
+
+
+def diff(previous, current):
+    """Given two results of host_fields, returns the IDs of the hosts which were added or changed, and the
+    IDs of the hosts which were removed."""
+    changed = [host_id for host_id, values in current.iteritems() if previous.get(host_id) != values]
+    removed = [host_id for host_id in previous if host_id not in current]
+    return sorted(changed), sorted(removed)
+
+
+class HostSnapshots:
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL_NR_SAMPLES, fields=TRACKED_FIELDS):
+        self._keyframe_interval = keyframe_interval
+        self._fields = fields
+        self._previous = None
+        self._nr_samples_since_keyframe = 0
+
+    def sample(self, hosts, date):
+        """Returns the records to write for the given hosts (taken from admin__queryStatus)."""
+        current = host_fields(hosts, self._fields)
+        is_keyframe = (self._previous is None or
+                       self._nr_samples_since_keyframe + 1 >= self._keyframe_interval)
+        if is_keyframe:
+            changed, removed = sorted(current), list()
+            self._nr_samples_since_keyframe = 0
+        else:
+            changed, removed = diff(self._previous, current)
+            self._nr_samples_since_keyframe += 1
+        self._previous = current
+        records = [self._record(host_id, current[host_id], date, is_keyframe) for host_id in changed]
+        removed_values = (None,) * len(self._fields)
+        records.extend(self._record(host_id, removed_values, date, is_keyframe=False, is_removed=True)
+                       for host_id in removed)
+        return records
+
+    def reset(self):
+        """Write a keyframe on the next sample (e.g. since the records of the last one were lost)."""
+        self._previous = None
+
+    def _record(self, host_id, values, date, is_keyframe, is_removed=False):
+        record = dict(zip(self._fields, values))
+        record.update(host_id=host_id, date=date, keyframe=is_keyframe, removed=is_removed)
+        return record
+
+
+def rebuild(records):
+    """Returns the status of each host (a dict of its tracked fields) after the given records, which must be
+    sorted by date. Records before the latest keyframe are ignored."""
+    hosts = dict()
+    keyframe_date = None
+    for record in records:
+        if record["keyframe"] and record["date"] != keyframe_date:
+            hosts = dict()
+            keyframe_date = record["date"]
+        if record["removed"]:
+            hosts.pop(record["host_id"], None)
+            continue
+        hosts[record["host_id"]] = dict((key, value) for key, value in record.iteritems()
+                                        if key not in ("host_id", "date", "keyframe", "removed"))
+    return hosts
@@ -0,0 +1,116 @@
+import os
+import gzip
+import json
+import time
+import zlib
+import logging
+import threading
+
+
+SEGMENT_MAX_NR_BYTES = 64 * 1024 * 1024
+SEGMENT_MAX_AGE_NR_SECONDS = 60 * 60
+MAX_NR_SEGMENTS = 24 * 30
+FLUSH_INTERVAL_NR_SECONDS = 1
+SEGMENT_FILENAME_SUFFIX = ".journal.gz"
+READ_CHUNK_NR_BYTES = 1024 * 1024
+
+
+class Journal:
+    """Records raw messages as time-stamped JSON lines in gzipped, rotating segment files.
+
+    A segment is rotated once it holds max_segment_nr_bytes (before compression) or once it is older than
+    max_segment_age. Only the newest max_nr_segments segments are kept. Segments are named after the time
+    at which they were started, so that their order is that of their filenames.
+    """
+    def __init__(self, dirpath, max_segment_nr_bytes=SEGMENT_MAX_NR_BYTES,
+                 max_segment_age=SEGMENT_MAX_AGE_NR_SECONDS, max_nr_segments=MAX_NR_SEGMENTS):
+        self._dirpath = dirpath
+        self._max_segment_nr_bytes = max_segment_nr_bytes
+        self._max_segment_age = max_segment_age
+        self._max_nr_segments = max_nr_segments
+        self._lock = threading.Lock()
+        self._current_segment = None
+        self._current_segment_nr_bytes = 0
+        self._current_segment_start_time = None
+        self._last_flush_time = 0
+        if not os.path.exists(dirpath):
+            logging.info("Creating the journal directory in {}".format(dirpath))
+            os.makedirs(dirpath)
+
+    def record(self, kind, message):
+        now = time.time()
+        line = json.dumps(dict(timestamp=now, kind=kind, message=message)) + "\n"
+        with self._lock:
+            if self._is_rotation_due(now):
+                self._start_new_segment(now)
+            self._current_segment.write(line)
+            self._current_segment_nr_bytes += len(line)
+            if now - self._last_flush_time >= FLUSH_INTERVAL_NR_SECONDS:
+                # Lets a reader (or a restart after a crash) see everything up to here
+                self._current_segment.flush(zlib.Z_SYNC_FLUSH)
+                self._last_flush_time = now
+
+    def close(self):
+        with self._lock:
+            self._close_current_segment()
+
+    def _is_rotation_due(self, now):
+        return self._current_segment is None or \
+            self._current_segment_nr_bytes >= self._max_segment_nr_bytes or \
+            now - self._current_segment_start_time >= self._max_segment_age
+
+    def _start_new_segment(self, now):
+        self._close_current_segment()
+        filename = "%.6f%s" % (now, SEGMENT_FILENAME_SUFFIX)
+        self._current_segment = gzip.open(os.path.join(self._dirpath, filename), "ab")
+        self._current_segment_nr_bytes = 0
+        self._current_segment_start_time = now
+        for filepath in list_segments(self._dirpath)[:-self._max_nr_segments]:
+            logging.info("Removing an old journal segment: {}".format(filepath))
+            os.unlink(filepath)
+
+    def _close_current_segment(self):
+        if self._current_segment is not None:
+            self._current_segment.close()
+            self._current_segment = None
+
+
+def list_segments(dirpath):
+    filenames = [filename for filename in os.listdir(dirpath) if filename.endswith(SEGMENT_FILENAME_SUFFIX)]
+    filenames.sort(key=lambda filename: float(filename[:-len(SEGMENT_FILENAME_SUFFIX)]))
+    return [os.path.join(dirpath, filename) for filename in filenames]
+
+
+def read(dirpath):
+    """Yield the (timestamp, kind, message) entries of all segments in the journal, oldest first."""
+    for filepath in list_segments(dirpath):
+        for line in _read_lines(filepath):
+            entry = json.loads(line)
+            yield entry["timestamp"], entry["kind"], entry["message"]
+
+
+def _read_lines(filepath):
+    # Decompressed by hand rather than with gzip, which cannot read segments that were not closed
+    # properly (e.g. the process was killed) up to their last flush
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = ""
+    with open(filepath, "rb") as segment:
+        while True:
+            data = segment.read(READ_CHUNK_NR_BYTES)
+            if not data:
+                break
+            while data:
+                try:
+                    pending += decompressor.decompress(data)
+                except zlib.error:
+                    logging.warn("Journal segment {} is corrupted; Skipping the rest of it."
+                                 .format(filepath))
+                    return
+                # A segment may consist of several gzip members
+                data = decompressor.unused_data
+                if data:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            lines = pending.split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line
@@ -1,38 +1,79 @@
 import os
 import sys
 import time
-import pytz
+import json
 import Queue
 import signal
 import pprint
 import socket
 import smtplib
 import logging
-import datetime
 import threading
 import traceback
 import elasticsearch
 from functools import partial
 from email.mime.text import MIMEText
 from rackattack.tcp import subscribe
+from rackattack.stats import spool
 from rackattack.stats import config
+from rackattack.stats import metrics
+from rackattack.stats import registry
+from rackattack.stats import dbwriter
+from rackattack.stats import journal
+from rackattack.stats import tracing
+from rackattack.stats import taskqueue
+from rackattack.stats import checkpoint
+from rackattack.stats import timerwheel
 from rackattack.stats import logconfig
 from rackattack.stats import events_monitor
+from rackattack.stats import activitytracker
+from rackattack.stats import allocationstate
+from rackattack.stats import pendingrequests
+from rackattack.stats import coalescingwriter
 from rackattack.stats import elasticsearchdbwrapper
 
 
-MAX_NR_ALLOCATIONS = 150
+# The compact state of an allocation of 10 hosts takes about 10KB
+MAX_NR_ALLOCATIONS = 3000
 EMAIL_SUBSCRIBERS = ("eliran@stratoscale.com",)
 MAX_NR_SECONDS_WITHOUT_EVENTS_BEFORE_ALERTING = 60 * 60 * 6
 SEND_ALERTS_BY_MAIL = True
 SENDER_EMAIL = "eliran@stratoscale.com"
 SMTP_SERVER = 'localhost'
-
-
-def datetime_from_timestamp(timestamp):
-    datetime_now = datetime.datetime.fromtimestamp(timestamp)
-    datetime_now = pytz.timezone(config.TIMEZONE).localize(datetime_now)
-    return datetime_now
+DB_WRITES_COALESCING_WINDOW_NR_SECONDS = 10
+HOST_INDICES_REGISTRY_PATH = "/var/lib/rackattackstats/host-indices-registry.json"
+CHECKPOINT_DIRPATH = "/var/lib/rackattackstats/allocations-checkpoint"
+JOURNAL_DIRPATH = "/var/lib/rackattackstats/allocations-journal"
+MAX_NR_PENDING_TASKS = 100000
+TASKS_OVERFLOW_POLICY = taskqueue.OVERFLOW_POLICY_SPILL
+TASKS_SPOOL_NAME = "allocation-tasks"
+TASKS_STATS_LOGGING_INTERVAL_NR_SECONDS = 60
+NR_ALLOCATION_SHARDS = 1
+MAX_ALLOCATION_IDLE_NR_SECONDS = 60 * 60 * 24 * 2
+ALLOCATION_IDLE_TIMEOUT_REASON = "timed out"
+ALLOCATION_EVICTION_REASON = "evicted (too many open allocations)"
+MAX_INAUGURATION_NR_SECONDS = 60 * 20
+MAX_NR_SECONDS_UNTIL_ALLOCATION_DONE = 60 * 30
+METRICS_PORT = 9701
+TRACING_ENABLED = False
+NR_TRACED_EVENTS = 10000
+TRACES_DIRPATH = "/var/lib/rackattackstats/traces"
+TRACES_FORMAT = tracing.FORMAT_CHROME
+SIGNALS_HANDLING_INTERVAL_NR_SECONDS = 1
+TASK_COMPLETION_TIMEOUT_NR_SECONDS = 60 * 5
+
+allocation_events = metrics.default_registry.counter(
+    "rackattack_stats_allocation_events_total", "Allocation events handled, by type.",
+    label_names=("event",))
+inaugurator_messages = metrics.default_registry.counter(
+    "rackattack_stats_inaugurator_messages_total", "Inaugurator messages handled, by status.",
+    label_names=("status",))
+allocation_phase_durations = metrics.default_registry.histogram(
+    "rackattack_stats_allocation_phase_duration_seconds", "Durations of the phases of allocations.",
+    buckets=metrics.LONG_DURATION_BUCKETS, label_names=("phase",))
+exceeded_deadlines = metrics.default_registry.counter(
+    "rackattack_stats_deadlines_exceeded_total",
+    "Inaugurations and allocations which exceeded their deadlines.", label_names=("kind",))
 
 
 def send_mail(msg):
@@ -63,53 +104,182 @@ class AllocationsHandler:
     INAUGURATIONS_INDEX = "inaugurations_4"
     ALLOCATIONS_INDEX = "allocations_3"
 
-    def __init__(self, subscription_mgr, db, events_monitor):
+    def __init__(self, subscription_mgr, db, events_monitor, host_indices_registry_path=None,
+                 checkpoint_dirpath=None, journal=None, clock=time.time, max_nr_pending_tasks=0,
+                 tasks_overflow_policy=taskqueue.OVERFLOW_POLICY_BLOCK, tasks_spill_dirpath=None,
+                 max_allocation_idle_time=None, timer_wheel=None, max_inauguration_time=None,
+                 max_time_until_done=None, alert_func=logging.warn, tracer=None,
+                 max_nr_allocations=MAX_NR_ALLOCATIONS):
         self._hosts_state = dict()
+        self._hosts_by_allocation = dict()
+        self._uninaugurated_hosts_by_allocation = dict()
+        self._tracer = tracer
+        if tracer is not None:
+            db = tracing.TracingDB(db, tracer)
         self._db = db
         self._subscription_mgr = subscription_mgr
-        logging.info('Subscribing to all hosts allocations.')
-        subscription_mgr.registerForAllAllocations(self._pika_all_allocations_handler)
         self._allocation_subscriptions = dict()
-        self._tasks = Queue.Queue()
+        self._allocations_activity = activitytracker.ActivityTracker()
+        self._max_allocation_idle_time = max_allocation_idle_time
+        self._max_nr_allocations = max_nr_allocations
+        self._timer_wheel = timer_wheel
+        self._max_inauguration_time = max_inauguration_time
+        self._max_time_until_done = max_time_until_done
+        self._alert_func = alert_func
+        self._inauguration_deadline_timers = dict()
+        self._done_deadline_timers = dict()
+        tasks_spool = None
+        if tasks_spill_dirpath is not None:
+            tasks_spool = spool.Spool(tasks_spill_dirpath)
+        self._tasks = taskqueue.TaskQueue(max_nr_pending_tasks, tasks_overflow_policy, tasks_spool,
+                                          self._encode_task, self._decode_task)
+        self._time_of_last_tasks_stats = time.time()
+        self._previous_tasks_stats = self._tasks.stats()
         self._latest_allocation_idx = None
-        self._host_indices = list()
-        self._last_requested_allocation = None
+        self._host_indices = dict()
+        self._host_indices_lock = threading.Lock()
+        self._host_indices_registry = None
+        if host_indices_registry_path is not None:
+            self._host_indices_registry = registry.Registry(host_indices_registry_path)
+            self._host_indices = self._host_indices_registry.read_all()
+            logging.info("Loaded the indices of {} hosts.".format(len(self._host_indices)))
+        self._pending_requests = pendingrequests.PendingRequests()
         self._events_monitor = events_monitor
+        self._journal = journal
+        self._clock = clock
+        self._checkpoint = None
+        self._dirty_checkpoint_keys = set()
+        if checkpoint_dirpath is not None:
+            self._checkpoint = checkpoint.Checkpoint(checkpoint_dirpath)
+            self._restore_from_checkpoint(self._checkpoint.load())
+        logging.info('Subscribing to all hosts allocations.')
+        subscription_mgr.registerForAllAllocations(self._pika_all_allocations_handler)
 
     def run(self):
         self._events_monitor.start()
+        self._handle_tasks_until_stopped()
+
+    def _handle_tasks_until_stopped(self):
         while True:
-            logging.info('Waiting for a new event (current number of monitored allocations: {})...'
-                         .format(len(self._allocation_subscriptions)))
-            finishedEvent, callback, message, args = self._tasks.get(block=True)
-            if callback is None:
-                logging.info('Finished handling events.')
-                finishedEvent.set()
+            if self._tasks.empty():
+                self._db.flush()
+            if time.time() - self._time_of_last_tasks_stats >= TASKS_STATS_LOGGING_INTERVAL_NR_SECONDS:
+                self._log_tasks_stats()
+            logging.info('Waiting for a new event (current number of monitored allocations: {}, events '
+                         'handled: {}, progress messages coalesced: {})...'
+                         .format(len(self._allocation_subscriptions), self._tasks.nr_processed(),
+                                 self._tasks.nr_coalesced()))
+            if not self._handle_task(self._get_task()):
                 break
+
+    def _get_task(self):
+        # Python handles signals (e.g. a request to stop, or to dump the traces) only between waits
+        while True:
             try:
-                if args is None:
-                    callback(message)
-                else:
-                    callback(message, **args)
-            finally:
-                if finishedEvent is not None:
-                    finishedEvent.set()
-                self._events_monitor.an_event_has_occurred()
+                return self._tasks.get(block=True, timeout=SIGNALS_HANDLING_INTERVAL_NR_SECONDS)
+            except Queue.Empty:
+                pass
+
+    def handle_pending_tasks(self):
+        """Handle the tasks which are already in the queue, without waiting for new ones.
+
+        Returns False if the handler was stopped."""
+        while not self._tasks.empty():
+            if not self._handle_task(self._tasks.get(block=False)):
+                return False
+        return True
+
+    def _handle_task(self, task):
+        finishedEvent, callback, message, args = task
+        if callback is None:
+            # Tasks spilled meanwhile are handled after a restart
+            self._tasks.flush_spilled()
+            self._db.flush()
+            logging.info('Finished handling events.')
+            finishedEvent.set()
+            return False
+        span = None if self._tracer is None else self._tracer.dequeued(task)
+        try:
+            self._evict_idle_allocations()
+            if args is None:
+                callback(message)
+            else:
+                callback(message, **args)
+        finally:
+            self._write_checkpoint()
+            if span is not None:
+                self._tracer.finish(span)
+            self._tasks.task_done()
+            if finishedEvent is not None:
+                finishedEvent.set()
+            self._events_monitor.an_event_has_occurred()
+        return True
+
+    def nr_pending_tasks(self):
+        return self._tasks.qsize()
+
+    def nr_open_allocations(self):
+        return len(self._allocation_subscriptions)
+
+    def _log_tasks_stats(self):
+        stats = self._tasks.stats()
+        previous = self._previous_tasks_stats
+        nr_processed = stats["nr_processed"] - previous["nr_processed"]
+        average_wait_time = 0
+        average_handling_time = 0
+        if nr_processed:
+            average_wait_time = (stats["total_wait_time"] - previous["total_wait_time"]) / nr_processed
+            average_handling_time = \
+                (stats["total_handling_time"] - previous["total_handling_time"]) / nr_processed
+        logging.info("Tasks queue: depth: {} (max: {}), spilled tasks pending: {}, handled: {}, "
+                     "coalesced: {}, shed: {}, spilled: {}, wait time: {:.3f}s on average (max: {:.3f}s), "
+                     "handling time: {:.3f}s on average (max: {:.3f}s).".format(
+                         stats["depth"], stats["max_depth"], stats["nr_spilled_pending"], nr_processed,
+                         stats["nr_coalesced"] - previous["nr_coalesced"],
+                         stats["nr_shed"] - previous["nr_shed"],
+                         stats["nr_spilled"] - previous["nr_spilled"],
+                         average_wait_time, stats["max_wait_time"],
+                         average_handling_time, stats["max_handling_time"]))
+        self._previous_tasks_stats = stats
+        self._time_of_last_tasks_stats = time.time()
+
+    def _encode_task(self, task):
+        finishedEvent, callback, message, args = task
+        if finishedEvent is not None or args is not None:
+            return None
+        return json.dumps(dict(callback=callback.__name__, message=message))
+
+    def _decode_task(self, line):
+        task = json.loads(line)
+        callbacks = dict((callback.__name__, callback) for callback in
+                         (self._inauguration_handler, self._all_allocations_handler))
+        return [None, callbacks[task["callback"]], task["message"], None]
 
     def stop(self, remove_pending_events=False):
         finishedEvent = threading.Event()
         if remove_pending_events:
             while not self._tasks.empty():
                 self._tasks.get(block=False)
-        self._tasks.put([finishedEvent, None, None, None])
+        self._tasks.put([finishedEvent, None, None, None], unbounded=True)
 
     def finish_all_commands_in_queue(self):
         finishedEvent = threading.Event()
-        self._tasks.put([finishedEvent, lambda *a: None, None, None])
-        finishedEvent.wait()
+        self._tasks.put([finishedEvent, lambda *a: None, None, None], unbounded=True)
+        wait_for_task(finishedEvent, "Pending allocation tasks")
 
     def _pika_inauguration_handler(self, message):
-        self._tasks.put([None, self._inauguration_handler, message, None])
+        span = None if self._tracer is None else self._tracer.start("inaugurator:" + message['status'])
+        if self._journal is not None:
+            self._journal.record("inaugurator", message)
+        task = [None, self._inauguration_handler, message, None]
+        # Before queueing it, since the task may be handled before put returns
+        if span is not None:
+            self._tracer.enqueued(task, span)
+        if message['status'] == 'progress' and message['progress']['state'] == 'fetching':
+            # Only the latest chain count matters; Replace a pending progress message of the host, if any
+            self._tasks.put_latest(message['id'], task)
+        else:
+            self._tasks.put(task, key=message['id'])
 
     def _inauguration_handler(self, msg):
         host_id = msg['id']
@@ -118,25 +288,33 @@ class AllocationsHandler:
                           ' a known allocation: {}. Ignoring.'.format(host_id))
             return
         host_state = self._hosts_state[host_id]
+        inaugurator_messages.labels(msg['status']).inc()
+        self._dirty_checkpoint_keys.add(("host", host_id))
+        self._allocations_activity.touch(host_state.allocation_idx, self._clock())
 
         if msg['status'] == 'done':
-            host_state['end_timestamp'] = time.time()
+            host_state.end_timestamp = self._clock()
             logging.info('Host "{}" has finished inauguration. Unsubscribing.'.format(host_id))
-            self._hosts_state[host_id]["inauguration_done"] = True
+            host_state.inauguration_done = True
+            self._cancel_deadline(self._inauguration_deadline_timers, host_id)
+            self._uninaugurated_hosts_by_allocation[host_state.allocation_idx].discard(host_id)
             self._add_inauguration_record_to_db(host_id)
             self._subscription_mgr.unregisterForInaugurator(host_id)
         elif msg['status'] == 'progress' and msg['progress']['state'] == 'fetching':
             logging.info('Progress message for {}'.format(host_id))
             chain_count = msg['progress']['chainGetCount']
-            self._hosts_state[host_id]['latest_chain_count'] = chain_count
+            host_state.latest_chain_count = chain_count
 
     def _unsubscribe_allocation(self, allocation_idx):
         """Precondition: allocation is subscribed to."""
         del self._allocation_subscriptions[allocation_idx]
-        allocated_hosts = [host_id for host_id, host in self._hosts_state.iteritems() if
-                           host['allocation_idx'] == allocation_idx]
-        uninaugurated_hosts = [host_id for host_id in allocated_hosts if
-                               not self._hosts_state[host_id]["inauguration_done"]]
+        self._allocations_activity.remove(allocation_idx)
+        self._dirty_checkpoint_keys.add(("allocation", allocation_idx))
+        self._cancel_deadline(self._done_deadline_timers, allocation_idx)
+        allocated_hosts = self._hosts_by_allocation.pop(allocation_idx, set())
+        for host_id in allocated_hosts:
+            self._cancel_deadline(self._inauguration_deadline_timers, host_id)
+        uninaugurated_hosts = list(self._uninaugurated_hosts_by_allocation.pop(allocation_idx, set()))
         if uninaugurated_hosts:
             logging.info("Inauguration stage for allocation {} ended without finishing inauguration "
                          "of the following hosts: {}.".format(allocation_idx,
@@ -148,138 +326,94 @@ class AllocationsHandler:
                 self._subscription_mgr.unregisterForInaugurator(host_id)
         for host in allocated_hosts:
             del self._hosts_state[host]
+            self._dirty_checkpoint_keys.add(("host", host))
 
     def _pika_all_allocations_handler(self, message):
-        self._tasks.put([None, self._all_allocations_handler, message, None], block=True)
+        span = None if self._tracer is None else self._tracer.start("allocations:" + message['event'])
+        if self._journal is not None:
+            self._journal.record("allocations", message)
+        task = [None, self._all_allocations_handler, message, None]
+        if span is not None:
+            self._tracer.enqueued(task, span)
+        self._tasks.put(task, block=True)
 
     def _store_allocation_request(self, message):
-        nr_nodes = len(message["requirements"])
-        record = dict(allocationInfo=message['allocationInfo'],
-                      nodes=self.get_nodes_list_from_requirements(message['requirements']),
-                      nr_nodes=nr_nodes,
-                      highest_phase_reached="requested",
-                      done=False,
-                      reason="Unknown",
-                      allocation_duration=0)
-        record["date"] = datetime_from_timestamp(time.time())
+        allocation = allocationstate.AllocationState(message['allocationInfo'],
+                                                     message['requirements'],
+                                                     self._clock())
         record_metadata = self._db.create(index=self.ALLOCATIONS_INDEX,
                                           doc_type='allocation',
-                                          body=record)
-        return record_metadata["_id"], record
-
-    def _store_allocation_rejection(self, reason):
-        assert self._last_requested_allocation is not None
-        record_id, record = self._last_requested_allocation
-        record["highest_phase_reached"] = "rejected"
-        record["reason"] = reason
-        self._db.update(index=self.ALLOCATIONS_INDEX,
-                        doc_type='allocation',
-                        id=record_id,
-                        body=dict(doc=record))
-
-    def _store_allocation_creation(self, message):
-        assert self._last_requested_allocation is not None
-        record_id, record = self._last_requested_allocation
-        record["highest_phase_reached"] = "created"
-        self.update_nodes_list_with_allocated(record, message["allocated"])
-        record.update(dict(nr_nodes=len(record["nodes"]),
-                           highest_phase_reached="created",
-                           allocation_id=message["allocationID"],
-                           creation_time=datetime_from_timestamp(time.time())))
-        self._db.update(index=self.ALLOCATIONS_INDEX,
-                        doc_type='allocation',
-                        id=record_id,
-                        body=dict(doc=record))
-        self._allocation_subscriptions[message["allocationID"]] = record_id, record
+                                          body=allocation.to_record())
+        allocation.record_id = record_metadata["_id"]
+        return allocation
+
+    def _store_allocation_rejection(self, allocation, reason):
+        allocation.highest_phase_reached = "rejected"
+        allocation.reason = reason
+        self._update_allocation_record(allocation)
+
+    def _store_allocation_creation(self, allocation, message):
+        self.update_nodes_list_with_allocated(allocation.nodes_by_name, message["allocated"])
+        allocation.highest_phase_reached = "created"
+        allocation.allocation_id = message["allocationID"]
+        allocation.creation_timestamp = self._clock()
+        allocation_phase_durations.labels("requested_to_created").observe(
+            allocation.creation_timestamp - allocation.request_timestamp)
+        self._allocation_subscriptions[message["allocationID"]] = allocation
+        self._allocations_activity.touch(message["allocationID"], allocation.creation_timestamp)
+        self._update_allocation_record(allocation)
 
     def _store_allocation_death(self, allocation_id, reason):
-        record_id, record = self._allocation_subscriptions[allocation_id]
-        record["highest_phase_reached"] = "dead"
-        record["reason"] = reason
-        record["allocation_duration"] = \
-            (datetime_from_timestamp(time.time()) - record["creation_time"]).total_seconds()
-        if record["done"]:
-            record["test_duration"] = \
-                (datetime_from_timestamp(time.time()) - record["creation_time"]).total_seconds()
-        self._db.update(index=self.ALLOCATIONS_INDEX,
-                        doc_type='allocation',
-                        id=record_id,
-                        body=dict(doc=record))
+        allocation = self._allocation_subscriptions[allocation_id]
+        allocation.highest_phase_reached = "dead"
+        allocation.reason = reason
+        allocation.allocation_duration = self._clock() - allocation.creation_timestamp
+        if allocation.done:
+            allocation.test_duration = self._clock() - allocation.creation_timestamp
+        allocation_phase_durations.labels("created_to_dead").observe(allocation.allocation_duration)
+        self._update_allocation_record(allocation)
 
     def _store_allocation_done(self, allocation_id):
-        record_id, record = self._allocation_subscriptions[allocation_id]
-        record["highest_phase_reached"] = "done"
-        record["done"] = True
-        record["inauguration_duration"] = \
-            (datetime_from_timestamp(time.time()) - record["creation_time"]).total_seconds()
+        allocation = self._allocation_subscriptions[allocation_id]
+        allocation.highest_phase_reached = "done"
+        allocation.done = True
+        allocation.inauguration_duration = self._clock() - allocation.creation_timestamp
+        allocation_phase_durations.labels("created_to_done").observe(allocation.inauguration_duration)
+        self._allocations_activity.touch(allocation_id, self._clock())
+        self._cancel_deadline(self._done_deadline_timers, allocation_id)
+        self._update_allocation_record(allocation)
+
+    def _update_allocation_record(self, allocation):
+        if allocation.allocation_id in self._allocation_subscriptions:
+            self._dirty_checkpoint_keys.add(("allocation", allocation.allocation_id))
         self._db.update(index=self.ALLOCATIONS_INDEX,
                         doc_type='allocation',
-                        id=record_id,
-                        body=dict(doc=record))
+                        id=allocation.record_id,
+                        body=dict(doc=allocation.to_record()))
 
     def _all_allocations_handler(self, message):
         event = message["event"]
         assert event in ("requested", "rejected", "created", "done", "dead"), event
-        if len(self._allocation_subscriptions) == MAX_NR_ALLOCATIONS:
-            logging.error("Something has gone wrong; Too many open allocations. Quitting")
-            self.stop(remove_pending_events=True)
-            return
+        allocation_events.labels(event).inc()
         if event == "requested":
-            allocation_data = self._store_allocation_request(message)
-            self._last_requested_allocation = allocation_data
+            self._expire_pending_requests()
+            allocation = self._store_allocation_request(message)
+            self._pending_requests.add(allocation)
+            self._dirty_checkpoint_keys.add(("pending_request", allocation.record_id))
         elif event == "rejected":
-            if self._last_requested_allocation is None:
-                logging.info("Got an allocation rejection message without a requeest message before. "
+            allocation = self._pop_pending_request(self._pending_requests.pop_rejected, message)
+            if allocation is None:
+                logging.info("Got an allocation rejection message without a request message before. "
                              "Skipping.")
                 return
-            if self._last_requested_allocation[1]["highest_phase_reached"] != "requested":
-                logging.error("Got an allocation rejection message in an invalid context (last event was:"
-                              " {}".format(self._last_requested_allocation[1]["highest_phase_reached"]))
-                return
-            self._store_allocation_rejection(reason=message["reason"])
+            self._store_allocation_rejection(allocation, reason=message["reason"])
         elif event == "created":
             logging.info('New allocation: {}'.format(message))
-            if self._last_requested_allocation is None:
+            allocation = self._pop_pending_request(self._pending_requests.pop_created, message)
+            if allocation is None:
                 logging.info("Ignoring allocation creation message since its request message was skipped")
                 return
-            last_requested_allocation = self._last_requested_allocation[1]
-            self._store_allocation_creation(message)
-            idx = message['allocationID']
-            if self._latest_allocation_idx is None:
-                self._latest_allocation_idx = idx
-            elif idx < self._latest_allocation_idx:
-                logging.error("Got an allocation index {} which is smaller than the previous one ({}) "
-                              "(could RackAttack have been restarted?). Quitting."
-                              .format(idx, self._latest_allocation_idx))
-                self.stop(remove_pending_events=True)
-                return
-            hosts = message['allocated']
-            logging.debug('New allocation: {}.'.format(hosts))
-            allocation_unsubscribed_from_due_to_new_allocation = set()
-            for name, host_id in hosts.iteritems():
-                if host_id in self._hosts_state:
-                    existing_allocation = self._hosts_state[host_id]["allocation_idx"]
-                    assert existing_allocation not in allocation_unsubscribed_from_due_to_new_allocation
-                    logging.warn("Allocation {} was allocated with a host which is already used by "
-                                 "another allocation ({}). Unsubscribing from the latter first..."
-                                 .format(idx, existing_allocation))
-                    self._unsubscribe_allocation(existing_allocation)
-                    allocation_unsubscribed_from_due_to_new_allocation.add(existing_allocation)
-                    assert host_id not in self._hosts_state
-                # Update hosts state
-                self._hosts_state[host_id] = dict(start_timestamp=time.time(),
-                                                  name=name,
-                                                  allocation_idx=idx,
-                                                  inauguration_done=False)
-                logging.info("Subscribing to inaugurator events of: {}.".format(host_id))
-                self._subscription_mgr.registerForInagurator(host_id, self._pika_inauguration_handler)
-                nodes = [node for node in last_requested_allocation["nodes"] if node["node_name"] == name]
-                if nodes:
-                    requirements = nodes[0]["requirements"]
-                    self._hosts_state[host_id].update(requirements)
-                else:
-                    logging.error("Failed to resolve requirmenents for inaugurated host {}".format(name))
-                logging.info("Subscribed.")
+            self._handle_allocation_creation(message, allocation)
         elif event == "done":
             allocation_id = message['allocationID']
             if allocation_id not in self._allocation_subscriptions:
@@ -301,19 +435,16 @@ class AllocationsHandler:
 
     def _add_inauguration_record_to_db(self, host_id):
         state = self._hosts_state[host_id]
-        record_datetime = datetime_from_timestamp(state['start_timestamp'])
+        record_datetime = allocationstate.datetime_from_timestamp(state.start_timestamp)
 
         local_store_count = None
         remote_store_count = None
-        try:
-            chain_count = state['latest_chain_count']
-            local_store_count = chain_count.pop(0)
-            remote_store_count = chain_count.pop(0)
-        except KeyError:
-            # NO info about Osmosis chain
-            pass
-        except IndexError:
-            pass
+        # No chain count means there's no info about Osmosis chain
+        chain_count = state.latest_chain_count
+        if chain_count:
+            local_store_count = chain_count[0]
+            if len(chain_count) > 1:
+                remote_store_count = chain_count[1]
 
         majority_chain_type = 'unknown'
         if local_store_count is not None:
@@ -321,16 +452,16 @@ class AllocationsHandler:
             if remote_store_count is not None and \
                     local_store_count < remote_store_count:
                 majority_chain_type = 'remote'
-        id = "%d%03d%05d" % (state['start_timestamp'], state['allocation_idx'], self._hostIndex(host_id))
+        id = "%d-%d-%d" % (state.start_timestamp, state.allocation_idx, self._hostIndex(host_id))
 
         record = dict(date=record_datetime,
                       host_id=host_id,
                       local_store_count=local_store_count,
                       remote_store_count=remote_store_count,
                       majority_chain_type=majority_chain_type)
-        if state["inauguration_done"]:
-            record["inauguration_period_length"] = state['end_timestamp'] - state['start_timestamp']
-        record.update(state)
+        if state.inauguration_done:
+            record["inauguration_period_length"] = state.end_timestamp - state.start_timestamp
+        record.update(state.to_record())
 
         try:
             logging.info("Inserting inauguration to DB (id: {}):\n{}".format(id, pprint.pformat(record)))
@@ -340,23 +471,396 @@ class AllocationsHandler:
             self.stop()
             return
 
+    def _evict_idle_allocations(self):
+        if self._max_allocation_idle_time is None:
+            return
+        for allocation_id in self._allocations_activity.idle_keys(self._clock(),
+                                                                  self._max_allocation_idle_time):
+            logging.warn("Allocation {} had no activity in the last {} seconds.".format(
+                allocation_id, self._max_allocation_idle_time))
+            self._evict_allocation(allocation_id, ALLOCATION_IDLE_TIMEOUT_REASON)
+
+    def _make_room_for_allocation(self):
+        # The maximum number of allocations bounds the memory used for open allocations
+        while len(self._allocation_subscriptions) >= self._max_nr_allocations:
+            allocation_id = self._allocations_activity.least_recently_active()
+            logging.warn("Too many open allocations ({}); Evicting the least recently active one ({})."
+                         .format(len(self._allocation_subscriptions), allocation_id))
+            self._evict_allocation(allocation_id, ALLOCATION_EVICTION_REASON)
+
+    def _evict_allocation(self, allocation_id, reason):
+        self._store_allocation_death(allocation_id, reason=reason)
+        self._unsubscribe_allocation(allocation_id)
+
+    def _pop_pending_request(self, pop_func, message):
+        allocation = pop_func(message)
+        if allocation is not None:
+            self._dirty_checkpoint_keys.add(("pending_request", allocation.record_id))
+        return allocation
+
+    def _expire_pending_requests(self):
+        for allocation in self._pending_requests.expire(self._clock()):
+            logging.warn("Dropping allocation request {} which was neither created nor rejected after {} "
+                         "seconds.".format(allocation.record_id, self._pending_requests.ttl))
+            self._dirty_checkpoint_keys.add(("pending_request", allocation.record_id))
+
+    def _handle_allocation_creation(self, message, allocation):
+        self._make_room_for_allocation()
+        nodes_by_name = allocation.nodes_by_name
+        self._store_allocation_creation(allocation, message)
+        idx = message['allocationID']
+        if self._latest_allocation_idx is None:
+            self._latest_allocation_idx = idx
+            self._dirty_checkpoint_keys.add(("latest_allocation_idx",))
+        elif idx < self._latest_allocation_idx:
+            logging.error("Got an allocation index {} which is smaller than the previous one ({}) "
+                          "(could RackAttack have been restarted?). Quitting."
+                          .format(idx, self._latest_allocation_idx))
+            self.stop(remove_pending_events=True)
+            return
+        hosts = message['allocated']
+        logging.debug('New allocation: {}.'.format(hosts))
+        allocation_unsubscribed_from_due_to_new_allocation = set()
+        for name, host_id in hosts.iteritems():
+            if host_id in self._hosts_state:
+                existing_allocation = self._hosts_state[host_id].allocation_idx
+                assert existing_allocation not in allocation_unsubscribed_from_due_to_new_allocation
+                logging.warn("Allocation {} was allocated with a host which is already used by "
+                             "another allocation ({}). Unsubscribing from the latter first..."
+                             .format(idx, existing_allocation))
+                self._unsubscribe_allocation(existing_allocation)
+                allocation_unsubscribed_from_due_to_new_allocation.add(existing_allocation)
+                assert host_id not in self._hosts_state
+            # Update hosts state
+            host_state = allocationstate.HostState(host_id, name, idx, self._clock())
+            self._hosts_state[host_id] = host_state
+            self._dirty_checkpoint_keys.add(("host", host_id))
+            self._hosts_by_allocation.setdefault(idx, set()).add(host_id)
+            self._uninaugurated_hosts_by_allocation.setdefault(idx, set()).add(host_id)
+            logging.info("Subscribing to inaugurator events of: {}.".format(host_id))
+            self._subscription_mgr.registerForInagurator(host_id, self._pika_inauguration_handler)
+            node = nodes_by_name.get(name)
+            if node is not None:
+                host_state.requirements = node.requirements
+            else:
+                logging.error("Failed to resolve requirmenents for inaugurated host {}".format(name))
+            self._schedule_inauguration_deadline(host_state)
+            logging.info("Subscribed.")
+        self._schedule_done_deadline(idx, allocation)
+
+    def _schedule_inauguration_deadline(self, host_state):
+        if self._timer_wheel is None or self._max_inauguration_time is None:
+            return
+        delay = max(host_state.start_timestamp + self._max_inauguration_time - self._clock(), 0)
+        message = dict(id=host_state.host_id, allocation_idx=host_state.allocation_idx)
+        self._inauguration_deadline_timers[host_state.host_id] = self._timer_wheel.schedule(
+            delay, self._put_deadline_task, self._inauguration_deadline_handler, message)
+
+    def _schedule_done_deadline(self, allocation_id, allocation):
+        if self._timer_wheel is None or self._max_time_until_done is None:
+            return
+        delay = max(allocation.creation_timestamp + self._max_time_until_done - self._clock(), 0)
+        self._done_deadline_timers[allocation_id] = self._timer_wheel.schedule(
+            delay, self._put_deadline_task, self._done_deadline_handler, dict(allocationID=allocation_id))
+
+    def _cancel_deadline(self, timers, key):
+        timer = timers.pop(key, None)
+        if timer is not None:
+            self._timer_wheel.cancel(timer)
+
+    def _put_deadline_task(self, callback, message):
+        # Called from the thread of the timer wheel, which must not wait for room in the queue
+        self._tasks.put([None, callback, message, None], unbounded=True)
+
+    def _inauguration_deadline_handler(self, message):
+        host_id = message["id"]
+        host_state = self._hosts_state.get(host_id)
+        if host_state is None or host_state.allocation_idx != message["allocation_idx"] or \
+                host_state.inauguration_done:
+            return
+        host_state.inauguration_deadline_exceeded = True
+        exceeded_deadlines.labels("inauguration").inc()
+        self._dirty_checkpoint_keys.add(("host", host_id))
+        self._alert_func("Inauguration of host {} (allocation {}) has not finished within {} seconds "
+                         "(latest chain count: {}).".format(host_id, host_state.allocation_idx,
+                                                            self._max_inauguration_time,
+                                                            host_state.latest_chain_count))
+
+    def _done_deadline_handler(self, message):
+        allocation_id = message["allocationID"]
+        allocation = self._allocation_subscriptions.get(allocation_id)
+        if allocation is None or allocation.done:
+            return
+        allocation.done_deadline_exceeded = True
+        exceeded_deadlines.labels("allocation_done").inc()
+        self._update_allocation_record(allocation)
+        uninaugurated_hosts = sorted(self._uninaugurated_hosts_by_allocation.get(allocation_id, set()))
+        self._alert_func("Allocation {} is not done {} seconds after it was created (hosts which were not "
+                         "inaugurated: {}).".format(allocation_id, self._max_time_until_done,
+                                                    ", ".join(uninaugurated_hosts)))
+
+    def _checkpoint_value(self, key):
+        kind = key[0]
+        if kind == "host":
+            return self._hosts_state.get(key[1])
+        elif kind == "allocation":
+            return self._allocation_subscriptions.get(key[1])
+        elif kind == "pending_request":
+            return self._pending_requests.get(key[1])
+        elif kind == "latest_allocation_idx":
+            return self._latest_allocation_idx
+        assert False, key
+
+    def _write_checkpoint(self):
+        if self._checkpoint is None or not self._dirty_checkpoint_keys:
+            return
+        changes = [(key, self._checkpoint_value(key)) for key in self._dirty_checkpoint_keys]
+        self._dirty_checkpoint_keys.clear()
+        try:
+            self._checkpoint.write(changes)
+            if self._checkpoint.should_compact():
+                state = dict((("host", host_id), host_state) for host_id, host_state in
+                             self._hosts_state.iteritems())
+                state.update((("allocation", allocation_id), allocation) for allocation_id, allocation in
+                             self._allocation_subscriptions.iteritems())
+                state.update((("pending_request", allocation.record_id), allocation) for allocation in
+                             self._pending_requests.allocations())
+                if self._latest_allocation_idx is not None:
+                    state[("latest_allocation_idx",)] = self._latest_allocation_idx
+                self._checkpoint.compact(state)
+        except Exception:
+            logging.exception("Failed writing the checkpoint of the allocations state.")
+
+    def _restore_from_checkpoint(self, state):
+        hosts_state = dict()
+        pending_requests = list()
+        for key, value in state.iteritems():
+            kind = key[0]
+            if kind == "host":
+                hosts_state[key[1]] = value
+            elif kind == "allocation":
+                self._allocation_subscriptions[key[1]] = value
+            elif kind == "pending_request":
+                pending_requests.append(value)
+            elif kind == "last_requested_allocation":
+                # Written by versions which tracked only the latest request
+                if value is not None and value.highest_phase_reached == "requested":
+                    pending_requests.append(value)
+            elif kind == "latest_allocation_idx":
+                self._latest_allocation_idx = value
+        pending_requests.sort(key=lambda allocation: allocation.request_timestamp)
+        for allocation in pending_requests:
+            self._pending_requests.add(allocation)
+        # The time of the latest activity is not kept; Restored allocations are considered active now
+        for allocation_id, allocation in sorted(self._allocation_subscriptions.iteritems(),
+                                                key=lambda item: item[1].creation_timestamp):
+            self._allocations_activity.touch(allocation_id, self._clock())
+            if not allocation.done:
+                self._schedule_done_deadline(allocation_id, allocation)
+        for allocation in self._allocation_subscriptions.values() + pending_requests:
+            allocation.allocation_info = allocationstate.interned.intern(allocation.allocation_info)
+            for node in allocation.nodes:
+                node.requirements = allocationstate.interned.intern(node.requirements)
+        for host_id, host_state in sorted(hosts_state.iteritems()):
+            if host_state.allocation_idx not in self._allocation_subscriptions:
+                logging.warn("Dropping the checkpointed state of host {}, which belongs to an allocation "
+                             "that is not tracked ({}).".format(host_id, host_state.allocation_idx))
+                continue
+            host_state.requirements = allocationstate.interned.intern(host_state.requirements)
+            self._hosts_state[host_id] = host_state
+            self._hosts_by_allocation.setdefault(host_state.allocation_idx, set()).add(host_id)
+            if not host_state.inauguration_done:
+                self._uninaugurated_hosts_by_allocation.setdefault(host_state.allocation_idx,
+                                                                   set()).add(host_id)
+                logging.info("Resubscribing to inaugurator events of: {}.".format(host_id))
+                self._subscription_mgr.registerForInagurator(host_id, self._pika_inauguration_handler)
+                self._schedule_inauguration_deadline(host_state)
+        logging.info("Restored {} allocations, {} pending requests and {} hosts from the checkpoint.".format(
+            len(self._allocation_subscriptions), len(self._pending_requests), len(self._hosts_state)))
+
     def _hostIndex(self, hostID):
-        if hostID not in self._host_indices:
-            self._host_indices.append(hostID)
-        return self._host_indices.index(hostID)
+        with self._host_indices_lock:
+            index = self._host_indices.get(hostID)
+            if index is None:
+                # Not the number of hosts, in case the registry has lost some of them
+                index = max(self._host_indices.itervalues()) + 1 if self._host_indices else 0
+                self._host_indices[hostID] = index
+                if self._host_indices_registry is not None:
+                    self._host_indices_registry.write(hostID, index)
+                    self._host_indices_registry.flush()
+        return index
+
+    def _handle_routed_creation(self, message, allocation):
+        self._handle_allocation_creation(message, allocation)
+
+    def _release_host(self, host_id):
+        host_state = self._hosts_state.get(host_id)
+        if host_state is None:
+            return
+        logging.warn("Host {} was allocated by an allocation of another shard. Unsubscribing from the "
+                     "allocation which holds it ({}) first...".format(host_id, host_state.allocation_idx))
+        self._unsubscribe_allocation(host_state.allocation_idx)
 
-    @classmethod
-    def get_nodes_list_from_requirements(cls, requirements):
-        result = list()
-        for node_name, node_requirements in requirements.iteritems():
-            node = dict(node_name=node_name, requirements=node_requirements)
-            result.append(node)
-        return result
+    def update_nodes_list_with_allocated(self, nodes_by_name, allocated):
+        for node_name, server_name in allocated.iteritems():
+            node = nodes_by_name.get(node_name)
+            if node is not None:
+                node.server_name = server_name
 
-    def update_nodes_list_with_allocated(self, allocation_record, allocated):
-        for node in allocation_record["nodes"]:
-            node_name = node["node_name"]
-            node["server_name"] = allocated[node_name]
+
+class ShardSubscriptionManager:
+    """Lets a shard subscribe to inaugurator events of its hosts; Allocation events are routed to it."""
+    def __init__(self, subscription_mgr):
+        self._subscription_mgr = subscription_mgr
+
+    def registerForAllAllocations(self, callback):
+        pass
+
+    def registerForInagurator(self, host_id, callback):
+        self._subscription_mgr.registerForInagurator(host_id, callback)
+
+    def unregisterForInaugurator(self, host_id):
+        self._subscription_mgr.unregisterForInaugurator(host_id)
+
+
+class ShardedAllocationsHandler(AllocationsHandler):
+    """Handles the events of different allocations concurrently, in shards partitioned by allocation ID.
+
+    This thread acts as a router: it correlates allocation requests with their creation (as
+    AllocationsHandler does) and forwards the creation, done and death events of each allocation to its
+    shard. Each shard is an AllocationsHandler with its own thread, task queue and state, and registers for
+    the inaugurator events of its hosts by itself, so events of an allocation are handled in order.
+
+    A host which is allocated by an allocation of another shard than the one which holds it, is first
+    released by that shard (which unsubscribes from the allocation holding it), and only then is the
+    new allocation forwarded.
+    """
+    def __init__(self, subscription_mgr, db, events_monitor, nr_shards, host_indices_registry_path=None,
+                 checkpoint_dirpath=None, journal=None, clock=time.time, max_nr_pending_tasks=0,
+                 tasks_overflow_policy=taskqueue.OVERFLOW_POLICY_BLOCK, tasks_spill_dirpath=None,
+                 max_allocation_idle_time=None, timer_wheel=None, max_inauguration_time=None,
+                 max_time_until_done=None, alert_func=logging.warn, tracer=None,
+                 max_nr_allocations=MAX_NR_ALLOCATIONS):
+        def shard_path(path, name):
+            return None if path is None else os.path.join(path, name)
+        AllocationsHandler.__init__(self, subscription_mgr, db, events_monitor, host_indices_registry_path,
+                                    shard_path(checkpoint_dirpath, "router"), journal, clock,
+                                    max_nr_pending_tasks, tasks_overflow_policy,
+                                    shard_path(tasks_spill_dirpath, "router"), max_allocation_idle_time,
+                                    timer_wheel, max_inauguration_time, max_time_until_done, alert_func,
+                                    tracer, max_nr_allocations)
+        self._shards = list()
+        self._host_shards = dict()
+        max_nr_allocations_per_shard = max(max_nr_allocations // nr_shards, 1)
+        for shard_idx in xrange(nr_shards):
+            # The number of shards must be kept across restarts, for the checkpoints to be of use
+            name = "shard-{}".format(shard_idx)
+            shard = AllocationsHandler(ShardSubscriptionManager(subscription_mgr), db, events_monitor,
+                                       checkpoint_dirpath=shard_path(checkpoint_dirpath, name),
+                                       journal=journal, clock=clock,
+                                       max_nr_pending_tasks=max_nr_pending_tasks,
+                                       tasks_overflow_policy=tasks_overflow_policy,
+                                       tasks_spill_dirpath=shard_path(tasks_spill_dirpath, name),
+                                       max_allocation_idle_time=max_allocation_idle_time,
+                                       timer_wheel=timer_wheel,
+                                       max_inauguration_time=max_inauguration_time,
+                                       max_time_until_done=max_time_until_done,
+                                       alert_func=alert_func,
+                                       tracer=tracer,
+                                       max_nr_allocations=max_nr_allocations_per_shard)
+            shard._host_indices = self._host_indices
+            shard._host_indices_lock = self._host_indices_lock
+            shard._host_indices_registry = self._host_indices_registry
+            for host_id in shard._hosts_state:
+                self._host_shards[host_id] = shard
+            self._shards.append(shard)
+        self._shard_threads = list()
+        self._shard_error = None
+        self._is_stopping_shards = False
+
+    def run(self):
+        self._is_stopping_shards = False
+        for shard_idx, shard in enumerate(self._shards):
+            thread = threading.Thread(target=self._run_shard, args=(shard,),
+                                      name="allocations-shard-{}".format(shard_idx))
+            thread.daemon = True
+            thread.start()
+            self._shard_threads.append(thread)
+        try:
+            AllocationsHandler.run(self)
+        finally:
+            self._is_stopping_shards = True
+            for shard in self._shards:
+                shard.stop()
+            for thread in self._shard_threads:
+                thread.join()
+            self._shard_threads = list()
+        if self._shard_error is not None:
+            raise self._shard_error
+
+    def finish_all_commands_in_queue(self):
+        AllocationsHandler.finish_all_commands_in_queue(self)
+        for shard in self._shards:
+            shard.finish_all_commands_in_queue()
+
+    def nr_pending_tasks(self):
+        nr_pending_tasks_in_shards = sum(shard.nr_pending_tasks() for shard in self._shards)
+        return AllocationsHandler.nr_pending_tasks(self) + nr_pending_tasks_in_shards
+
+    def nr_open_allocations(self):
+        return sum(shard.nr_open_allocations() for shard in self._shards)
+
+    def _run_shard(self, shard):
+        while True:
+            try:
+                shard._handle_tasks_until_stopped()
+                break
+            except elasticsearch.exceptions.TransportError:
+                self._db.handle_disconnection()
+            except Exception as ex:
+                logging.exception("An allocations shard has failed.")
+                self._shard_error = ex
+                break
+        if not self._is_stopping_shards:
+            self.stop()
+
+    def _shard_of(self, allocation_id):
+        return self._shards[hash(allocation_id) % len(self._shards)]
+
+    def _all_allocations_handler(self, message):
+        event = message["event"]
+        if event in ("requested", "rejected"):
+            AllocationsHandler._all_allocations_handler(self, message)
+            return
+        shard = self._shard_of(message["allocationID"])
+        if event == "created":
+            # The shard updates the allocation from now on
+            allocation = self._pop_pending_request(self._pending_requests.pop_created, message)
+            if allocation is None:
+                logging.info("Ignoring allocation creation message since its request message was skipped")
+                return
+            for host_id in message["allocated"].itervalues():
+                self._release_host_from_other_shards(host_id, shard)
+            shard._tasks.put([None, shard._handle_routed_creation, message, dict(allocation=allocation)])
+        else:
+            shard._tasks.put([None, shard._all_allocations_handler, message, None])
+
+    def _release_host_from_other_shards(self, host_id, shard):
+        owner = self._host_shards.get(host_id)
+        self._host_shards[host_id] = shard
+        if owner is None or owner is shard:
+            return
+        finishedEvent = threading.Event()
+        owner._tasks.put([finishedEvent, owner._release_host, host_id, None], unbounded=True)
+        wait_for_task(finishedEvent, "Release of host {} by its previous allocations shard".format(host_id))
+
+
+def wait_for_task(finishedEvent, description):
+    if not finishedEvent.wait(TASK_COMPLETION_TIMEOUT_NR_SECONDS):
+        msg = "{} did not finish within {} seconds; Is the handler thread stuck?".format(
+            description, TASK_COMPLETION_TIMEOUT_NR_SECONDS)
+        logging.error(msg)
+        raise Exception(msg)
 
 
 def create_subscription():
@@ -375,33 +879,91 @@ def alert_info_func(msg):
     send_mail(msg)
 
 
+def install_termination_handler(allocation_handler, signum=signal.SIGTERM):
+    """Stop the handler when the signal is received, so that the pending DB writes are done on exit.
+
+    Stopping takes the tasks queue lock, which the interrupted thread may hold; Hence the separate thread."""
+    def handler(*args):
+        logging.info("Received signal {}; Stopping...".format(signum))
+        stopper = threading.Thread(target=allocation_handler.stop, name="stopper")
+        stopper.daemon = True
+        stopper.start()
+    signal.signal(signum, handler)
+
+
 def main():
     logconfig.configure_logger()
-    db = elasticsearchdbwrapper.ElasticsearchDBWrapper(alert_func=send_mail)
+    db = elasticsearchdbwrapper.create_spooled_bulk_writer("allocations", alert_func=send_mail)
+    writer = dbwriter.AsyncDBWriter(db, error_func=send_mail)
+    db = coalescingwriter.CoalescingWriter(writer, window=DB_WRITES_COALESCING_WINDOW_NR_SECONDS)
     subscription_mgr = create_subscription()
+    timer_wheel = timerwheel.TimerWheel()
+    timer_wheel.start()
     monitor = events_monitor.EventsMonitor(MAX_NR_SECONDS_WITHOUT_EVENTS_BEFORE_ALERTING,
                                            alert_info_func,
-                                           alert_warn_func)
-    allocation_handler = AllocationsHandler(subscription_mgr, db, monitor)
-    while True:
-        try:
-            allocation_handler.run()
-            break
-        except elasticsearch.ConnectionTimeout:
-            db.handle_disconnection()
-        except elasticsearch.ConnectionError:
-            db.handle_disconnection()
-        except elasticsearch.exceptions.TransportError:
-            db.handle_disconnection()
-        except KeyboardInterrupt:
-            break
-        except Exception:
-            msg = "Critical error, exiting.\n\n"
-            logging.exception(msg)
-            msg += traceback.format_exc()
-            send_mail(msg)
-            sys.exit(1)
-    logging.info("Done.")
+                                           alert_warn_func,
+                                           timer_wheel)
+    allocations_journal = journal.Journal(JOURNAL_DIRPATH)
+    tracer = None
+    if TRACING_ENABLED:
+        tracer = tracing.Tracer(NR_TRACED_EVENTS)
+        tracing.install_signal_handler(tracer, TRACES_DIRPATH, TRACES_FORMAT)
+    tasks_spill_dirpath = os.path.join(config.SPOOL_DIRPATH, TASKS_SPOOL_NAME)
+    handler_kwargs = dict(host_indices_registry_path=HOST_INDICES_REGISTRY_PATH,
+                          checkpoint_dirpath=CHECKPOINT_DIRPATH,
+                          journal=allocations_journal,
+                          max_nr_pending_tasks=MAX_NR_PENDING_TASKS,
+                          tasks_overflow_policy=TASKS_OVERFLOW_POLICY,
+                          tasks_spill_dirpath=tasks_spill_dirpath,
+                          max_allocation_idle_time=MAX_ALLOCATION_IDLE_NR_SECONDS,
+                          timer_wheel=timer_wheel,
+                          max_inauguration_time=MAX_INAUGURATION_NR_SECONDS,
+                          max_time_until_done=MAX_NR_SECONDS_UNTIL_ALLOCATION_DONE,
+                          alert_func=alert_warn_func,
+                          tracer=tracer,
+                          max_nr_allocations=MAX_NR_ALLOCATIONS)
+    if NR_ALLOCATION_SHARDS > 1:
+        allocation_handler = ShardedAllocationsHandler(subscription_mgr, db, monitor, NR_ALLOCATION_SHARDS,
+                                                       **handler_kwargs)
+    else:
+        allocation_handler = AllocationsHandler(subscription_mgr, db, monitor, **handler_kwargs)
+    install_termination_handler(allocation_handler)
+    pending_tasks = metrics.default_registry.gauge(
+        "rackattack_stats_allocation_tasks_pending", "Tasks waiting to be handled (including spilled ones).")
+    pending_tasks.set_function(allocation_handler.nr_pending_tasks)
+    open_allocations = metrics.default_registry.gauge(
+        "rackattack_stats_open_allocations", "Allocations which are currently tracked.")
+    open_allocations.set_function(allocation_handler.nr_open_allocations)
+    metrics_server = metrics.start_server(METRICS_PORT)
+    try:
+        while True:
+            try:
+                allocation_handler.run()
+                break
+            except elasticsearch.ConnectionTimeout:
+                db.handle_disconnection()
+            except elasticsearch.ConnectionError:
+                db.handle_disconnection()
+            except elasticsearch.exceptions.TransportError:
+                db.handle_disconnection()
+            except KeyboardInterrupt:
+                break
+            except Exception:
+                msg = "Critical error, exiting.\n\n"
+                logging.exception(msg)
+                msg += traceback.format_exc()
+                send_mail(msg)
+                sys.exit(1)
+    finally:
+        # Also on a critical error, since the checkpoint already considers the pending writes done
+        timer_wheel.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+        logging.info("Waiting for pending DB writes...")
+        db.close()
+        writer.close()
+        allocations_journal.close()
+        logging.info("Done.")
 
 if __name__ == '__main__':
     main()
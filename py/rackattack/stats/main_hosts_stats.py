@@ -15,12 +15,20 @@ import smtplib
 import datetime
 import traceback
 import elasticsearch
-from time import sleep
 import rackattack.tcp.transport
 from email.mime.text import MIMEText
 from rackattack import clientfactory
 from rackattack.stats import config
+from rackattack.stats import metrics
+from rackattack.stats import rollups
+from rackattack.stats import registry
+from rackattack.stats import scheduler
+from rackattack.stats import hostcounts
 from rackattack.stats import logconfig
+from rackattack.stats import rapclient
+from rackattack.stats import concurrentpoller
+from rackattack.stats import hostsnapshots
+from rackattack.stats import hostintervals
 from rackattack.stats import elasticsearchdbwrapper
 
 
@@ -31,8 +39,20 @@ SEND_ALERTS_BY_MAIL = False
 
 # Less interesting configuration
 SAMPLE_INTERVAL_NR_SECONDS = 60
+# Sample more often when hosts change states frequently, and less often when they are idle
+ADAPTIVE_SAMPLING = False
+MIN_SAMPLE_INTERVAL_NR_SECONDS = 15
+MAX_SAMPLE_INTERVAL_NR_SECONDS = 4 * 60
 SENDER_EMAIL = "eliran@stratoscale.com"
 SMTP_SERVER = 'localhost'
+METRICS_PORT = 9702
+ROLLUPS_REGISTRY_PATH = "/var/lib/rackattackstats/hosts-rollups-registry.json"
+# Maps the names of sites to the connection strings of their providers (if missing, RACKATTACK_PROVIDER is)
+PROVIDERS_FILEPATH = "/etc/rackattack-stats/providers.yaml"
+DEFAULT_SITE = "default"
+PROVIDER_TIMEOUT_NR_SECONDS = 30
+# Combinations of host fields by which hosts are counted (in the host_counts index)
+HOST_COUNTS_DIMENSIONS = (("state",), ("pool",), ("state", "pool"))
 
 
 # In case we cannot connect to sockets and stuff, this
@@ -42,10 +62,23 @@ SMTP_SERVER = 'localhost'
 is_connected = False
 msg_so_far = ''
 
-# Connections
-rackattack_client = None
+# Connections (created by main)
+sites = list()
+poller = None
 db = None
 
+# Metrics
+query_status_durations = metrics.default_registry.histogram(
+    "rackattack_stats_rap_query_status_duration_seconds", "Duration of admin__queryStatus calls to RAP.",
+    label_names=("site",))
+failed_polls = metrics.default_registry.counter(
+    "rackattack_stats_rap_failed_polls_total", "Polls of RAP which failed or timed out.",
+    label_names=("site",))
+nr_hosts = metrics.default_registry.gauge(
+    "rackattack_stats_hosts", "Hosts in the latest status of RAP.", label_names=("site",))
+missed_samples = metrics.default_registry.counter(
+    "rackattack_stats_missed_samples_total", "Samples skipped since the previous one was still running.")
+
 
 def log_msg(msg, level=logging.INFO):
     """Log the given message and add it to the global `msg_so_far` variable"""
@@ -89,64 +122,190 @@ def datetime_from_timestamp(timestamp):
     return datetime_now
 
 
-def fetch_nodes_stats(timestamp):
-    """Fetch RackAttack stats, add them to db and alert on errors"""
+class Site:
+    """The provider (RAP) of a site, and what is kept about its hosts between polls."""
+    def __init__(self, name, connection_string=None):
+        self.name = name
+        # None until the first poll, so that a failure of the first poll is alerted about as well
+        self.is_connected = None
+        connection_errors = (socket.error, rackattack.tcp.transport.TimeoutError,
+                             rackattack.tcp.transport.RemotelyClosedError)
+        self.client = rapclient.ReconnectingClient(self._client_factory(connection_string),
+                                                   connection_errors,
+                                                   socket_func=rackattack_client_socket,
+                                                   site=name)
+        # Per-host snapshots, delta encoded against the previous poll
+        self.snapshots = hostsnapshots.HostSnapshots()
+        # Intervals of hosts in states, ended by diffing consecutive polls
+        self.intervals = hostintervals.HostIntervals()
+        # Counts of hosts per state and per pool, downsampled to coarser windows
+        self.rollups = rollups.Rollups(registry.Registry(rollups_registry_path(name)),
+                                       datetime_from_timestamp)
+
+    def query_status(self):
+        """Called from a thread of the poller."""
+        self.client.connect()
+        before = time.time()
+        stats = self.client.call('admin__queryStatus')
+        query_status_durations.labels(self.name).observe(time.time() - before)
+        return stats
+
+    @staticmethod
+    def _client_factory(connection_string):
+        if connection_string is None:
+            return clientfactory.factory
+        return lambda: clientfactory.factory(connection_string)
+
+
+def rollups_registry_path(site_name):
+    if site_name == DEFAULT_SITE:
+        return ROLLUPS_REGISTRY_PATH
+    basename, extension = os.path.splitext(ROLLUPS_REGISTRY_PATH)
+    return "{}-{}{}".format(basename, site_name, extension)
+
+
+def load_providers():
+    """Maps the names of the sites to the connection strings of their providers. Without a providers file,
+    the provider of the environment (RACKATTACK_PROVIDER) is used, as the default site."""
+    if not os.path.exists(PROVIDERS_FILEPATH):
+        return {DEFAULT_SITE: None}
+    with open(PROVIDERS_FILEPATH) as providers_file:
+        providers = yaml.safe_load(providers_file)
+    if not isinstance(providers, dict) or not providers:
+        raise Exception("Invalid providers file: %s" % (PROVIDERS_FILEPATH,))
+    return providers
+
+
+def add_record(site, index, doc_type, record, id=None):
+    record['site'] = site.name
+    db.create(index=index, doc_type=doc_type, body=record, id=id)
+
+
+def add_site_stats(site, stats, timestamp):
+    """Add the records of the stats of a site to db. Returns the number of hosts which changed their state
+    since the previous poll of the site, or None if this is its first poll."""
     logger = logging.getLogger('rackattack_stats')
-
-    # Get stats from RackAttack
-    logger.debug('Fetching state from RAP...')
-    stats = rackattack_client.call('admin__queryStatus')
-    logger.info("Got state response from Rackattack.")
-
-    # Insert stats to the DB
+    nr_hosts.labels(site.name).set(len(stats['hosts']))
     unixtime = int(timestamp * 1000)
     datetime_now = datetime_from_timestamp(timestamp)
     # Use a special index that already counts the states (typos are in
     # rackattack). This is quite ugly, but we haven't managed to craete a
     # query in Kibana which does an average on the count of states (2
     # aggregations)
-    states = list(set([host['state'] for host in stats['hosts']]))
-    for idx, _state in enumerate(states):
+    counts = hostcounts.count_hosts(stats['hosts'], set(HOST_COUNTS_DIMENSIONS + (("state",), ("pool",))))
+    for idx, ((_state,), count) in enumerate(sorted(counts[("state",)].iteritems())):
         record = {'state': _state,
-                  'states_count': len([host for host in stats['hosts'] if host['state'] == _state]),
+                  'states_count': count,
                   'date': datetime_now}
         id = "%13d%03d" % (unixtime, idx)
-        logger.info("Inserting a record to the DB: {}...".format(record))
-        db.create(index='states', doc_type='state_count', body=record, id=id)
-        logger.info("Record inserted to DB.")
+        if site.name != DEFAULT_SITE:
+            id = "{}-{}".format(site.name, id)
+        logger.info("Adding a record to the DB: {}...".format(record))
+        add_record(site, 'states', 'state_count', record, id=id)
 
-    pools = list(set([host['pool'] for host in stats['hosts']]))
-    for idx, _pool in enumerate(pools):
+    for (_pool,), count in sorted(counts[("pool",)].iteritems()):
         record = {'pool': _pool,
-                  'count': len([host for host in stats['hosts'] if host['pool'] == _pool]),
+                  'count': count,
                   'date': datetime_now}
-        logger.info("Inserting a record to the DB: {}...".format(record))
-        db.create(index='pools', doc_type='pool_count', body=record)
-        logger.info("Record inserted to DB.")
-    flush_msgs_to_mail()
+        logger.info("Adding a record to the DB: {}...".format(record))
+        add_record(site, 'pools', 'pool_count', record)
+
+    configured_counts = dict((dimension, counts[dimension]) for dimension in HOST_COUNTS_DIMENSIONS)
+    for record in hostcounts.to_records(configured_counts, datetime_now):
+        logger.debug("Adding a record to the DB: {}...".format(record))
+        add_record(site, hostcounts.INDEX, hostcounts.DOC_TYPE, record)
 
+    for record in site.snapshots.sample(stats['hosts'], datetime_now):
+        add_record(site, hostsnapshots.INDEX, hostsnapshots.DOC_TYPE, record)
 
-def create_connection(factory_function, service_name):
+    rollup_counts = dict((kind, dict((value, count) for (value,), count in counts[(kind,)].iteritems()))
+                         for kind in ("state", "pool"))
+    for index, doc_type, record in site.rollups.add(timestamp, rollup_counts):
+        logger.info("Adding a rollup record to the DB: {}...".format(record))
+        add_record(site, index, doc_type, record)
+
+    is_first_poll = not site.intervals.has_previous_sample()
+    interval_records = site.intervals.sample(stats['hosts'], datetime_now)
+    for record in interval_records:
+        add_record(site, hostintervals.INDEX, hostintervals.DOC_TYPE, record)
+    return None if is_first_poll else len(interval_records)
+
+
+def fetch_nodes_stats(timestamp):
+    """Fetch the stats of the RackAttack of each site, add them to db and alert on errors. Returns the number
+    of hosts which changed their state since the previous call, and the number of hosts (both of the sites
+    which were polled before, since the churn of a site is unknown on its first poll)."""
     logger = logging.getLogger('rackattack_stats')
-    client = factory_function()
-    logger.info('Connected.')
-    return client
 
+    # Get stats from the RackAttacks of all sites, concurrently
+    logger.debug('Fetching state from the RAPs of {} sites...'.format(len(sites)))
+    results, errors, timed_out = poller.poll(dict((site.name, site.query_status) for site in sites))
+    logger.info("Got state responses from the RAPs of {} sites.".format(len(results)))
 
-def create_connections():
-    global rackattack_client, db
-    # Reload because somehow the socket gets recreated only when this happens
-    reload(rackattack.tcp.transport)
-    reload(clientfactory)
-    rackattack_client = clientfactory.factory()
-    db = elasticsearchdbwrapper.ElasticserachDBWrapper(alert_func=send_mail)
+    # Insert stats to the DB
+    nr_changed_hosts = 0
+    nr_sampled_hosts = 0
+    for site in sites:
+        if site.name in results:
+            if site.is_connected is False:
+                log_msg('RackAttack of site {} is connected and works again.'.format(site.name))
+            site.is_connected = True
+            nr_changed_hosts_of_site = add_site_stats(site, results[site.name], timestamp)
+            # Nothing is known about the churn of a site on its first poll
+            if nr_changed_hosts_of_site is not None:
+                nr_changed_hosts += nr_changed_hosts_of_site
+                nr_sampled_hosts += len(results[site.name]['hosts'])
+        elif site.name in errors:
+            site_error_recovery(site, "Error while fetching the state of site {}:\n{}"
+                                .format(site.name, errors[site.name]))
+        else:
+            site_error_recovery(site, "The RAP of site {} did not respond within {} seconds."
+                                .format(site.name, PROVIDER_TIMEOUT_NR_SECONDS))
+    # The records of all sites were buffered by the bulk writer, and are sent together
+    logger.info("Inserting records to the DB...")
+    db.flush()
+    logger.info("Records inserted to DB.")
+    # Only now, so that the rollups of windows which ended are not lost if the process stops before
+    for site in sites:
+        if site.name in results:
+            site.rollups.save()
+    flush_msgs_to_mail()
+    return nr_changed_hosts, nr_sampled_hosts
 
 
-def validate_rackattack_client_connection_is_closed():
-    try:
-        rackattack_client.close()
-    except:
-        pass
+def rackattack_client_socket(client):
+    """The socket of the requests transport of a RAP client, if it can be found."""
+    transport = getattr(client, "_request", None)
+    return getattr(transport, "_socket", None)
+
+
+def create_clients():
+    """Create the (long-lived) clients; They connect (and reconnect) by themselves."""
+    global sites, poller, db
+    sites = [Site(name, connection_string) for name, connection_string in sorted(load_providers().items())]
+    logging.info("Collecting the stats of sites: {}.".format(", ".join(site.name for site in sites)))
+    poller = concurrentpoller.ConcurrentPoller(len(sites), PROVIDER_TIMEOUT_NR_SECONDS)
+    db = elasticsearchdbwrapper.create_spooled_bulk_writer("hosts", alert_func=send_mail)
+
+
+def close_clients():
+    for site in sites:
+        site.client.close()
+    if poller is not None:
+        poller.close()
+
+
+def site_error_recovery(site, msg):
+    failed_polls.labels(site.name).inc()
+    # Alert by mail only on the first error after a successful poll of the site (or on the first poll)
+    if site.is_connected is False:
+        logging.getLogger('rackattack_stats').error(msg)
+        return
+    site.is_connected = False
+    log_msg(msg, level=logging.ERROR)
+    log_msg("Trying to reconnect to the RAP of site {} in about {} seconds."
+            .format(site.name, max(int(site.client.time_until_next_attempt()), SAMPLE_INTERVAL_NR_SECONDS)),
+            level=logging.ERROR)
 
 
 def socket_error_recovery(is_first_connection_attampt):
@@ -163,24 +322,38 @@ def socket_error_recovery(is_first_connection_attampt):
         is_connected = False
         flush_msgs_to_mail()
 
-    validate_rackattack_client_connection_is_closed()
+    # The snapshots of the last poll may not have been written, so the next poll is written in full
+    for site in sites:
+        site.snapshots.reset()
+
+
+def create_scheduler():
+    if ADAPTIVE_SAMPLING:
+        return scheduler.AdaptiveScheduler(SAMPLE_INTERVAL_NR_SECONDS, MIN_SAMPLE_INTERVAL_NR_SECONDS,
+                                           MAX_SAMPLE_INTERVAL_NR_SECONDS)
+    return scheduler.FixedRateScheduler(SAMPLE_INTERVAL_NR_SECONDS)
 
 
 def main():
     global is_connected
     logconfig.configure_logger()
     logger = logging.getLogger('rackattack_stats')
+    metrics.start_server(METRICS_PORT)
+    create_clients()
     is_first_connection_attampt = True
+    sample_scheduler = create_scheduler()
 
-    # Fetch stats forever
+    # Fetch stats forever, on the boundaries of the sample interval
     while True:
+        timestamp, nr_missed_samples = sample_scheduler.wait_for_next_tick()
+        if nr_missed_samples:
+            logger.warning("Skipped {} samples, since the previous one took too long.".format(
+                nr_missed_samples))
+            missed_samples.inc(nr_missed_samples)
         try:
-            if not is_connected:
-                logger.info('Attempting to create connections...')
-                create_connections()
-                logger.info("Connections created successfully.")
-
-            fetch_nodes_stats(time.time())
+            nr_changed_hosts, nr_sampled_hosts = fetch_nodes_stats(timestamp)
+            if nr_sampled_hosts:
+                sample_scheduler.report_churn(nr_changed_hosts, nr_sampled_hosts)
             if not is_connected and not is_first_connection_attampt:
                 send_mail('RackAttack Stats is connected and works again.')
             is_connected = True
@@ -188,10 +361,6 @@ def main():
             break
         except socket.error:
             socket_error_recovery(is_first_connection_attampt)
-        except rackattack.tcp.transport.TimeoutError:
-            socket_error_recovery(is_first_connection_attampt)
-        except rackattack.tcp.transport.RemotelyClosedError:
-            socket_error_recovery(is_first_connection_attampt)
         except elasticsearch.ConnectionTimeout:
             socket_error_recovery(is_first_connection_attampt)
         except elasticsearch.ConnectionError:
@@ -207,9 +376,7 @@ def main():
         finally:
             is_first_connection_attampt = False
 
-        sleep(SAMPLE_INTERVAL_NR_SECONDS)
-
-    validate_rackattack_client_connection_is_closed()
+    close_clients()
 
 
 if __name__ == '__main__':
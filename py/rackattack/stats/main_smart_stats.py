@@ -1,14 +1,19 @@
 import logging
 import traceback
 import elasticsearch
+from rackattack.stats import metrics
 from rackattack.stats import logconfig
 from rackattack.stats import smartscanner
 from rackattack.stats import elasticsearchdbwrapper
 
 
+METRICS_PORT = 9703
+
+
 def main():
     logconfig.configure_logger()
-    db = elasticsearchdbwrapper.ElasticsearchDBWrapper()
+    metrics.start_server(METRICS_PORT)
+    db = elasticsearchdbwrapper.create_spooled_bulk_writer("smart")
     smart_scanner = smartscanner.SmartScanner(db)
 
     while True:
@@ -0,0 +1,277 @@
+"""In-process metrics, served over HTTP in the Prometheus text exposition format.
+
+Metrics are created through a MetricsRegistry (usually default_registry), e.g.:
+
+    events = metrics.default_registry.counter("events_total", "Handled events.", label_names=("type",))
+    events.labels("done").inc()
+
+Updating a metric takes a dict lookup and a lock, so it can be done on every event.
+"""
+import math
+import bisect
+import logging
+import threading
+import BaseHTTPServer
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LONG_DURATION_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600,
+                         24 * 3600, 3 * 24 * 3600)
+
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self._label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._children = dict()
+        self._func = None
+
+    def labels(self, *label_values):
+        assert len(label_values) == len(self._label_names), label_values
+        child = self._children.get(label_values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(label_values, self._new_child())
+        return child
+
+    def set_function(self, func):
+        """Take the (unlabeled) value from func whenever the metric is rendered."""
+        assert not self._label_names
+        self._func = func
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, _escape(self.help, is_label_value=False)),
+                 "# TYPE {} {}".format(self.name, self.TYPE)]
+        if self._func is not None:
+            lines.append("{} {}".format(self.name, _format_value(self._func())))
+            return lines
+        with self._lock:
+            children = sorted(self._children.iteritems())
+        for label_values, child in children:
+            lines.extend(self._render_child(dict(zip(self._label_names, label_values)), child))
+        return lines
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _render_child(self, labels, child):
+        return ["{}{} {}".format(self.name, _format_labels(labels), _format_value(child.value()))]
+
+
+class _Value(object):
+    __slots__ = ("_value", "_lock")
+
+    def __init__(self, lock):
+        self._value = 0.0
+        self._lock = lock
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value):
+        self._value = float(value)
+
+    def value(self):
+        return self._value
+
+
+class Counter(_Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1):
+        assert amount >= 0
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+
+class Gauge(_Metric):
+    TYPE = "gauge"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+
+class _HistogramValue(object):
+    __slots__ = ("_upper_bounds", "_bucket_counts", "_sum", "_lock")
+
+    def __init__(self, upper_bounds, lock):
+        self._upper_bounds = upper_bounds
+        self._bucket_counts = [0] * (len(upper_bounds) + 1)
+        self._sum = 0.0
+        self._lock = lock
+
+    def observe(self, value):
+        bucket_idx = bisect.bisect_left(self._upper_bounds, value)
+        with self._lock:
+            self._bucket_counts[bucket_idx] += 1
+            self._sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._bucket_counts), self._sum
+
+
+class Histogram(_Metric):
+    """Counts observations into fixed buckets (given by their upper bounds), and keeps their sum."""
+    TYPE = "histogram"
+
+    def __init__(self, name, help, buckets=DURATION_BUCKETS, label_names=()):
+        _Metric.__init__(self, name, help, label_names)
+        self._upper_bounds = tuple(sorted(buckets))
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def set_function(self, func):
+        raise NotImplementedError("Histograms cannot be taken from a function")
+
+    def _new_child(self):
+        return _HistogramValue(self._upper_bounds, self._lock)
+
+    def _render_child(self, labels, child):
+        bucket_counts, total = child.snapshot()
+        lines = list()
+        cumulative_count = 0
+        for upper_bound, count in zip(self._upper_bounds + (float("inf"),), bucket_counts):
+            cumulative_count += count
+            bucket_labels = dict(labels, le=_format_value(upper_bound))
+            lines.append("{}_bucket{} {}".format(self.name, _format_labels(bucket_labels), cumulative_count))
+        lines.append("{}_sum{} {}".format(self.name, _format_labels(labels), _format_value(total)))
+        lines.append("{}_count{} {}".format(self.name, _format_labels(labels), cumulative_count))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = dict()
+        self._lock = threading.Lock()
+
+    def counter(self, name, help, label_names=()):
+        return self._get_or_create(Counter, name, help, label_names=label_names)
+
+    def gauge(self, name, help, label_names=()):
+        return self._get_or_create(Gauge, name, help, label_names=label_names)
+
+    def histogram(self, name, help, buckets=DURATION_BUCKETS, label_names=()):
+        return self._get_or_create(Histogram, name, help, buckets=buckets, label_names=label_names)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.itervalues(), key=lambda metric: metric.name)
+        lines = list()
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                logging.exception("Failed rendering metric {}.".format(metric.name))
+        return "\n".join(lines) + "\n"
+
+    def _get_or_create(self, cls, name, help, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, help, **kwargs)
+                self._metrics[name] = metric
+            assert isinstance(metric, cls), name
+            return metric
+
+
+class MetricsServer:
+    """Serves the metrics of a registry at /metrics, from a thread of its own."""
+    def __init__(self, registry, port, host="127.0.0.1"):
+        self._registry = registry
+        handler = self._create_handler_class(registry)
+        self._server = BaseHTTPServer.HTTPServer((host, port), handler)
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server")
+        self._thread.daemon = True
+        self._thread.start()
+        logging.info("Serving metrics on port {}.".format(self.port))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @staticmethod
+    def _create_handler_class(registry):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics request: " + format, *args)
+        return Handler
+
+
+def start_server(port, registry=None):
+    """Serve the metrics of the registry (default_registry if not given); Failing to do so is not fatal."""
+    if registry is None:
+        registry = default_registry
+    try:
+        server = MetricsServer(registry, port)
+    except Exception:
+        logging.exception("Failed to serve metrics on port {}.".format(port))
+        return None
+    server.start()
+    return server
+
+
+def _escape(text, is_label_value=True):
+    text = text.replace("\\", "\\\\").replace("\n", "\\n")
+    if is_label_value:
+        text = text.replace('"', '\\"')
+    return text
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(str(value)))
+                          for name, value in sorted(labels.iteritems())) + "}"
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+default_registry = MetricsRegistry()
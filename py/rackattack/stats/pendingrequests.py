@@ -0,0 +1,115 @@
+import collections
+from rackattack.stats import allocationstate
+
+
+PENDING_REQUEST_TTL_NR_SECONDS = 5 * 60
+
+
+def request_fingerprint(requirements, allocation_info):
+    return allocationstate.fingerprint(dict(requirements=requirements, allocationInfo=allocation_info))
+
+
+def node_names_fingerprint(node_names):
+    return frozenset(node_names)
+
+
+class _Entry:
+    def __init__(self, allocation, request_fingerprint, node_names_fingerprint):
+        self.allocation = allocation
+        self.request_fingerprint = request_fingerprint
+        self.node_names_fingerprint = node_names_fingerprint
+        self.is_pending = True
+
+
+class PendingRequests:
+    """Allocation requests which were neither created nor rejected yet, matched by their contents.
+
+    A creation (or rejection) message is matched with the oldest pending request of the same requirements
+    and allocation info when the message contains them (RackAttack's messages usually do not). Otherwise,
+    a creation message is matched with the oldest pending request of the same node names, and a rejection
+    message is matched with the oldest pending request, since requests are handled in order.
+    Requests which were not matched within the TTL are dropped by expire(). All operations take O(1)
+    (amortized), since matched entries are only marked as such, and removed once they are the oldest.
+    """
+    def __init__(self, ttl=PENDING_REQUEST_TTL_NR_SECONDS):
+        self.ttl = ttl
+        self._entries = collections.deque()
+        self._entries_by_record_id = dict()
+        self._by_request_fingerprint = dict()
+        self._by_node_names_fingerprint = dict()
+        self._nr_pending = 0
+
+    def add(self, allocation):
+        requirements = dict((node.node_name, node.requirements) for node in allocation.nodes)
+        entry = _Entry(allocation,
+                       request_fingerprint(requirements, allocation.allocation_info),
+                       node_names_fingerprint(requirements.iterkeys()))
+        self._entries.append(entry)
+        self._entries_by_record_id[allocation.record_id] = entry
+        self._by_request_fingerprint.setdefault(entry.request_fingerprint, collections.deque()).append(entry)
+        self._by_node_names_fingerprint.setdefault(entry.node_names_fingerprint,
+                                                   collections.deque()).append(entry)
+        self._nr_pending += 1
+
+    def pop_created(self, message):
+        if "requirements" in message and "allocationInfo" in message:
+            return self._pop_by_request_fingerprint(message["requirements"], message["allocationInfo"])
+        return self._pop_oldest(self._by_node_names_fingerprint,
+                                node_names_fingerprint(message["allocated"].iterkeys()))
+
+    def pop_rejected(self, message):
+        if "requirements" in message and "allocationInfo" in message:
+            return self._pop_by_request_fingerprint(message["requirements"], message["allocationInfo"])
+        while self._entries:
+            entry = self._entries.popleft()
+            if entry.is_pending:
+                return self._pop_entry(entry)
+        return None
+
+    def expire(self, now):
+        """Drop the requests which are older than the TTL, and return their allocations."""
+        expired = list()
+        while self._entries:
+            entry = self._entries[0]
+            if entry.is_pending and now - entry.allocation.request_timestamp < self.ttl:
+                break
+            self._entries.popleft()
+            if entry.is_pending:
+                expired.append(self._pop_entry(entry))
+        return expired
+
+    def get(self, record_id):
+        entry = self._entries_by_record_id.get(record_id)
+        return None if entry is None else entry.allocation
+
+    def allocations(self):
+        return [entry.allocation for entry in self._entries if entry.is_pending]
+
+    def __len__(self):
+        return self._nr_pending
+
+    def _pop_by_request_fingerprint(self, requirements, allocation_info):
+        fingerprint = request_fingerprint(requirements, allocation_info)
+        return self._pop_oldest(self._by_request_fingerprint, fingerprint)
+
+    def _pop_oldest(self, entries_by_fingerprint, fingerprint):
+        entries = entries_by_fingerprint.get(fingerprint)
+        if not entries:
+            return None
+        return self._pop_entry(entries[0])
+
+    def _pop_entry(self, entry):
+        entry.is_pending = False
+        self._nr_pending -= 1
+        del self._entries_by_record_id[entry.allocation.record_id]
+        self._remove_matched_entries(self._by_request_fingerprint, entry.request_fingerprint)
+        self._remove_matched_entries(self._by_node_names_fingerprint, entry.node_names_fingerprint)
+        return entry.allocation
+
+    @staticmethod
+    def _remove_matched_entries(entries_by_fingerprint, fingerprint):
+        entries = entries_by_fingerprint[fingerprint]
+        while entries and not entries[0].is_pending:
+            entries.popleft()
+        if not entries:
+            del entries_by_fingerprint[fingerprint]
@@ -0,0 +1,117 @@
+import time
+import errno
+import random
+import select
+import socket
+import logging
+from rackattack.stats import metrics
+
+
+MIN_RECONNECTION_BACKOFF_NR_SECONDS = 1
+MAX_RECONNECTION_BACKOFF_NR_SECONDS = 5 * 60
+
+lost_connections = metrics.default_registry.counter(
+    "rackattack_stats_rap_reconnections_total", "Times the connection to RAP was lost.",
+    label_names=("site",))
+
+
+def is_socket_alive(sock):
+    """A cheap check (no request is sent) that the peer did not close the socket, nor reset it."""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return True
+        # A readable socket with no data to read was closed by the peer
+        return sock.recv(1, socket.MSG_PEEK) != ""
+    except socket.error as ex:
+        return ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+    except (select.error, ValueError):
+        return False
+
+
+class ReconnectingClient:
+    """Keeps a single long-lived client of RAP (created by the given factory), and replaces it once it dies.
+
+    The client is replaced when a call fails with one of connection_errors, or when its socket (given by
+    socket_func, if it can tell) is found dead before a call. Failed connection attempts are spaced by an
+    exponential backoff with jitter, so that clients do not reconnect all at once after RAP restarts.
+    """
+    def __init__(self, factory, connection_errors=(socket.error,), socket_func=None, site="default",
+                 min_backoff=MIN_RECONNECTION_BACKOFF_NR_SECONDS,
+                 max_backoff=MAX_RECONNECTION_BACKOFF_NR_SECONDS,
+                 clock=time.time, sleep=time.sleep, random_func=random.random):
+        self._factory = factory
+        self._site = site
+        self._connection_errors = connection_errors
+        self._socket_func = socket_func
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._clock = clock
+        self._sleep = sleep
+        self._random_func = random_func
+        self._client = None
+        self._nr_failures = 0
+        self._time_of_next_attempt = None
+
+    def connect(self):
+        """Connect, unless the current client is alive. Waits for the backoff of previous failures first."""
+        if self._client is not None:
+            if self.is_alive():
+                return
+            logging.warning("The connection to RAP was found dead.")
+            self._handle_failure()
+        while True:
+            remaining = self.time_until_next_attempt()
+            if remaining <= 0:
+                break
+            self._sleep(remaining)
+        try:
+            self._client = self._factory()
+        except Exception:
+            self._handle_failure()
+            raise
+        self._nr_failures = 0
+        self._time_of_next_attempt = None
+        logging.info("Connected to RAP.")
+
+    def call(self, *args, **kwargs):
+        if self._client is None:
+            self.connect()
+        try:
+            return self._client.call(*args, **kwargs)
+        except self._connection_errors:
+            self._handle_failure()
+            raise
+
+    def is_alive(self):
+        if self._client is None:
+            return False
+        if self._socket_func is None:
+            return True
+        sock = self._socket_func(self._client)
+        return sock is None or is_socket_alive(sock)
+
+    def time_until_next_attempt(self):
+        if self._time_of_next_attempt is None:
+            return 0
+        return max(self._time_of_next_attempt - self._clock(), 0)
+
+    def close(self):
+        if self._client is None:
+            return
+        try:
+            self._client.close()
+        except Exception:
+            logging.debug("Failed closing the RAP client (probably since it is already closed).")
+        self._client = None
+
+    def _handle_failure(self):
+        # Only a connection which was established is lost (rather than each failed attempt to reconnect)
+        if self._client is not None:
+            lost_connections.labels(self._site).inc()
+        self.close()
+        self._nr_failures += 1
+        backoff = min(self._min_backoff * 2 ** (self._nr_failures - 1), self._max_backoff)
+        # Half of the backoff is fixed, and the other half is random
+        backoff = backoff / 2.0 + self._random_func() * backoff / 2.0
+        self._time_of_next_attempt = self._clock() + backoff
@@ -11,17 +11,25 @@ class Registry:
         self._validate_file_exists()
 
     def write(self, key, content):
-        if key in self._data and self._data[key] != content:
+        if key not in self._data or self._data[key] != content:
             self._is_dirty = True
         self._data[key] = content
 
     def read(self, key):
         return self._data.get(key, None)
 
+    def read_all(self):
+        return dict(self._data)
+
     def flush(self):
         if self._is_dirty:
-            with open(self._storage_filepath, "w") as storage_file:
+            # Replace the file at once, so that a crash while writing cannot leave a truncated registry
+            temp_filepath = self._storage_filepath + ".tmp"
+            with open(temp_filepath, "w") as storage_file:
                 yaml.dump(self._data, storage_file)
+                storage_file.flush()
+                os.fsync(storage_file.fileno())
+            os.rename(temp_filepath, self._storage_filepath)
         self._is_dirty = False
 
     def _refresh(self):
@@ -0,0 +1,180 @@
+"""Feeds a journal of allocation and inaugurator messages back through the allocations handler.
+
+Useful for rebuilding the allocations and inaugurations indices (e.g. after a schema change), and for
+measuring the throughput of the handler on recorded production traffic. Replays never write to the
+production indices, but to indices of the given suffix (which can then be aliased).
+"""
+import time
+import uuid
+import logging
+import argparse
+from rackattack.stats import journal
+from rackattack.stats import logconfig
+from rackattack.stats import elasticsearchdbwrapper
+from rackattack.stats.main_allocation_stats import AllocationsHandler
+
+
+PACE_RECORDED = "recorded"
+PACE_FAST = "fast"
+DB_ELASTICSEARCH = "elasticsearch"
+DB_NULL = "null"
+
+
+class ReplaySubscriptionManager:
+    """Takes the place of the AMQP subscription; Delivers journaled messages to the registered callbacks."""
+    def __init__(self):
+        self._all_allocations_callback = None
+        self._inaugurator_callbacks = dict()
+        self.nr_undelivered_messages = 0
+
+    def registerForAllAllocations(self, callback):
+        self._all_allocations_callback = callback
+
+    def registerForInagurator(self, host_id, callback):
+        self._inaugurator_callbacks[host_id] = callback
+
+    def unregisterForInaugurator(self, host_id):
+        self._inaugurator_callbacks.pop(host_id, None)
+
+    def deliver(self, kind, message):
+        if kind == "allocations":
+            callback = self._all_allocations_callback
+        else:
+            callback = self._inaugurator_callbacks.get(message.get("id"))
+        if callback is None:
+            self.nr_undelivered_messages += 1
+            return
+        callback(message)
+
+
+class ReplayClock:
+    """The time as seen by the handler, which is the time at which the replayed message was recorded."""
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self):
+        return self.now
+
+
+class NullEventsMonitor:
+    def start(self):
+        pass
+
+    def an_event_has_occurred(self):
+        pass
+
+
+class NullDB:
+    """Discards all writes (only counts them); For measuring the throughput of the handler itself."""
+    def __init__(self):
+        self.nr_creates = 0
+        self.nr_updates = 0
+
+    def create(self, index, doc_type, body, id=None):
+        self.nr_creates += 1
+        if id is None:
+            id = uuid.uuid4().hex
+        return dict(_index=index, _type=doc_type, _id=id)
+
+    def update(self, index, doc_type, id, body):
+        self.nr_updates += 1
+        return dict(_index=index, _type=doc_type, _id=id)
+
+    def flush(self):
+        return list()
+
+    def handle_disconnection(self):
+        pass
+
+
+class ReplayTargetDB:
+    """Writes to the indices of the given suffix instead of the production indices, and gives documents
+    which are created without an ID an ID which is the same on every replay of the journal (the number of
+    the document in its index), so that replaying again does not duplicate them."""
+    def __init__(self, db, index_suffix):
+        if not index_suffix:
+            raise ValueError("An index suffix is required, so that production indices are not written to")
+        self._db = db
+        self._index_suffix = index_suffix
+        self._nr_created_documents = dict()
+
+    def create(self, index, doc_type, body, id=None):
+        index = self.target_index(index)
+        if id is None:
+            nr_created_documents = self._nr_created_documents.get(index, 0)
+            self._nr_created_documents[index] = nr_created_documents + 1
+            id = "replay-{}".format(nr_created_documents)
+        return self._db.create(index=index, doc_type=doc_type, body=body, id=id)
+
+    def update(self, index, doc_type, id, body):
+        return self._db.update(index=self.target_index(index), doc_type=doc_type, id=id, body=body)
+
+    def target_index(self, index):
+        return "{}_{}".format(index, self._index_suffix)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+def replay(journal_dirpath, db, pace=PACE_FAST):
+    """Returns the number of replayed messages and how long it took."""
+    clock = ReplayClock()
+    subscription_mgr = ReplaySubscriptionManager()
+    handler = AllocationsHandler(subscription_mgr, db, NullEventsMonitor(), clock=clock)
+    nr_messages = 0
+    first_timestamp = None
+    start_time = time.time()
+    for timestamp, kind, message in journal.read(journal_dirpath):
+        if pace == PACE_RECORDED:
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = (timestamp - first_timestamp) - (time.time() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+        clock.now = timestamp
+        subscription_mgr.deliver(kind, message)
+        nr_messages += 1
+        if not handler.handle_pending_tasks():
+            logging.error("The handler has stopped; Stopping the replay.")
+            break
+    db.flush()
+    duration = time.time() - start_time
+    if subscription_mgr.nr_undelivered_messages:
+        logging.info("{} inaugurator messages were of hosts which were not subscribed to.".format(
+            subscription_mgr.nr_undelivered_messages))
+    return nr_messages, duration
+
+
+def create_db(db_type, index_suffix=None):
+    if db_type == DB_ELASTICSEARCH:
+        db = elasticsearchdbwrapper.BulkWriter(elasticsearchdbwrapper.ElasticsearchDBWrapper())
+        return ReplayTargetDB(db, index_suffix)
+    elif db_type == DB_NULL:
+        return NullDB()
+    raise ValueError(db_type)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("journal_dirpath")
+    parser.add_argument("--pace", choices=(PACE_FAST, PACE_RECORDED), default=PACE_FAST)
+    parser.add_argument("--db", choices=(DB_NULL, DB_ELASTICSEARCH), default=DB_NULL)
+    parser.add_argument("--index-suffix", help="Write to the indices of this suffix (e.g. allocations_3_"
+                        "<suffix>) rather than to the production indices; Required with --db elasticsearch")
+    args = parser.parse_args()
+    if args.db == DB_ELASTICSEARCH and not args.index_suffix:
+        parser.error("--index-suffix is required with --db elasticsearch")
+    return args
+
+
+def main():
+    args = get_args()
+    logconfig.configure_logger(level=logging.WARNING)
+    db = create_db(args.db, args.index_suffix)
+    nr_messages, duration = replay(args.journal_dirpath, db, args.pace)
+    print "Replayed {} messages in {:.2f} seconds ({:.0f} messages per second).".format(
+        nr_messages, duration, nr_messages / duration if duration else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Downsampled counts of hosts (e.g. per state and per pool), in windows of 5 minutes and of an hour.
+
+Each sample of counts is added to the current window of each granularity. Once a sample of a later window
+is added, a record of the min, max, average and last count of each value in the window is emitted. Values
+which are missing in some of the samples of a window count as 0 in them. The windows in progress are kept
+in a registry by save() (which should be called once the emitted records were written), so that they are
+resumed after a restart.
+"""
+import copy
+import math
+
+
+WINDOWS = ((5 * 60, "5m"), (60 * 60, "1h"))
+
+
+def index_name(kind, window_label):
+    return "{}s_{}".format(kind, window_label)
+
+
+def doc_type(kind):
+    return "{}_rollup".format(kind)
+
+
+class Rollups:
+    def __init__(self, registry=None, date_func=lambda timestamp: timestamp, windows=WINDOWS):
+        self._registry = registry
+        self._date_func = date_func
+        self._windows = windows
+        self._current = dict()
+        if registry is not None:
+            for _, label in windows:
+                window = registry.read(self._registry_key(label))
+                if window is not None:
+                    self._current[label] = window
+
+    def add(self, timestamp, counts):
+        """counts maps each kind (e.g. "state") to the count of each of its values. Returns a list of
+        (index, doc_type, record) of the windows which ended before the given sample."""
+        records = list()
+        for length, label in self._windows:
+            start = math.floor(timestamp / float(length)) * length
+            window = self._current.get(label)
+            if window is not None and window["start"] != start:
+                records.extend(self._records(window, length, label))
+                window = None
+            if window is None:
+                window = dict(start=start, nr_samples=0, aggregates=dict())
+                self._current[label] = window
+            self._add_sample(window, counts)
+        return records
+
+    def save(self):
+        """Persist the windows in progress. Until then, a restart resumes the windows as they were on the
+        previous save, so that the records of windows which ended after it are emitted again."""
+        if self._registry is None:
+            return
+        for label, window in self._current.iteritems():
+            self._registry.write(self._registry_key(label), copy.deepcopy(window))
+        self._registry.flush()
+
+    @staticmethod
+    def _add_sample(window, counts):
+        for kind, aggregates in window["aggregates"].iteritems():
+            for value, aggregate in aggregates.iteritems():
+                if value not in counts.get(kind, ()):
+                    aggregate["min"] = 0
+                    aggregate["last"] = 0
+        for kind, value_counts in counts.iteritems():
+            aggregates = window["aggregates"].setdefault(kind, dict())
+            for value, count in value_counts.iteritems():
+                aggregate = aggregates.get(value)
+                if aggregate is None:
+                    # The value was missing (i.e. 0) in the previous samples of the window, if any
+                    min_count = count if window["nr_samples"] == 0 else 0
+                    aggregates[value] = dict(min=min_count, max=count, sum=count, last=count)
+                    continue
+                aggregate["min"] = min(aggregate["min"], count)
+                aggregate["max"] = max(aggregate["max"], count)
+                aggregate["sum"] += count
+                aggregate["last"] = count
+        window["nr_samples"] += 1
+
+    def _records(self, window, length, label):
+        records = list()
+        date = self._date_func(window["start"])
+        for kind, aggregates in sorted(window["aggregates"].iteritems()):
+            for value, aggregate in sorted(aggregates.iteritems()):
+                record = {kind: value,
+                          'date': date,
+                          'window_nr_seconds': length,
+                          'nr_samples': window["nr_samples"],
+                          'min': aggregate["min"],
+                          'max': aggregate["max"],
+                          'avg': aggregate["sum"] / float(window["nr_samples"]),
+                          'last': aggregate["last"]}
+                records.append((index_name(kind, label), doc_type(kind), record))
+        return records
+
+    @staticmethod
+    def _registry_key(label):
+        return "window_{}".format(label)
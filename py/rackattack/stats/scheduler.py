@@ -0,0 +1,76 @@
+import math
+import time
+
+
+class FixedRateScheduler:
+    """Ticks at the multiples of the interval (in seconds since the epoch), regardless of how long runs take.
+
+    Runs never overlap: A tick which passed while the previous run was still running is skipped, and
+    counted as missed, and the next run takes place on the next boundary.
+    """
+    def __init__(self, interval, clock=time.time, sleep=time.sleep):
+        self.interval = interval
+        self._clock = clock
+        self._sleep = sleep
+        self._expected_tick = None
+        self.nr_missed_ticks = 0
+
+    def wait_for_next_tick(self):
+        """Sleeps until the next tick, and returns its time and the number of ticks missed before it."""
+        tick = math.ceil(self._clock() / self.interval) * self.interval
+        nr_missed_ticks = 0
+        if self._expected_tick is not None:
+            tick = max(tick, self._expected_tick)
+            nr_missed_ticks = int(round((tick - self._expected_tick) / self.interval))
+        self.nr_missed_ticks += nr_missed_ticks
+        while True:
+            remaining = tick - self._clock()
+            if remaining <= 0:
+                break
+            self._sleep(remaining)
+        self._expected_tick = tick + self.interval
+        return tick, nr_missed_ticks
+
+    def report_churn(self, nr_changed, nr_total):
+        """How many of the sampled items changed since the previous run (used by the adaptive scheduler)."""
+        pass
+
+
+class AdaptiveScheduler(FixedRateScheduler):
+    """Halves the interval (down to min_interval) when the ratio of changed items reaches high_churn_ratio,
+    doubles it (up to max_interval) when nothing changed, and otherwise goes back towards the base interval.
+
+    Intervals are the base interval times powers of 2, so ticks stay aligned to the same boundaries.
+    """
+    def __init__(self, interval, min_interval, max_interval, high_churn_ratio=0.05, clock=time.time,
+                 sleep=time.sleep):
+        FixedRateScheduler.__init__(self, interval, clock, sleep)
+        self._base_interval = interval
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._high_churn_ratio = high_churn_ratio
+
+    def report_churn(self, nr_changed, nr_total):
+        # Nothing was sampled (e.g. the first poll, which has nothing to be compared with)
+        if not nr_total:
+            return
+        if nr_changed >= self._high_churn_ratio * nr_total:
+            interval = self.interval / 2.0
+        elif nr_changed == 0:
+            interval = self.interval * 2
+        elif self.interval > self._base_interval:
+            interval = self.interval / 2.0
+        elif self.interval < self._base_interval:
+            interval = self.interval * 2
+        else:
+            return
+        if self._min_interval <= interval <= self._max_interval:
+            self._set_interval(interval)
+
+    def _set_interval(self, interval):
+        # The previous tick is a boundary of the new interval as well (when shortened), or the next tick is
+        # the next boundary of the new interval after it (when lengthened)
+        if self._expected_tick is not None:
+            previous_tick = self._expected_tick - self.interval
+            self._expected_tick = math.floor(previous_tick / interval) * interval + interval
+        self.interval = interval
@@ -6,6 +6,7 @@ import logging
 import datetime
 import subprocess
 from rackattack.stats import config
+from rackattack.stats import metrics
 from rackattack.stats import registry
 from rackattack.stats import statemachinescanner
 
@@ -14,6 +15,14 @@ SCAN_INTERVAL_NR_SECONDS = 60 * 30
 REGISTRY_PATH = "/var/lib/rackattackstats/smartscanner-registry.json"
 RACKATTACK_LOGS_PATH = "/var/lib/rackattackphysical/seriallogs/"
 
+scan_durations = metrics.default_registry.histogram(
+    "rackattack_stats_smart_scan_duration_seconds", "Duration of scans of the serial logs.",
+    buckets=metrics.LONG_DURATION_BUCKETS)
+scanned_lines = metrics.default_registry.counter(
+    "rackattack_stats_smart_lines_scanned_total", "Lines of SMART output found in the serial logs.")
+new_results = metrics.default_registry.counter(
+    "rackattack_stats_smart_results_total", "New SMART results which were inserted to the DB.")
+
 GENERAL_ATTRIBUTES = {"Model Family": str,
                       "Serial Number": str,
                       "Rotation Rate": str}
@@ -54,15 +63,19 @@ class SmartScanner:
             time.sleep(SCAN_INTERVAL_NR_SECONDS)
 
     def _scan_once(self):
+        start_time = time.time()
         nrNewResults = 0
         results = self._get_smart_results()
         for result in results:
             if self._is_result_new(result):
                 self._insert_to_db(result)
                 nrNewResults += 1
+        self._db.flush()
         logging.info("%(nrNewResults)s new results were inserted during this scan cycle.",
                      dict(nrNewResults=nrNewResults))
         self._scan_time_registry.flush()
+        new_results.inc(nrNewResults)
+        scan_durations.observe(time.time() - start_time)
 
     def _parse_scan_result(self, scan_result, server):
         parsed_result = dict()
@@ -132,7 +145,9 @@ class SmartScanner:
 
     def _group_raw_results_by_server(self, raw_results):
         results = dict()
-        for line in raw_results.splitlines():
+        lines = raw_results.splitlines()
+        scanned_lines.inc(len(lines))
+        for line in lines:
             line = line.strip()
             if not line:
                 continue
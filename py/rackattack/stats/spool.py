@@ -0,0 +1,101 @@
+import os
+import logging
+
+
+SEGMENT_MAX_NR_BYTES = 16 * 1024 * 1024
+SEGMENT_FILENAME_SUFFIX = ".spool"
+
+
+class Spool:
+    """An append-only store of lines on disk, rotated into segment files.
+
+    Lines are read back segment by segment, in the order in which they were appended. A segment is
+    removed only after it was consumed successfully, so nothing is lost if the process dies meanwhile.
+    """
+    def __init__(self, dirpath, max_segment_nr_bytes=SEGMENT_MAX_NR_BYTES):
+        self._dirpath = dirpath
+        self._max_segment_nr_bytes = max_segment_nr_bytes
+        self._current_segment = None
+        self._current_segment_nr_bytes = 0
+        if not os.path.exists(dirpath):
+            logging.info("Creating the spool directory in {}".format(dirpath))
+            os.makedirs(dirpath)
+        self._segments = self._find_existing_segments()
+        if self._segments:
+            logging.info("Found {} spooled segments in {}.".format(len(self._segments), dirpath))
+
+    def append(self, lines):
+        if self._current_segment is None or self._current_segment_nr_bytes >= self._max_segment_nr_bytes:
+            self._start_new_segment()
+        data = "".join(self._encode(line) + "\n" for line in lines)
+        self._current_segment.write(data)
+        self._current_segment.flush()
+        os.fsync(self._current_segment.fileno())
+        self._current_segment_nr_bytes += len(data)
+
+    def is_empty(self):
+        return not self._segments
+
+    def nr_segments(self):
+        return len(self._segments)
+
+    def replay(self, consume_func):
+        """Feed the lines of each segment, oldest first, to consume_func, removing consumed segments.
+
+        If consume_func raises, the segment it was given is kept and the exception propagates.
+        """
+        self._close_current_segment()
+        while self._segments:
+            segment_nr = self._segments[0]
+            lines = self._read_segment(segment_nr)
+            consume_func(lines)
+            os.unlink(self._segment_path(segment_nr))
+            self._segments.pop(0)
+
+    def take_oldest_segment(self):
+        """Remove the oldest segment and return its lines."""
+        if len(self._segments) == 1:
+            self._close_current_segment()
+        segment_nr = self._segments.pop(0)
+        lines = self._read_segment(segment_nr)
+        os.unlink(self._segment_path(segment_nr))
+        return lines
+
+    def _start_new_segment(self):
+        self._close_current_segment()
+        segment_nr = self._segments[-1] + 1 if self._segments else 0
+        self._current_segment = open(self._segment_path(segment_nr), "a")
+        self._current_segment_nr_bytes = 0
+        self._segments.append(segment_nr)
+
+    def _close_current_segment(self):
+        if self._current_segment is not None:
+            self._current_segment.close()
+            self._current_segment = None
+
+    def _read_segment(self, segment_nr):
+        with open(self._segment_path(segment_nr)) as segment:
+            lines = segment.read().split("\n")
+        # The last line is either empty, or was cut in the middle of a write
+        return lines[:-1]
+
+    def _segment_path(self, segment_nr):
+        return os.path.join(self._dirpath, "%010d%s" % (segment_nr, SEGMENT_FILENAME_SUFFIX))
+
+    def _find_existing_segments(self):
+        segments = list()
+        for filename in os.listdir(self._dirpath):
+            if not filename.endswith(SEGMENT_FILENAME_SUFFIX):
+                continue
+            try:
+                segments.append(int(filename[:-len(SEGMENT_FILENAME_SUFFIX)]))
+            except ValueError:
+                logging.warn("Ignoring an invalid spool segment filename: {}".format(filename))
+        segments.sort()
+        return segments
+
+    @staticmethod
+    def _encode(line):
+        if isinstance(line, unicode):
+            return line.encode("utf-8")
+        return line
@@ -0,0 +1,267 @@
+import time
+import Queue
+import logging
+import threading
+import collections
+from rackattack.stats import metrics
+
+
+OVERFLOW_POLICY_BLOCK = "block"
+OVERFLOW_POLICY_SPILL = "spill"
+OVERFLOW_POLICY_SHED = "shed"
+_SHED = object()
+# Spilled tasks are written to the spool in batches, since each write is synced to disk
+SPILL_BATCH_MAX_NR_TASKS = 1000
+SPILL_BATCH_MAX_AGE_NR_SECONDS = 1
+
+wait_durations = metrics.default_registry.histogram(
+    "rackattack_stats_task_wait_duration_seconds", "Time tasks waited in the queue until they were taken.")
+handling_durations = metrics.default_registry.histogram(
+    "rackattack_stats_task_handling_duration_seconds", "Time it took to handle tasks.")
+
+
+class TaskQueue:
+    """A FIFO queue of tasks, in which a task can replace a pending task of the same key.
+
+    put_latest(key, task) replaces the task given to the previous put_latest() with the same key, as long as
+    that task is still pending, and keeps its place in the queue. Otherwise the task is appended. A task
+    appended with put() is never replaced, and keeps its order relative to all other tasks: after it, a
+    put_latest() with its key (or with any key, if it has no key) appends a new task instead of replacing
+    one which is before it.
+
+    If max_size is given, a task which does not fit in the queue is handled by the overflow policy:
+    * block: wait until there is room.
+    * spill: append it to the spool (encoded by encode_func), after which new tasks are spooled as well,
+      until the spool is read back (decoded by decode_func) as the queue empties. Tasks for which
+      encode_func returns None are never spilled. Spilled tasks are batched in memory before they are
+      written; flush_spilled() writes the current batch (e.g. before the consumer stops).
+    * shed: drop it if it was given to put_latest(); Otherwise, drop the oldest pending task which was
+      given to put_latest() to make room for it, or wait if there is none.
+    Tasks put with unbounded=True are accepted regardless of max_size (e.g., control tasks put by the
+    consumer itself, which must never wait for itself).
+
+    get() and task_done() keep the time tasks waited in the queue and the time it took to handle them, and
+    export them as metrics.
+    """
+    def __init__(self, max_size=0, overflow_policy=OVERFLOW_POLICY_BLOCK, spool=None, encode_func=None,
+                 decode_func=None):
+        assert overflow_policy in (OVERFLOW_POLICY_BLOCK, OVERFLOW_POLICY_SPILL, OVERFLOW_POLICY_SHED)
+        assert overflow_policy != OVERFLOW_POLICY_SPILL or None not in (spool, encode_func, decode_func)
+        self._max_size = max_size
+        self._overflow_policy = overflow_policy
+        self._spool = spool
+        self._encode_func = encode_func
+        self._decode_func = decode_func
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._entries = collections.deque()
+        self._nr_entries = 0
+        self._latest_entries = dict()
+        self._sheddable_entries = collections.OrderedDict()
+        self._nr_spilled_entries = 0
+        self._spill_batch = list()
+        self._time_of_first_batched_spill = None
+        if spool is not None and not spool.is_empty():
+            # Left there by a previous run; The exact number is known only once they are read back
+            self._nr_spilled_entries = 1
+        self._time_of_last_get = None
+        self._nr_coalesced = 0
+        self._nr_processed = 0
+        self._nr_shed = 0
+        self._nr_spilled = 0
+        self._total_wait_time = 0.0
+        self._total_handling_time = 0.0
+        self._max_wait_time = 0.0
+        self._max_handling_time = 0.0
+        self._max_depth = 0
+
+    def put(self, task, block=True, timeout=None, key=None, unbounded=False):
+        with self._lock:
+            entry = [task, None, time.time()]
+            if unbounded:
+                self._append(entry)
+            else:
+                self._put_bounded(entry, block, timeout)
+            if key is None:
+                self._latest_entries.clear()
+            else:
+                self._latest_entries.pop(key, None)
+
+    def put_latest(self, key, task):
+        with self._lock:
+            entry = self._latest_entries.get(key)
+            if entry is not None:
+                entry[0] = task
+                self._nr_coalesced += 1
+                return
+            if self._overflow_policy == OVERFLOW_POLICY_SHED and self._is_full():
+                self._nr_shed += 1
+                return
+            self._put_bounded([task, key, time.time()], block=True, timeout=None)
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while True:
+                if not self._entries and self._nr_spilled_entries:
+                    self._unspill()
+                if self._entries:
+                    entry = self._entries.popleft()
+                    if entry[0] is not _SHED:
+                        break
+                    continue
+                if not block:
+                    raise Queue.Empty()
+                if deadline is None:
+                    self._not_empty.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Queue.Empty()
+                    self._not_empty.wait(remaining)
+            task, key, enqueue_time = entry
+            self._nr_entries -= 1
+            if key is not None:
+                if self._latest_entries.get(key) is entry:
+                    del self._latest_entries[key]
+                self._sheddable_entries.pop(id(entry), None)
+            self._not_full.notify()
+            now = time.time()
+            wait_time = now - enqueue_time
+            wait_durations.observe(wait_time)
+            self._total_wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+            self._time_of_last_get = now
+            self._nr_processed += 1
+            return task
+
+    def task_done(self):
+        """Called by the consumer once it is done handling the task it got last."""
+        with self._lock:
+            if self._time_of_last_get is None:
+                return
+            handling_time = time.time() - self._time_of_last_get
+            handling_durations.observe(handling_time)
+            self._total_handling_time += handling_time
+            self._max_handling_time = max(self._max_handling_time, handling_time)
+            self._time_of_last_get = None
+
+    def flush_spilled(self):
+        """Write the batch of spilled tasks to the spool."""
+        with self._lock:
+            self._write_spill_batch()
+
+    def qsize(self):
+        with self._lock:
+            return self._nr_entries + self._nr_spilled_entries
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def nr_coalesced(self):
+        return self._nr_coalesced
+
+    def nr_processed(self):
+        return self._nr_processed
+
+    def stats(self):
+        """Counters and totals since the queue was created, and maximal values since the last call."""
+        with self._lock:
+            stats = dict(depth=self._nr_entries,
+                         nr_spilled_pending=self._nr_spilled_entries,
+                         max_depth=self._max_depth,
+                         nr_processed=self._nr_processed,
+                         nr_coalesced=self._nr_coalesced,
+                         nr_shed=self._nr_shed,
+                         nr_spilled=self._nr_spilled,
+                         total_wait_time=self._total_wait_time,
+                         max_wait_time=self._max_wait_time,
+                         total_handling_time=self._total_handling_time,
+                         max_handling_time=self._max_handling_time)
+            self._max_depth = self._nr_entries
+            self._max_wait_time = 0.0
+            self._max_handling_time = 0.0
+        return stats
+
+    def _is_full(self):
+        return self._max_size and self._nr_entries >= self._max_size
+
+    def _put_bounded(self, entry, block, timeout):
+        # Once spilling started, new tasks must wait for the spilled ones to be handled first
+        if self._nr_spilled_entries and self._spill(entry):
+            return
+        deadline = None if timeout is None else time.time() + timeout
+        while self._is_full():
+            if self._overflow_policy == OVERFLOW_POLICY_SPILL and self._spill(entry):
+                return
+            if self._overflow_policy == OVERFLOW_POLICY_SHED and self._sheddable_entries:
+                self._shed_oldest_sheddable_entry()
+                continue
+            if not block:
+                raise Queue.Full()
+            if deadline is None:
+                self._not_full.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Queue.Full()
+                self._not_full.wait(remaining)
+        self._append(entry)
+
+    def _append(self, entry):
+        key = entry[1]
+        if key is not None:
+            self._latest_entries[key] = entry
+            self._sheddable_entries[id(entry)] = entry
+        self._entries.append(entry)
+        self._nr_entries += 1
+        self._max_depth = max(self._max_depth, self._nr_entries)
+        self._not_empty.notify()
+
+    def _shed_oldest_sheddable_entry(self):
+        _, entry = self._sheddable_entries.popitem(last=False)
+        if self._latest_entries.get(entry[1]) is entry:
+            del self._latest_entries[entry[1]]
+        entry[0] = _SHED
+        self._nr_entries -= 1
+        self._nr_shed += 1
+
+    def _spill(self, entry):
+        line = self._encode_func(entry[0])
+        if line is None:
+            return False
+        if not self._nr_spilled_entries:
+            logging.warn("The task queue is full; Spilling tasks to disk.")
+        # Spilled tasks are handled after the ones in memory, which must not be replaced by later ones
+        self._latest_entries.clear()
+        if not self._spill_batch:
+            self._time_of_first_batched_spill = time.time()
+        self._spill_batch.append(line)
+        if len(self._spill_batch) >= SPILL_BATCH_MAX_NR_TASKS or \
+                time.time() - self._time_of_first_batched_spill >= SPILL_BATCH_MAX_AGE_NR_SECONDS:
+            self._write_spill_batch()
+        self._nr_spilled_entries += 1
+        self._nr_spilled += 1
+        self._not_empty.notify()
+        return True
+
+    def _write_spill_batch(self):
+        if not self._spill_batch:
+            return
+        self._spool.append(self._spill_batch)
+        self._spill_batch = list()
+        self._time_of_first_batched_spill = None
+
+    def _unspill(self):
+        # The batch is written first, so that spilled tasks are read back in order
+        self._write_spill_batch()
+        lines = self._spool.take_oldest_segment()
+        now = time.time()
+        for line in lines:
+            self._append([self._decode_func(line), None, now])
+        if self._spool.is_empty():
+            self._nr_spilled_entries = 0
+            logging.info("All spilled tasks were taken back from disk.")
+        else:
+            self._nr_spilled_entries = max(self._nr_spilled_entries - len(lines), 1)
@@ -0,0 +1,55 @@
+import mock
+import time
+import logging
+import argparse
+from rackattack.stats.main_allocation_stats import AllocationsHandler
+from rackattack.stats.tests.test_allocations_handler import SubscribeMock, DBMock, AllocationsFlow
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Compare looking up the hosts of allocations by scanning "
+                                     "all tracked hosts with looking them up by the index of the handler")
+    parser.add_argument("--nr-allocations", type=int, default=150)
+    parser.add_argument("--nr-hosts-per-allocation", type=int, default=60)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.WARNING)
+    mgr = SubscribeMock()
+    tested = AllocationsHandler(mgr, DBMock(), mock.Mock(), max_nr_allocations=args.nr_allocations + 1)
+    flow = AllocationsFlow(tested, mgr)
+    allocation_ids = range(1, args.nr_allocations + 1)
+    for allocation_id in allocation_ids:
+        flow.allocate(allocation_id, ["host-{}-{}".format(allocation_id, host_nr)
+                                      for host_nr in xrange(args.nr_hosts_per_allocation)])
+    nr_tracked_hosts = len(tested._hosts_state)
+    assert nr_tracked_hosts == args.nr_allocations * args.nr_hosts_per_allocation, nr_tracked_hosts
+
+    def find_hosts_by_scanning(allocation_idx):
+        return [host_id for host_id, host in tested._hosts_state.iteritems()
+                if host.allocation_idx == allocation_idx]
+
+    def find_hosts_by_index(allocation_idx):
+        return list(tested._hosts_by_allocation[allocation_idx])
+
+    durations = dict()
+    for find_hosts in (find_hosts_by_scanning, find_hosts_by_index):
+        before = time.time()
+        for allocation_id in allocation_ids:
+            assert len(find_hosts(allocation_id)) == args.nr_hosts_per_allocation
+        durations[find_hosts.__name__] = time.time() - before
+    before = time.time()
+    for allocation_id in allocation_ids:
+        flow.kill(allocation_id)
+    death_duration = time.time() - before
+    assert not tested._hosts_state
+    print "Looking up the hosts of {} allocations out of {} tracked hosts: {:.4f}s by scanning, " \
+        "{:.4f}s by index. Handling all deaths took {:.4f}s.".format(
+            args.nr_allocations, nr_tracked_hosts, durations["find_hosts_by_scanning"],
+            durations["find_hosts_by_index"], death_duration)
+
+
+if __name__ == "__main__":
+    main()
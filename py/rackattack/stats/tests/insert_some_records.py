@@ -1,9 +1,12 @@
+import os
 import mock
 import copy
 import json
+import shutil
 import logging
 import unittest
 import greenlet
+import tempfile
 import threading
 import elasticsearch
 import rackattack
@@ -11,10 +14,13 @@ from rackattack.tcp import publish
 from rackattack.tcp import subscribe
 from rackattack.tests import mock_pika
 from rackattack.tests import one_threaded_publish
+from rackattack.stats import timerwheel
 from rackattack.stats.main_allocation_stats import AllocationsHandler
 
 
 logger = logging.getLogger()
+# Smaller than the production budget, to keep the test of too many open allocations short
+MAX_NR_ALLOCATIONS = 150
 
 
 class Host:
@@ -90,6 +96,9 @@ class ElasticsearchDBMock(object):
         self._records[id].update(update)
         self._event.set()
 
+    def flush(self):
+        return list()
+
     def get_records_by_order_of_creation(self):
         keys = self._records.keys()
         keys.sort()
@@ -244,7 +253,7 @@ class Test(unittest.TestCase):
         self.validate_open_registerations()
 
     def test_too_many_open_allocations(self):
-        for i in xrange(rackattack.stats.main_allocation_stats.MAX_NR_ALLOCATIONS):
+        for i in xrange(MAX_NR_ALLOCATIONS):
             req_msg = self.generate_allocation_request_message(nr_hosts=10)
             self.generate_allocation_request_flow(req_msg)
             alloc_msg = self.generate_allocation_creation_message_from_request_message(req_msg)
@@ -265,6 +274,121 @@ class Test(unittest.TestCase):
         self.validate_db()
         self.validate_open_registerations()
 
+    def test_host_indices_are_kept_across_restarts(self):
+        registry_dirpath = tempfile.mkdtemp()
+        try:
+            registry_path = os.path.join(registry_dirpath, "host-indices-registry.json")
+            hosts = self.available_hosts[:100]
+            tested = AllocationsHandler(mock.Mock(), self._db, mock.Mock(), registry_path)
+            indices = [tested._hostIndex(host_id) for host_id in hosts]
+            self.assertEquals(indices, range(len(hosts)))
+            self.assertEquals(tested._hostIndex(hosts[0]), 0)
+            tested = AllocationsHandler(mock.Mock(), self._db, mock.Mock(), registry_path)
+            self.assertEquals(tested._hostIndex(hosts[-1]), len(hosts) - 1)
+            self.assertEquals(tested._hostIndex("new_host"), len(hosts))
+        finally:
+            shutil.rmtree(registry_dirpath)
+
+    def test_open_allocations_are_restored_after_a_restart(self):
+        checkpoint_dirpath = tempfile.mkdtemp()
+        try:
+            subscription_mgr = mock.Mock()
+            tested = AllocationsHandler(subscription_mgr, self._db, mock.Mock(),
+                                        checkpoint_dirpath=checkpoint_dirpath)
+            for allocation_id, hosts in ((1, ["alpha", "bravo"]), (2, ["charlie"])):
+                message = self.generate_allocation_request_message(nr_hosts=len(hosts))
+                tested._all_allocations_handler(message)
+                allocated = dict(('node{}'.format(host_nr), host_id)
+                                 for host_nr, host_id in enumerate(hosts))
+                tested._all_allocations_handler(dict(event="created", allocationID=allocation_id,
+                                                     allocated=allocated))
+                tested._write_checkpoint()
+            tested._inauguration_handler(dict(id="alpha", status="done"))
+            tested._all_allocations_handler(dict(event="done", allocationID=1))
+            tested._write_checkpoint()
+            subscription_mgr = mock.Mock()
+            tested = AllocationsHandler(subscription_mgr, self._db, mock.Mock(),
+                                        checkpoint_dirpath=checkpoint_dirpath)
+            self.assertEquals(set(tested._allocation_subscriptions), set([1, 2]))
+            self.assertEquals(set(tested._hosts_state), set(["alpha", "bravo", "charlie"]))
+            self.assertTrue(tested._allocation_subscriptions[1].done)
+            self.assertEquals(len(tested._pending_requests), 0)
+            resubscribed = [call[0][0] for call in subscription_mgr.registerForInagurator.call_args_list]
+            self.assertEquals(sorted(resubscribed), ["bravo", "charlie"])
+            record_id = tested._allocation_subscriptions[1].record_id
+            tested._all_allocations_handler(dict(event="dead", allocationID=1, reason="freed"))
+            self.assertEquals(self._db._records[record_id]["highest_phase_reached"], "dead")
+            self.assertIn("test_duration", self._db._records[record_id])
+        finally:
+            shutil.rmtree(checkpoint_dirpath)
+
+    def create_allocation_directly(self, tested, allocation_id, hosts):
+        message = self.generate_allocation_request_message(nr_hosts=len(hosts))
+        tested._all_allocations_handler(message)
+        allocated = dict(('node{}'.format(host_nr), host_id) for host_nr, host_id in enumerate(hosts))
+        tested._all_allocations_handler(dict(event="created", allocationID=allocation_id,
+                                             allocated=allocated))
+        return tested._allocation_subscriptions[allocation_id].record_id
+
+    def test_idle_allocations_are_timed_out(self):
+        clock = mock.Mock(return_value=1000.0)
+        subscription_mgr = mock.Mock()
+        tested = AllocationsHandler(subscription_mgr, self._db, mock.Mock(), clock=clock,
+                                    max_allocation_idle_time=100)
+        idle_record_id = self.create_allocation_directly(tested, 1, ["alpha"])
+        self.create_allocation_directly(tested, 2, ["bravo"])
+        clock.return_value = 1050.0
+        tested._inauguration_handler(dict(id="bravo", status="done"))
+        clock.return_value = 1120.0
+        tested._evict_idle_allocations()
+        self.assertEquals(set(tested._allocation_subscriptions), set([2]))
+        self.assertEquals(self._db._records[idle_record_id]["highest_phase_reached"], "dead")
+        self.assertEquals(self._db._records[idle_record_id]["reason"], "timed out")
+        subscription_mgr.unregisterForInaugurator.assert_called_with("alpha")
+        clock.return_value = 1200.0
+        tested._evict_idle_allocations()
+        self.assertFalse(tested._allocation_subscriptions)
+        self.assertFalse(tested._hosts_state)
+
+    def test_the_least_recently_active_allocation_is_evicted_when_there_are_too_many(self):
+        tested = AllocationsHandler(mock.Mock(), self._db, mock.Mock(), max_nr_allocations=2)
+        self.create_allocation_directly(tested, 1, ["alpha"])
+        evicted_record_id = self.create_allocation_directly(tested, 2, ["bravo"])
+        tested._inauguration_handler(dict(id="alpha", status="progress",
+                                          progress=dict(state="fetching", chainGetCount=[1, 2])))
+        self.create_allocation_directly(tested, 3, ["charlie"])
+        self.assertEquals(set(tested._allocation_subscriptions), set([1, 3]))
+        self.assertEquals(self._db._records[evicted_record_id]["highest_phase_reached"], "dead")
+        self.assertNotIn("bravo", tested._hosts_state)
+
+    def test_stalled_inaugurations_and_allocations_are_reported(self):
+        clock = mock.Mock(return_value=1000.0)
+        timer_wheel = timerwheel.TimerWheel(clock=clock)
+        alert_func = mock.Mock()
+        tested = AllocationsHandler(mock.Mock(), self._db, mock.Mock(), clock=clock, timer_wheel=timer_wheel,
+                                    max_inauguration_time=60, max_time_until_done=120,
+                                    alert_func=alert_func)
+        record_id = self.create_allocation_directly(tested, 1, ["alpha", "bravo"])
+        clock.return_value = 1030.0
+        tested._inauguration_handler(dict(id="alpha", status="done"))
+        clock.return_value = 1061.0
+        timer_wheel.advance()
+        tested.handle_pending_tasks()
+        self.assertEquals(alert_func.call_count, 1)
+        self.assertIn("bravo", alert_func.call_args[0][0])
+        self.assertFalse(self._db._records[record_id]["done_deadline_exceeded"])
+        clock.return_value = 1121.0
+        timer_wheel.advance()
+        tested.handle_pending_tasks()
+        self.assertEquals(alert_func.call_count, 2)
+        self.assertTrue(self._db._records[record_id]["done_deadline_exceeded"])
+        tested._all_allocations_handler(dict(event="dead", allocationID=1, reason="freed"))
+        inaugurations = dict((record["host_id"], record) for record in self._db._records.itervalues()
+                             if record["_index"] == AllocationsHandler.INAUGURATIONS_INDEX)
+        self.assertFalse(inaugurations["alpha"]["inauguration_deadline_exceeded"])
+        self.assertTrue(inaugurations["bravo"]["inauguration_deadline_exceeded"])
+        self.assertEquals(len(timer_wheel), 0)
+
     def test_allocation_request(self):
         msg = self.generate_allocation_request_message(nr_hosts=10)
         self.generate_allocation_request_flow(msg)
@@ -490,7 +614,7 @@ class Test(unittest.TestCase):
         self.publish.allocationCreated(alloc_msg["allocationID"], allocated)
         self._continue_with_server()
         self.assertNotIn(allocation_id, self.uninaugurated_hosts_of_open_reported_allocations)
-        if self.open_allocations_count > rackattack.stats.main_allocation_stats.MAX_NR_ALLOCATIONS:
+        if self.open_allocations_count > MAX_NR_ALLOCATIONS:
             return
         if is_allocation_report_expected:
             uninaugurated = dict()
@@ -572,7 +696,8 @@ class Test(unittest.TestCase):
     def _generate_instance_with_mocked_event_loop(self):
         self._db = ElasticsearchDBMock()
         subscription_mgr = subscribe.Subscribe(mock_pika.DEFAULT_AMQP_URL)
-        instance = AllocationsHandler(subscription_mgr, self._db, mock.Mock())
+        instance = AllocationsHandler(subscription_mgr, self._db, mock.Mock(),
+                                      max_nr_allocations=MAX_NR_ALLOCATIONS)
 
         def queueGetWrapper(*args, **kwargs):
             if self.tested._tasks.qsize() > 0:
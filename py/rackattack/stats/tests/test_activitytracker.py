@@ -0,0 +1,30 @@
+import unittest
+from rackattack.stats import activitytracker
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tested = activitytracker.ActivityTracker()
+
+    def test_idle_keys(self):
+        self.tested.touch("alpha", 0)
+        self.tested.touch("bravo", 5)
+        self.tested.touch("charlie", 7)
+        self.tested.touch("alpha", 8)
+        self.assertEquals(self.tested.idle_keys(now=10, max_idle_time=3), ["bravo", "charlie"])
+        self.tested.remove("bravo")
+        self.assertEquals(self.tested.idle_keys(now=10, max_idle_time=3), ["charlie"])
+        self.assertEquals(self.tested.idle_keys(now=20, max_idle_time=3), ["charlie", "alpha"])
+        self.assertEquals(len(self.tested), 2)
+
+    def test_least_recently_active(self):
+        self.assertIsNone(self.tested.least_recently_active())
+        self.tested.touch("alpha", 0)
+        self.tested.touch("bravo", 1)
+        self.assertEquals(self.tested.least_recently_active(), "alpha")
+        self.tested.touch("alpha", 2)
+        self.assertEquals(self.tested.least_recently_active(), "bravo")
+
+
+if __name__ == '__main__':
+    unittest.main()
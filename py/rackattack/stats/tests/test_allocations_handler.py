@@ -0,0 +1,138 @@
+import mock
+import unittest
+from rackattack.stats import tracing
+from rackattack.stats.main_allocation_stats import AllocationsHandler
+
+
+class SubscribeMock(object):
+    def __init__(self):
+        self.all_allocations_callback = None
+        self.inaugurations_callbacks = dict()
+
+    def registerForAllAllocations(self, callback):
+        self.all_allocations_callback = callback
+
+    def registerForInagurator(self, host_id, callback):
+        assert host_id not in self.inaugurations_callbacks, host_id
+        self.inaugurations_callbacks[host_id] = callback
+
+    def unregisterForInaugurator(self, host_id):
+        del self.inaugurations_callbacks[host_id]
+
+
+class DBMock(object):
+    def __init__(self):
+        self.records = dict()
+
+    def create(self, index, doc_type, body, id=None):
+        record_id = len(self.records)
+        self.records[record_id] = dict(body, _index=index)
+        return dict(_id=record_id)
+
+    def update(self, index, doc_type, id, body):
+        self.records[id].update(body["doc"])
+
+    def flush(self):
+        return list()
+
+
+class AllocationsFlow:
+    """Feeds allocation events to a handler, and handles them in the calling thread."""
+    def __init__(self, tested, mgr):
+        self._tested = tested
+        self._mgr = mgr
+
+    def allocate(self, allocation_id, hosts):
+        requirements = dict(('node{}'.format(host_nr), dict(pool="default"))
+                            for host_nr in xrange(len(hosts)))
+        self._mgr.all_allocations_callback(dict(event="requested", requirements=requirements,
+                                                allocationInfo=dict(user="someone")))
+        allocated = dict(('node{}'.format(host_nr), host_id) for host_nr, host_id in enumerate(hosts))
+        self._mgr.all_allocations_callback(dict(event="created", allocationID=allocation_id,
+                                                allocated=allocated))
+        self._tested.handle_pending_tasks()
+
+    def inaugurate(self, host_id):
+        self._mgr.inaugurations_callbacks[host_id](dict(id=host_id, status="done"))
+        self._tested.handle_pending_tasks()
+
+    def kill(self, allocation_id):
+        self._mgr.all_allocations_callback(dict(event="dead", allocationID=allocation_id, reason="freed"))
+        self._tested.handle_pending_tasks()
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.mgr = SubscribeMock()
+        self.db = DBMock()
+        self.tested = AllocationsHandler(self.mgr, self.db, mock.Mock())
+        self.flow = AllocationsFlow(self.tested, self.mgr)
+
+    def test_the_hosts_of_each_allocation_are_indexed(self):
+        hosts = dict((allocation_id, set("host-{}-{}".format(allocation_id, host_nr)
+                                         for host_nr in xrange(3)))
+                     for allocation_id in xrange(1, 4))
+        for allocation_id, allocation_hosts in hosts.iteritems():
+            self.flow.allocate(allocation_id, sorted(allocation_hosts))
+        for allocation_id, allocation_hosts in hosts.iteritems():
+            self.assertEquals(self.tested._hosts_by_allocation[allocation_id], allocation_hosts)
+            self.assertEquals(self.tested._uninaugurated_hosts_by_allocation[allocation_id],
+                              allocation_hosts)
+        self.flow.inaugurate("host-1-0")
+        self.assertEquals(self.tested._hosts_by_allocation[1], hosts[1])
+        self.assertEquals(self.tested._uninaugurated_hosts_by_allocation[1], hosts[1] - set(["host-1-0"]))
+        # The death of an allocation releases its hosts only
+        self.flow.kill(2)
+        self.assertNotIn(2, self.tested._hosts_by_allocation)
+        self.assertNotIn(2, self.tested._uninaugurated_hosts_by_allocation)
+        self.assertEquals(set(self.tested._hosts_state), hosts[1] | hosts[3])
+        self.assertEquals(set(self.mgr.inaugurations_callbacks), (hosts[1] - set(["host-1-0"])) | hosts[3])
+        for allocation_id in (1, 3):
+            self.flow.kill(allocation_id)
+        self.assertFalse(self.tested._hosts_state)
+        self.assertFalse(self.tested._hosts_by_allocation)
+        self.assertFalse(self.tested._uninaugurated_hosts_by_allocation)
+        self.assertFalse(self.mgr.inaugurations_callbacks)
+
+    def test_a_host_reused_by_a_newer_allocation_is_released_from_the_older_one(self):
+        self.flow.allocate(1, ["alpha", "bravo"])
+        self.flow.allocate(2, ["bravo", "charlie"])
+        self.assertNotIn(1, self.tested._hosts_by_allocation)
+        self.assertEquals(self.tested._hosts_by_allocation[2], set(["bravo", "charlie"]))
+        self.assertEquals(set(self.tested._hosts_state), set(["bravo", "charlie"]))
+
+    def test_a_new_host_index_is_not_one_already_given(self):
+        self.tested._host_indices.update(alpha=0, charlie=2)
+        self.assertEquals(self.tested._hostIndex("bravo"), 3)
+        self.assertEquals(self.tested._hostIndex("alpha"), 0)
+
+    def test_a_traced_task_is_registered_before_it_can_be_taken_from_the_queue(self):
+        tracer = tracing.Tracer(10)
+        self.tested = AllocationsHandler(self.mgr, self.db, mock.Mock(), tracer=tracer)
+        self.flow = AllocationsFlow(self.tested, self.mgr)
+        put = self.tested._tasks.put
+
+        def put_and_validate_registration(task, *args, **kwargs):
+            self.assertIn(id(task), tracer._queued_spans)
+            return put(task, *args, **kwargs)
+        self.tested._tasks.put = put_and_validate_registration
+        self.flow.allocate(1, ["alpha"])
+        self.flow.inaugurate("alpha")
+        self.assertFalse(tracer._queued_spans)
+        self.assertEquals([span.name for span in tracer.spans()],
+                          ["allocations:requested", "allocations:created", "inaugurator:done"])
+
+    def test_the_least_recently_active_allocation_is_evicted_when_over_the_budget(self):
+        self.tested = AllocationsHandler(self.mgr, self.db, mock.Mock(), max_nr_allocations=2)
+        self.flow = AllocationsFlow(self.tested, self.mgr)
+        for allocation_id in xrange(1, 4):
+            self.flow.allocate(allocation_id, ["host-{}".format(allocation_id)])
+        self.assertEquals(set(self.tested._allocation_subscriptions), set([2, 3]))
+        allocations = dict((record["allocation_id"], record) for record in self.db.records.itervalues()
+                           if record["_index"] == AllocationsHandler.ALLOCATIONS_INDEX)
+        self.assertEquals(allocations[1]["highest_phase_reached"], "dead")
+        self.assertEquals(allocations[2]["highest_phase_reached"], "created")
+
+
+if __name__ == '__main__':
+    unittest.main()
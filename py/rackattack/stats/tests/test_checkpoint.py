@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+from rackattack.stats import checkpoint
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.tested = checkpoint.Checkpoint(self.dirpath, min_log_nr_bytes_to_compact=1000)
+
+    def tearDown(self):
+        self.tested.close()
+        shutil.rmtree(self.dirpath)
+
+    def reload(self):
+        self.tested.close()
+        self.tested = checkpoint.Checkpoint(self.dirpath, min_log_nr_bytes_to_compact=1000)
+        return self.tested.load()
+
+    def test_changes_are_loaded_after_a_restart(self):
+        self.assertEquals(self.tested.load(), dict())
+        self.tested.write([("a", 1), ("b", 2)])
+        self.tested.write([("a", None), ("c", [3])])
+        self.assertEquals(self.reload(), dict(b=2, c=[3]))
+
+    def test_compaction(self):
+        self.tested.load()
+        state = dict()
+        while not self.tested.should_compact():
+            key = len(state) % 10
+            state[key] = "x" * len(state)
+            self.tested.write([(key, state[key])])
+        self.tested.compact(state)
+        self.assertFalse(self.tested.should_compact())
+        self.assertEquals(os.path.getsize(os.path.join(self.dirpath, checkpoint.LOG_FILENAME)), 0)
+        self.tested.write([(0, None)])
+        del state[0]
+        self.assertEquals(self.reload(), state)
+
+    def test_a_partially_written_change_is_discarded(self):
+        self.tested.load()
+        self.tested.write([("a", 1)])
+        self.tested.close()
+        with open(os.path.join(self.dirpath, checkpoint.LOG_FILENAME), "ab") as log:
+            log.write("\x80\x02]q")
+        self.assertEquals(self.reload(), dict(a=1))
+        self.tested.write([("b", 2)])
+        self.assertEquals(self.reload(), dict(a=1, b=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
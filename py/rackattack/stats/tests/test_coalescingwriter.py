@@ -0,0 +1,83 @@
+import time
+import unittest
+from rackattack.stats import coalescingwriter
+
+
+class RecordingDBMock(object):
+    def __init__(self):
+        self.actions = list()
+
+    def create(self, index, doc_type, body, id):
+        self.actions.append(("create", id, body))
+        return dict(_id=id)
+
+    def update(self, index, doc_type, id, body):
+        self.actions.append(("update", id, body))
+
+    def flush(self):
+        return list()
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.db = RecordingDBMock()
+        self.tested = coalescingwriter.CoalescingWriter(self.db, window=1000)
+
+    def tearDown(self):
+        self.tested.close()
+
+    def test_a_created_and_updated_document_is_written_once_in_its_final_state(self):
+        record = dict(highest_phase_reached="requested", done=False)
+        result = self.tested.create(index="allocations", doc_type="allocation", body=record)
+        for phase in ("created", "done", "dead"):
+            record["highest_phase_reached"] = phase
+            self.tested.update(index="allocations", doc_type="allocation", id=result["_id"],
+                               body=dict(doc=record))
+        self.tested.flush()
+        self.assertEquals(self.db.actions, [])
+        self.tested.flush_all()
+        self.assertEquals(self.db.actions,
+                          [("create", result["_id"], dict(highest_phase_reached="dead", done=False))])
+        self.assertEquals(self.tested.nr_merged_writes(), 3)
+
+    def test_updates_contain_only_changed_fields(self):
+        record = dict(highest_phase_reached="requested", done=False, reason="Unknown")
+        self.tested.create(index="allocations", doc_type="allocation", body=record, id="a")
+        self.tested.flush_all()
+        record["highest_phase_reached"] = "done"
+        record["done"] = True
+        self.tested.update(index="allocations", doc_type="allocation", id="a", body=dict(doc=record))
+        self.tested.flush_all()
+        self.assertEquals(self.db.actions[-1],
+                          ("update", "a", dict(doc=dict(highest_phase_reached="done", done=True))))
+
+    def test_unchanged_updates_are_dropped(self):
+        record = dict(highest_phase_reached="requested")
+        self.tested.create(index="allocations", doc_type="allocation", body=record, id="a")
+        self.tested.flush_all()
+        self.tested.update(index="allocations", doc_type="allocation", id="a", body=dict(doc=record))
+        self.tested.flush_all()
+        self.assertEquals(len(self.db.actions), 1)
+
+    def test_a_field_changed_back_within_the_window_is_still_written(self):
+        self.tested.create(index="allocations", doc_type="allocation", body=dict(reason="a"), id="a")
+        self.tested.flush_all()
+        for reason in ("b", "a"):
+            self.tested.update(index="allocations", doc_type="allocation", id="a",
+                               body=dict(doc=dict(reason=reason)))
+        self.tested.flush_all()
+        self.assertEquals(self.db.actions[-1], ("update", "a", dict(doc=dict(reason="a"))))
+
+    def test_writes_are_emitted_once_the_window_passes(self):
+        self.tested.close()
+        self.tested = coalescingwriter.CoalescingWriter(self.db, window=0.05)
+        self.tested.create(index="allocations", doc_type="allocation", body=dict(), id="a")
+        for _ in xrange(100):
+            if self.db.actions:
+                break
+            time.sleep(0.01)
+        self.assertEquals(self.db.actions, [("create", "a", dict())])
+
+
+if __name__ == '__main__':
+    unittest.main()
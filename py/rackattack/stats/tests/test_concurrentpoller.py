@@ -0,0 +1,51 @@
+import time
+import unittest
+import threading
+from rackattack.stats import concurrentpoller
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tested = concurrentpoller.ConcurrentPoller(nr_threads=3, timeout=0.2)
+        self.release = threading.Event()
+        self.nr_slow_calls = 0
+
+    def tearDown(self):
+        self.release.set()
+        self.tested.close()
+
+    def slow(self):
+        self.nr_slow_calls += 1
+        self.release.wait()
+        return "slow"
+
+    def failing(self):
+        raise ValueError("failed")
+
+    def poll(self):
+        return self.tested.poll(dict(fast=lambda: "fast", slow=self.slow, failing=self.failing))
+
+    def test_a_slow_call_does_not_delay_the_others(self):
+        before = time.time()
+        results, errors, timed_out = self.poll()
+        self.assertLess(time.time() - before, 1)
+        self.assertEquals(results, dict(fast="fast"))
+        self.assertEquals(errors.keys(), ["failing"])
+        self.assertIn("ValueError: failed", errors["failing"])
+        self.assertEquals(timed_out, ["slow"])
+
+    def test_no_call_is_made_while_the_previous_one_did_not_return(self):
+        self.poll()
+        _, _, timed_out = self.poll()
+        self.assertEquals(timed_out, ["slow"])
+        self.assertEquals(self.nr_slow_calls, 1)
+        self.release.set()
+        time.sleep(0.05)
+        results, _, timed_out = self.poll()
+        self.assertEquals(results, dict(fast="fast", slow="slow"))
+        self.assertEquals(timed_out, [])
+        self.assertEquals(self.nr_slow_calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import time
+import unittest
+import threading
+from rackattack.stats import dbwriter
+
+
+class SlowDBMock(object):
+    def __init__(self):
+        self.actions = list()
+        self.nr_flushes = 0
+        self.release_event = threading.Event()
+        self.release_event.set()
+        self._lock = threading.Lock()
+
+    def create(self, index, doc_type, body, id):
+        self.release_event.wait()
+        if body.get("fail", False):
+            raise ValueError("Invalid document")
+        with self._lock:
+            self.actions.append(("create", id, body))
+        return dict(_id=id)
+
+    def update(self, index, doc_type, id, body):
+        self.release_event.wait()
+        time.sleep(0.001)
+        with self._lock:
+            self.actions.append(("update", id, body))
+
+    def flush(self):
+        with self._lock:
+            self.nr_flushes += 1
+            self.actions.append(("flush", None, None))
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.db = SlowDBMock()
+        self.tested = dbwriter.AsyncDBWriter(self.db, nr_workers=4, max_nr_in_flight=10)
+
+    def test_actions_on_the_same_document_stay_ordered(self):
+        for doc_idx in xrange(5):
+            self.tested.create(index="allocations", doc_type="allocation", body=dict(count=0),
+                               id=str(doc_idx))
+            for count in xrange(1, 20):
+                self.tested.update(index="allocations", doc_type="allocation", id=str(doc_idx),
+                                   body=dict(doc=dict(count=count)))
+        self.tested.join()
+        for doc_idx in xrange(5):
+            actions = [action for action in self.db.actions if action[1] == str(doc_idx)]
+            self.assertEquals(actions[0][0], "create")
+            counts = [action[2]["doc"]["count"] for action in actions[1:]]
+            self.assertEquals(counts, range(1, 20))
+
+    def test_create_returns_the_document_id_before_the_action_is_done(self):
+        self.db.release_event.clear()
+        result = self.tested.create(index="allocations", doc_type="allocation", body=dict())
+        self.assertEquals(self.db.actions, [])
+        self.db.release_event.set()
+        self.tested.join()
+        self.assertEquals(self.db.actions[0][1], result["_id"])
+
+    def test_callbacks(self):
+        results = list()
+
+        def callback(result, error):
+            results.append((result, error))
+        self.tested.create(index="allocations", doc_type="allocation", body=dict(), id="good",
+                           callback=callback)
+        self.tested.create(index="allocations", doc_type="allocation", body=dict(fail=True), id="bad",
+                           callback=callback)
+        self.tested.join()
+        results = dict((result["_id"] if error is None else "bad", error) for result, error in results)
+        self.assertIsNone(results["good"])
+        self.assertIsInstance(results["bad"], ValueError)
+
+    def test_submission_blocks_when_the_in_flight_window_is_full(self):
+        self.db.release_event.clear()
+        for idx in xrange(10):
+            self.tested.create(index="allocations", doc_type="allocation", body=dict(), id=str(idx))
+        submitter = threading.Thread(target=self.tested.create,
+                                     kwargs=dict(index="allocations", doc_type="allocation", body=dict()))
+        submitter.daemon = True
+        submitter.start()
+        submitter.join(0.1)
+        self.assertTrue(submitter.is_alive())
+        self.db.release_event.set()
+        submitter.join(1)
+        self.assertFalse(submitter.is_alive())
+        self.tested.join()
+        self.assertEquals(len(self.db.actions), 11)
+
+    def test_close_flushes_the_db(self):
+        self.tested.create(index="allocations", doc_type="allocation", body=dict())
+        self.tested.close()
+        self.assertEquals([action[0] for action in self.db.actions], ["create", "flush"])
+        self.assertEquals(self.db.nr_flushes, 1)
+
+    def test_the_db_is_flushed_once_after_the_actions_of_all_workers(self):
+        for doc_idx in xrange(20):
+            self.tested.update(index="allocations", doc_type="allocation", id=str(doc_idx),
+                               body=dict(doc=dict(count=1)))
+        self.tested.flush()
+        self.tested.join()
+        self.assertEquals(self.db.nr_flushes, 1)
+        self.assertEquals(self.db.actions[-1][0], "flush")
+        self.assertEquals(len(self.db.actions), 21)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+import json
+import shutil
+import tempfile
+import unittest
+import elasticsearch
+from rackattack.stats import spool
+from rackattack.stats import elasticsearchdbwrapper
+
+
+class BulkDBMock(object):
+    def __init__(self):
+        self.requests = list()
+        self.failed_ids = set()
+        self.throttled_ids = set()
+        self.is_reachable = True
+        self.is_rejecting_requests = False
+
+    def serialize(self, data):
+        return json.dumps(data)
+
+    def bulk(self, body):
+        if not self.is_reachable:
+            raise elasticsearch.ConnectionError("N/A", "DB is down", None)
+        if self.is_rejecting_requests:
+            raise elasticsearch.RequestError(400, "parse_exception", dict())
+        lines = body.splitlines()
+        self.requests.append(lines)
+        items = list()
+        for action_line in lines[::2]:
+            action = json.loads(action_line)
+            op_type, metadata = action.items()[0]
+            status = 201
+            if metadata["_id"] in self.failed_ids:
+                status = 400
+            elif metadata["_id"] in self.throttled_ids:
+                status = 429
+            items.append({op_type: dict(_id=metadata["_id"], status=status)})
+        errors = any(item.values()[0]["status"] >= 300 for item in items)
+        return dict(errors=errors, items=items)
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.db = BulkDBMock()
+        self.item_errors = list()
+        self.tested = elasticsearchdbwrapper.BulkWriter(self.db,
+                                                        max_nr_actions=3,
+                                                        max_nr_bytes=10 ** 6,
+                                                        max_age=10 ** 6,
+                                                        item_error_func=self._item_error_func)
+
+    def _item_error_func(self, action, result):
+        self.item_errors.append((action, result))
+
+    def test_actions_are_buffered_until_flush(self):
+        result = self.tested.create(index="states", doc_type="state_count", body=dict(count=1))
+        self.tested.update(index="states", doc_type="state_count", id=result["_id"],
+                           body=dict(doc=dict(count=2)))
+        self.assertEquals(self.db.requests, [])
+        self.assertEquals(self.tested.nr_pending_actions(), 2)
+        self.assertEquals(self.tested.flush(), [])
+        self.assertEquals(len(self.db.requests), 1)
+        lines = [json.loads(line) for line in self.db.requests[0]]
+        self.assertEquals(lines[0]["create"]["_id"], result["_id"])
+        self.assertEquals(lines[1], dict(count=1))
+        self.assertEquals(lines[2]["update"]["_id"], result["_id"])
+        self.assertEquals(lines[3], dict(doc=dict(count=2)))
+        self.assertEquals(self.tested.nr_pending_actions(), 0)
+
+    def test_flush_when_max_nr_actions_is_reached(self):
+        for _ in xrange(7):
+            self.tested.create(index="pools", doc_type="pool_count", body=dict(count=1))
+        self.assertEquals(len(self.db.requests), 2)
+        self.assertEquals(self.tested.nr_pending_actions(), 1)
+
+    def test_flush_when_max_nr_bytes_is_reached(self):
+        self.tested = elasticsearchdbwrapper.BulkWriter(self.db, max_nr_bytes=100, max_age=10 ** 6)
+        self.tested.create(index="pools", doc_type="pool_count", body=dict(comment="x" * 100))
+        self.assertEquals(len(self.db.requests), 1)
+
+    def test_flush_when_oldest_action_is_too_old(self):
+        self.tested = elasticsearchdbwrapper.BulkWriter(self.db, max_age=0)
+        self.tested.create(index="pools", doc_type="pool_count", body=dict(count=1))
+        self.assertEquals(len(self.db.requests), 1)
+
+    def test_errors_are_reported_per_item(self):
+        self.db.failed_ids.add("bad")
+        self.tested.create(index="pools", doc_type="pool_count", body=dict(count=1), id="good")
+        self.tested.create(index="pools", doc_type="pool_count", body=dict(count=2), id="bad")
+        failures = self.tested.flush()
+        self.assertEquals(len(failures), 1)
+        action, result = failures[0]
+        self.assertEquals(action["create"]["_id"], "bad")
+        self.assertEquals(result["status"], 400)
+        self.assertEquals(self.item_errors, failures)
+
+    def test_actions_are_kept_when_the_request_fails(self):
+        def failing_bulk(body):
+            raise IOError("DB is down")
+        original_bulk = self.db.bulk
+        self.db.bulk = failing_bulk
+        self.tested.create(index="pools", doc_type="pool_count", body=dict(count=1))
+        self.assertRaises(IOError, self.tested.flush)
+        self.assertEquals(self.tested.nr_pending_actions(), 1)
+        self.db.bulk = original_bulk
+        self.tested.flush()
+        self.assertEquals(len(self.db.requests), 1)
+
+    def test_actions_are_spooled_while_the_db_is_unreachable(self):
+        spool_dirpath = tempfile.mkdtemp()
+        try:
+            self.tested = elasticsearchdbwrapper.BulkWriter(self.db, spool=spool.Spool(spool_dirpath))
+            self.db.is_reachable = False
+            for count in xrange(3):
+                self.tested.create(index="pools", doc_type="pool_count", body=dict(count=count))
+                self.assertEquals(self.tested.flush(), [])
+                self.assertFalse(self.tested.is_db_available())
+                elasticsearchdbwrapper.DB_RECONNECTION_ATTEMPTS_INTERVAL = 0
+            self.assertEquals(self.tested.nr_pending_actions(), 0)
+            self.db.is_reachable = True
+            self.tested.create(index="pools", doc_type="pool_count", body=dict(count=3))
+            self.tested.flush()
+            self.assertTrue(self.tested.is_db_available())
+            sources = [json.loads(line) for request in self.db.requests for line in request[1::2]]
+            self.assertEquals(sources, [dict(count=count) for count in xrange(4)])
+            self.assertTrue(spool.Spool(spool_dirpath).is_empty())
+        finally:
+            elasticsearchdbwrapper.DB_RECONNECTION_ATTEMPTS_INTERVAL = 60
+            shutil.rmtree(spool_dirpath)
+
+    def test_spooled_actions_survive_a_restart(self):
+        spool_dirpath = tempfile.mkdtemp()
+        try:
+            self.tested = elasticsearchdbwrapper.BulkWriter(self.db, spool=spool.Spool(spool_dirpath))
+            self.db.is_reachable = False
+            self.tested.create(index="pools", doc_type="pool_count", body=dict(count=1), id="first")
+            self.tested.flush()
+            self.db.is_reachable = True
+            self.tested = elasticsearchdbwrapper.BulkWriter(self.db, spool=spool.Spool(spool_dirpath))
+            self.tested.create(index="pools", doc_type="pool_count", body=dict(count=2), id="second")
+            self.tested.flush()
+            ids = [json.loads(request[0])["create"]["_id"] for request in self.db.requests]
+            self.assertEquals(ids, ["first", "second"])
+        finally:
+            shutil.rmtree(spool_dirpath)
+
+    def test_spooled_actions_which_were_throttled_are_kept_in_the_spool(self):
+        spool_dirpath = tempfile.mkdtemp()
+        try:
+            self.tested = elasticsearchdbwrapper.BulkWriter(self.db, spool=spool.Spool(spool_dirpath))
+            self.db.is_reachable = False
+            for id in ("first", "second", "third"):
+                self.tested.create(index="pools", doc_type="pool_count", body=dict(count=1), id=id)
+            self.tested.flush()
+            self.db.is_reachable = True
+            self.db.throttled_ids.add("second")
+            self.db.failed_ids.add("third")
+            self.tested = elasticsearchdbwrapper.BulkWriter(self.db, spool=spool.Spool(spool_dirpath))
+            self.tested.flush()
+            self.assertFalse(self.tested.is_db_available())
+            self.assertFalse(spool.Spool(spool_dirpath).is_empty())
+            self.db.throttled_ids.clear()
+            self.tested = elasticsearchdbwrapper.BulkWriter(self.db, spool=spool.Spool(spool_dirpath))
+            self.tested.flush()
+            self.assertTrue(spool.Spool(spool_dirpath).is_empty())
+            ids = [[json.loads(line)["create"]["_id"] for line in request[::2]]
+                   for request in self.db.requests]
+            self.assertEquals(ids, [["first", "second", "third"], ["first", "second", "third"]])
+        finally:
+            shutil.rmtree(spool_dirpath)
+
+    def test_actions_of_a_request_which_the_db_rejected_are_reported_and_dropped(self):
+        self.db.is_rejecting_requests = True
+        self.tested.create(index="pools", doc_type="pool_count", body=dict(count=1), id="first")
+        self.tested.create(index="pools", doc_type="pool_count", body=dict(count=2), id="second")
+        failures = self.tested.flush()
+        self.assertEquals([action["create"]["_id"] for action, _ in failures], ["first", "second"])
+        self.assertEquals([result["status"] for _, result in failures], [400, 400])
+        self.assertEquals(self.item_errors, failures)
+        self.assertEquals(self.tested.nr_pending_actions(), 0)
+        self.db.is_rejecting_requests = False
+        self.tested.create(index="pools", doc_type="pool_count", body=dict(count=3), id="third")
+        self.assertEquals(self.tested.flush(), [])
+        ids = [[json.loads(line)["create"]["_id"] for line in request[::2]] for request in self.db.requests]
+        self.assertEquals(ids, [["third"]])
+
+    def test_a_spooled_segment_which_the_db_rejected_is_dropped(self):
+        spool_dirpath = tempfile.mkdtemp()
+        try:
+            self.tested = elasticsearchdbwrapper.BulkWriter(self.db, spool=spool.Spool(spool_dirpath))
+            self.db.is_reachable = False
+            self.tested.create(index="pools", doc_type="pool_count", body=dict(count=1), id="first")
+            self.tested.flush()
+            self.db.is_reachable = True
+            self.db.is_rejecting_requests = True
+            self.tested = elasticsearchdbwrapper.BulkWriter(self.db, spool=spool.Spool(spool_dirpath))
+            self.tested.flush()
+            self.assertTrue(self.tested.is_db_available())
+            self.assertTrue(spool.Spool(spool_dirpath).is_empty())
+        finally:
+            shutil.rmtree(spool_dirpath)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+from rackattack.stats import hostcounts
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.hosts = [dict(id="alpha", state="ONLINE", pool="default"),
+                      dict(id="bravo", state="ONLINE", pool="default"),
+                      dict(id="charlie", state="OFFLINE", pool="default"),
+                      dict(id="delta", state="ONLINE", pool="private"),
+                      dict(id="echo", state="OFFLINE")]
+
+    def test_count_hosts(self):
+        counts = hostcounts.count_hosts(self.hosts, [("state",), ("pool",), ("state", "pool")])
+        self.assertEquals(counts[("state",)], {("ONLINE",): 3, ("OFFLINE",): 2})
+        self.assertEquals(counts[("pool",)], {("default",): 3, ("private",): 1, (None,): 1})
+        self.assertEquals(counts[("state", "pool")], {("ONLINE", "default"): 2, ("OFFLINE", "default"): 1,
+                                                      ("ONLINE", "private"): 1, ("OFFLINE", None): 1})
+
+    def test_to_records(self):
+        counts = hostcounts.count_hosts(self.hosts, [("state", "pool")])
+        records = hostcounts.to_records(counts, date="now")
+        self.assertEquals(len(records), 4)
+        self.assertIn(dict(dimension="state+pool", state="ONLINE", pool="default", count=2, date="now"),
+                      records)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import datetime
+import unittest
+from rackattack.stats import hostintervals
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tested = hostintervals.HostIntervals()
+        self.hosts = dict(alpha=dict(id="alpha", state="ONLINE", pool="default"),
+                          bravo=dict(id="bravo", state="ONLINE", pool="default"))
+
+    def sample(self, minute):
+        date = datetime.datetime(2016, 1, 1, 0, minute)
+        records = self.tested.sample(self.hosts.values(), date)
+        return [(record["host_id"], record["state"], record["start"].minute, record["end"].minute,
+                 record["duration"], record["partial"]) for record in records]
+
+    def test_intervals(self):
+        self.assertFalse(self.tested.has_previous_sample())
+        self.assertEquals(self.sample(0), [])
+        self.assertTrue(self.tested.has_previous_sample())
+        self.hosts["alpha"]["state"] = "OFFLINE"
+        self.assertEquals(self.sample(1), [("alpha", "ONLINE", 0, 1, 60, True)])
+        self.hosts["charlie"] = dict(id="charlie", state="ONLINE", pool="default")
+        self.assertEquals(self.sample(2), [])
+        self.hosts["alpha"]["state"] = "ONLINE"
+        self.hosts["charlie"]["pool"] = "private"
+        self.assertEquals(self.sample(5), [("alpha", "OFFLINE", 1, 5, 240, False),
+                                           ("charlie", "ONLINE", 2, 5, 180, False)])
+        del self.hosts["bravo"]
+        self.assertEquals(self.sample(6), [("bravo", "ONLINE", 0, 6, 360, True)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from rackattack.stats import hostsnapshots
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tested = hostsnapshots.HostSnapshots(keyframe_interval=3)
+        self.hosts = dict(alpha=dict(id="alpha", state="ONLINE", pool="default"),
+                          bravo=dict(id="bravo", state="ONLINE", pool="default"))
+        self.written = list()
+
+    def sample(self, date):
+        records = self.tested.sample(self.hosts.values(), date)
+        self.written.extend(records)
+        return records
+
+    def test_only_changed_hosts_are_written_between_keyframes(self):
+        records = self.sample(1)
+        self.assertEquals([(record["host_id"], record["keyframe"]) for record in records],
+                          [("alpha", True), ("bravo", True)])
+        self.assertEquals(self.sample(2), [])
+        self.hosts["bravo"]["state"] = "OFFLINE"
+        self.hosts["charlie"] = dict(id="charlie", state="ONLINE", pool="private")
+        del self.hosts["alpha"]
+        records = self.sample(3)
+        self.assertEquals([(record["host_id"], record["state"], record["removed"]) for record in records],
+                          [("bravo", "OFFLINE", False), ("charlie", "ONLINE", False), ("alpha", None, True)])
+        records = self.sample(4)
+        self.assertEquals(sorted(record["host_id"] for record in records if record["keyframe"]),
+                          ["bravo", "charlie"])
+
+    def test_rebuild(self):
+        self.sample(1)
+        self.hosts["bravo"]["state"] = "OFFLINE"
+        self.sample(2)
+        del self.hosts["alpha"]
+        self.sample(3)
+        self.assertEquals(hostsnapshots.rebuild([record for record in self.written if record["date"] <= 2]),
+                          dict(alpha=dict(state="ONLINE", pool="default"),
+                               bravo=dict(state="OFFLINE", pool="default")))
+        self.sample(4)
+        self.hosts["alpha"] = dict(id="alpha", state="ONLINE", pool="default")
+        self.sample(5)
+        self.assertEquals(hostsnapshots.rebuild(self.written),
+                          dict(alpha=dict(state="ONLINE", pool="default"),
+                               bravo=dict(state="OFFLINE", pool="default")))
+        self.assertEquals(hostsnapshots.rebuild([record for record in self.written if record["date"] <= 4]),
+                          dict(bravo=dict(state="OFFLINE", pool="default")))
+
+    def test_reset_writes_a_keyframe(self):
+        self.sample(1)
+        self.tested.reset()
+        self.assertEquals(len(self.sample(2)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import mock
+import shutil
+import tempfile
+import unittest
+from rackattack.stats import journal
+from rackattack.stats import replay_allocations_journal
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_recorded_messages_are_read_in_order(self):
+        tested = journal.Journal(self.dirpath, max_segment_nr_bytes=200)
+        for idx in xrange(20):
+            tested.record("allocations", dict(event="requested", idx=idx))
+        tested.close()
+        self.assertGreater(len(journal.list_segments(self.dirpath)), 1)
+        entries = list(journal.read(self.dirpath))
+        self.assertEquals([message["idx"] for _, _, message in entries], range(20))
+        self.assertEquals(set(kind for _, kind, _ in entries), set(["allocations"]))
+        timestamps = [timestamp for timestamp, _, _ in entries]
+        self.assertEquals(timestamps, sorted(timestamps))
+
+    def test_only_the_newest_segments_are_kept(self):
+        tested = journal.Journal(self.dirpath, max_segment_nr_bytes=1, max_nr_segments=3)
+        for idx in xrange(10):
+            tested.record("allocations", dict(idx=idx))
+        tested.close()
+        self.assertEquals(len(journal.list_segments(self.dirpath)), 3)
+        self.assertEquals([message["idx"] for _, _, message in journal.read(self.dirpath)], [7, 8, 9])
+
+    def test_a_segment_which_was_not_closed_is_read_until_its_end(self):
+        tested = journal.Journal(self.dirpath)
+        tested.record("inaugurator", dict(id="alpha", status="done"))
+        segment_filepath = journal.list_segments(self.dirpath)[0]
+        with open(segment_filepath, "rb") as segment:
+            data = segment.read()
+        tested.close()
+        with open(segment_filepath, "wb") as segment:
+            segment.write(data)
+        self.assertEquals([message for _, _, message in journal.read(self.dirpath)],
+                          [dict(id="alpha", status="done")])
+
+    def record_allocation(self):
+        tested = journal.Journal(self.dirpath)
+        requirements = dict(node0=dict(pool="default"), node1=dict(pool="default"))
+        tested.record("allocations", dict(event="requested", requirements=requirements,
+                                          allocationInfo=dict(user="someone")))
+        tested.record("allocations", dict(event="created", allocationID=1,
+                                          allocated=dict(node0="alpha", node1="bravo")))
+        tested.record("inaugurator", dict(id="alpha", status="done"))
+        tested.record("inaugurator", dict(id="charlie", status="done"))
+        tested.record("allocations", dict(event="done", allocationID=1))
+        tested.record("allocations", dict(event="dead", allocationID=1, reason="freed"))
+        tested.close()
+
+    def test_replay(self):
+        self.record_allocation()
+        db = replay_allocations_journal.NullDB()
+        nr_messages, _ = replay_allocations_journal.replay(self.dirpath, db)
+        self.assertEquals(nr_messages, 6)
+        # The allocation record, and an inauguration record for each host
+        self.assertEquals(db.nr_creates, 3)
+        self.assertEquals(db.nr_updates, 3)
+
+    def test_replays_write_the_same_documents_to_the_indices_of_the_suffix(self):
+        self.record_allocation()
+        writes = list()
+        for _ in xrange(2):
+            db = mock.Mock()
+            db.create.side_effect = lambda index, doc_type, body, id: dict(_index=index, _id=id)
+            target_db = replay_allocations_journal.ReplayTargetDB(db, "v2")
+            replay_allocations_journal.replay(self.dirpath, target_db)
+            writes.append(sorted((call[1]["index"], call[1]["id"])
+                                 for call in db.create.call_args_list + db.update.call_args_list))
+        self.assertEquals(writes[0], writes[1])
+        self.assertEquals(set(index for index, _ in writes[0]),
+                          set(["allocations_3_v2", "inaugurations_4_v2"]))
+        self.assertIn(("allocations_3_v2", "replay-0"), writes[0])
+
+    def test_an_index_suffix_is_required(self):
+        self.assertRaises(ValueError, replay_allocations_journal.ReplayTargetDB, mock.Mock(), "")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import urllib2
+import unittest
+from rackattack.stats import metrics
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_counters_and_gauges(self):
+        events = self.registry.counter("events_total", "Handled events.", label_names=("type",))
+        events.labels("done").inc()
+        events.labels("dead").inc(2)
+        events.labels("done").inc()
+        depth = self.registry.gauge("depth", "Queue depth.")
+        depth.set(3)
+        depth.dec()
+        nr_items = [7]
+        self.registry.gauge("items", "Items.").set_function(lambda: nr_items[0])
+        self.assertIs(self.registry.counter("events_total", "Handled events."), events)
+        self.assertEquals(self.registry.render().splitlines(),
+                          ['# HELP depth Queue depth.',
+                           '# TYPE depth gauge',
+                           'depth 2.0',
+                           '# HELP events_total Handled events.',
+                           '# TYPE events_total counter',
+                           'events_total{type="dead"} 2.0',
+                           'events_total{type="done"} 2.0',
+                           '# HELP items Items.',
+                           '# TYPE items gauge',
+                           'items 7.0'])
+
+    def test_histogram(self):
+        durations = self.registry.histogram("duration_seconds", "Durations.", buckets=(1, 10))
+        for value in (0.5, 1, 5, 20):
+            durations.observe(value)
+        self.assertEquals(self.registry.render().splitlines()[2:],
+                          ['duration_seconds_bucket{le="1.0"} 2',
+                           'duration_seconds_bucket{le="10.0"} 3',
+                           'duration_seconds_bucket{le="+Inf"} 4',
+                           'duration_seconds_sum 26.5',
+                           'duration_seconds_count 4'])
+
+    def test_label_values_are_escaped(self):
+        self.registry.counter("errors_total", "Errors.", label_names=("message",)).labels('a "b"\n').inc()
+        self.assertIn('errors_total{message="a \\"b\\"\\n"} 1.0', self.registry.render())
+
+    def test_server(self):
+        self.registry.counter("requests_total", "Requests.").inc()
+        server = metrics.MetricsServer(self.registry, port=0)
+        server.start()
+        try:
+            response = urllib2.urlopen("http://127.0.0.1:{}/metrics".format(server.port), timeout=10)
+            self.assertEquals(response.info()["Content-Type"], metrics.CONTENT_TYPE)
+            self.assertIn("requests_total 1.0\n", response.read())
+            with self.assertRaises(urllib2.HTTPError):
+                urllib2.urlopen("http://127.0.0.1:{}/other".format(server.port), timeout=10)
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
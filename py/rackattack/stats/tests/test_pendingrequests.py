@@ -0,0 +1,72 @@
+import unittest
+from rackattack.stats import pendingrequests
+from rackattack.stats import allocationstate
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tested = pendingrequests.PendingRequests(ttl=10)
+        self.nr_requests = 0
+
+    def request(self, user, nr_nodes=2, timestamp=0):
+        requirements = dict(('node{}'.format(node_nr), dict(pool="default")) for node_nr in xrange(nr_nodes))
+        allocation = allocationstate.AllocationState(dict(user=user), requirements, timestamp)
+        allocation.record_id = self.nr_requests
+        self.nr_requests += 1
+        self.tested.add(allocation)
+        return allocation
+
+    def created_message(self, nr_nodes=2, **kwargs):
+        allocated = dict(('node{}'.format(node_nr), 'host{}'.format(node_nr))
+                         for node_nr in xrange(nr_nodes))
+        return dict(kwargs, event="created", allocationID=1, allocated=allocated)
+
+    def test_overlapping_requests_are_matched_by_their_contents(self):
+        first = self.request("alice")
+        second = self.request("bob")
+        third = self.request("alice")
+        requirements = dict(node0=dict(pool="default"), node1=dict(pool="default"))
+        message = self.created_message(requirements=requirements, allocationInfo=dict(user="alice"))
+        self.assertIs(self.tested.pop_created(message), first)
+        self.assertIs(self.tested.pop_created(message), third)
+        self.assertIsNone(self.tested.pop_created(message))
+        self.assertEquals(self.tested.allocations(), [second])
+        self.assertEquals(len(self.tested), 1)
+
+    def test_creation_messages_without_the_request_contents_are_matched_by_node_names(self):
+        first = self.request("alice", nr_nodes=2)
+        second = self.request("bob", nr_nodes=3)
+        self.assertIs(self.tested.pop_created(self.created_message(nr_nodes=3)), second)
+        self.assertIsNone(self.tested.pop_created(self.created_message(nr_nodes=3)))
+        self.assertIs(self.tested.pop_created(self.created_message(nr_nodes=2)), first)
+        self.assertEquals(len(self.tested), 0)
+
+    def test_rejection_messages_without_the_request_contents_are_matched_with_the_oldest_request(self):
+        first = self.request("alice")
+        second = self.request("bob")
+        self.assertIs(self.tested.pop_rejected(dict(event="rejected", reason="no hosts")), first)
+        self.assertIsNone(self.tested.get(first.record_id))
+        self.assertIs(self.tested.get(second.record_id), second)
+        self.assertIs(self.tested.pop_created(self.created_message()), second)
+        self.assertIsNone(self.tested.pop_rejected(dict(event="rejected", reason="no hosts")))
+        self.assertEquals(len(self.tested), 0)
+
+    def test_a_rejection_skips_requests_which_were_already_created(self):
+        first = self.request("alice", nr_nodes=2)
+        second = self.request("bob", nr_nodes=3)
+        self.assertIs(self.tested.pop_created(self.created_message(nr_nodes=2)), first)
+        self.assertIs(self.tested.pop_rejected(dict(event="rejected", reason="no hosts")), second)
+        self.assertEquals(len(self.tested), 0)
+
+    def test_requests_which_were_not_matched_in_time_expire(self):
+        first = self.request("alice", timestamp=0)
+        second = self.request("bob", timestamp=5)
+        self.assertEquals(self.tested.expire(now=9), [])
+        self.assertEquals(self.tested.expire(now=12), [first])
+        self.assertIs(self.tested.pop_created(self.created_message()), second)
+        self.assertEquals(self.tested.expire(now=100), [])
+        self.assertEquals(len(self.tested), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
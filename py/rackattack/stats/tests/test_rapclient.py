@@ -0,0 +1,92 @@
+import mock
+import socket
+import unittest
+from rackattack.stats import rapclient
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = list()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, duration):
+        self.sleeps.append(duration)
+        self.now += duration
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.clients = list()
+        self.factory = mock.Mock(side_effect=self.create_client)
+        self.tested = rapclient.ReconnectingClient(self.factory, min_backoff=1, max_backoff=10,
+                                                   clock=self.clock.time, sleep=self.clock.sleep,
+                                                   random_func=lambda: 1.0)
+
+    def create_client(self):
+        client = mock.Mock()
+        self.clients.append(client)
+        return client
+
+    def test_a_single_client_is_kept_while_it_is_alive(self):
+        self.tested.connect()
+        self.tested.call("admin__queryStatus")
+        self.tested.connect()
+        self.tested.call("admin__queryStatus")
+        self.assertEquals(len(self.clients), 1)
+        self.assertEquals(self.clients[0].call.call_count, 2)
+
+    def test_reconnection_after_a_connection_error(self):
+        self.tested.connect()
+        self.clients[0].call.side_effect = socket.error("Connection reset by peer")
+        self.assertRaises(socket.error, self.tested.call, "admin__queryStatus")
+        self.assertTrue(self.clients[0].close.called)
+        self.assertEquals(self.tested.time_until_next_attempt(), 1)
+        self.tested.call("admin__queryStatus")
+        self.assertEquals(len(self.clients), 2)
+        self.assertEquals(self.clock.sleeps, [1])
+
+    def test_only_established_connections_are_counted_as_lost(self):
+        lost_connections = rapclient.lost_connections.labels("default")
+        nr_lost_connections = lost_connections.value()
+        self.tested.connect()
+        self.clients[0].call.side_effect = socket.error("Connection reset by peer")
+        self.assertRaises(socket.error, self.tested.call, "admin__queryStatus")
+        self.factory.side_effect = socket.error("Connection refused")
+        for _ in xrange(3):
+            self.assertRaises(socket.error, self.tested.connect)
+        self.assertEquals(lost_connections.value(), nr_lost_connections + 1)
+
+    def test_exponential_backoff(self):
+        self.factory.side_effect = socket.error("Connection refused")
+        for expected_backoff in (1, 2, 4, 8, 10, 10):
+            self.assertRaises(socket.error, self.tested.connect)
+            self.assertEquals(self.tested.time_until_next_attempt(), expected_backoff)
+        self.assertEquals(self.clock.sleeps, [1, 2, 4, 8, 10])
+        self.factory.side_effect = self.create_client
+        self.tested.connect()
+        self.assertEquals(self.tested.time_until_next_attempt(), 0)
+
+    def test_a_dead_socket_is_detected_before_a_call(self):
+        sockets = dict()
+
+        def socket_of(client):
+            return sockets.setdefault(client, socket.socketpair())[0]
+        self.tested = rapclient.ReconnectingClient(self.factory, socket_func=socket_of,
+                                                   clock=self.clock.time, sleep=self.clock.sleep)
+        self.tested.connect()
+        self.assertTrue(self.tested.is_alive())
+        sockets[self.clients[0]][1].close()
+        self.assertFalse(self.tested.is_alive())
+        self.tested.connect()
+        self.assertEquals(len(self.clients), 2)
+        for pair in sockets.itervalues():
+            for sock in pair:
+                sock.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
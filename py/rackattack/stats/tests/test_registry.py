@@ -0,0 +1,41 @@
+import os
+import mock
+import shutil
+import unittest
+import tempfile
+from rackattack.stats import registry
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.dirpath, "registry.yaml")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_flushed_entries_are_read_after_a_restart(self):
+        tested = registry.Registry(self.filepath)
+        tested.write("alpha", 0)
+        tested.write("bravo", 1)
+        tested.flush()
+        self.assertEquals(registry.Registry(self.filepath).read_all(), dict(alpha=0, bravo=1))
+        self.assertEquals(os.listdir(self.dirpath), ["registry.yaml"])
+
+    def test_a_flush_interrupted_while_writing_keeps_the_previous_content(self):
+        tested = registry.Registry(self.filepath)
+        tested.write("alpha", 0)
+        tested.write("bravo", 1)
+        tested.flush()
+        tested.write("charlie", 2)
+
+        def dump_partially(data, storage_file):
+            storage_file.write("alpha: 0\n")
+            raise IOError("No space left on device")
+        with mock.patch.object(registry.yaml, "dump", side_effect=dump_partially):
+            self.assertRaises(IOError, tested.flush)
+        self.assertEquals(registry.Registry(self.filepath).read_all(), dict(alpha=0, bravo=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
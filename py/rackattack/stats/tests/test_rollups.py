@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+from rackattack.stats import rollups
+from rackattack.stats import registry
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.registry_path = os.path.join(self.dirpath, "rollups.json")
+        self.tested = self.create()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def create(self):
+        return rollups.Rollups(registry.Registry(self.registry_path),
+                               windows=((5 * 60, "5m"), (60 * 60, "1h")))
+
+    def records_by_index(self, records):
+        result = dict()
+        for index, _, record in records:
+            result.setdefault(index, list()).append(record)
+        return result
+
+    def test_windows(self):
+        self.assertEquals(self.tested.add(0, dict(state=dict(ONLINE=4), pool=dict(default=4))), [])
+        self.assertEquals(self.tested.add(60, dict(state=dict(ONLINE=2, OFFLINE=2), pool=dict(default=4))),
+                          [])
+        self.assertEquals(self.tested.add(120, dict(state=dict(ONLINE=3), pool=dict(default=3))), [])
+        records = self.records_by_index(self.tested.add(300, dict(state=dict(ONLINE=4),
+                                                                  pool=dict(default=4))))
+        self.assertEquals(sorted(records), ["pools_5m", "states_5m"])
+        self.assertEquals(records["states_5m"],
+                          [dict(state="OFFLINE", date=0, window_nr_seconds=300, nr_samples=3,
+                                min=0, max=2, avg=2 / 3.0, last=0),
+                           dict(state="ONLINE", date=0, window_nr_seconds=300, nr_samples=3,
+                                min=2, max=4, avg=3.0, last=3)])
+        records = self.records_by_index(self.tested.add(3600, dict(state=dict(ONLINE=1))))
+        self.assertEquals(sorted(records), ["pools_1h", "pools_5m", "states_1h", "states_5m"])
+        self.assertEquals([(record["state"], record["nr_samples"], record["min"], record["max"])
+                           for record in records["states_1h"]],
+                          [("OFFLINE", 4, 0, 2), ("ONLINE", 4, 2, 4)])
+
+    def test_partial_windows_are_resumed_after_a_restart(self):
+        self.tested.add(0, dict(state=dict(ONLINE=4)))
+        self.tested.add(60, dict(state=dict(ONLINE=2)))
+        self.tested.save()
+        self.tested = self.create()
+        self.tested.add(120, dict(state=dict(ONLINE=3)))
+        records = self.tested.add(300, dict(state=dict(ONLINE=3)))
+        self.assertEquals([(index, record["nr_samples"], record["avg"]) for index, _, record in records],
+                          [("states_5m", 3, 3.0)])
+
+    def test_a_window_which_ended_after_the_last_save_is_emitted_again_after_a_restart(self):
+        self.tested.add(0, dict(state=dict(ONLINE=4)))
+        self.tested.save()
+        records = self.tested.add(300, dict(state=dict(ONLINE=3)))
+        self.assertEquals(len(records), 1)
+        self.tested = self.create()
+        self.assertEquals(self.tested.add(300, dict(state=dict(ONLINE=3))), records)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+from rackattack.stats import scheduler
+
+
+class FakeClock(object):
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = list()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, duration):
+        self.sleeps.append(duration)
+        self.now += duration
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock(1000.0)
+        self.tested = scheduler.FixedRateScheduler(60, clock=self.clock.time, sleep=self.clock.sleep)
+
+    def test_ticks_are_aligned_to_the_interval(self):
+        self.assertEquals(self.tested.wait_for_next_tick(), (1020, 0))
+        self.clock.now += 5
+        self.assertEquals(self.tested.wait_for_next_tick(), (1080, 0))
+        self.assertEquals(self.clock.sleeps, [20, 55])
+
+    def test_ticks_missed_by_a_long_run_are_skipped(self):
+        self.tested.wait_for_next_tick()
+        self.clock.now += 130
+        self.assertEquals(self.tested.wait_for_next_tick(), (1200, 2))
+        self.assertEquals(self.tested.nr_missed_ticks, 2)
+
+    def test_a_run_which_ends_exactly_on_a_tick(self):
+        self.tested.wait_for_next_tick()
+        self.clock.now = 1080
+        self.assertEquals(self.tested.wait_for_next_tick(), (1080, 0))
+        self.assertEquals(self.tested.wait_for_next_tick(), (1140, 0))
+
+    def test_adaptive_interval(self):
+        self.tested = scheduler.AdaptiveScheduler(60, 15, 240, high_churn_ratio=0.1, clock=self.clock.time,
+                                                  sleep=self.clock.sleep)
+        self.assertEquals(self.tested.wait_for_next_tick(), (1020, 0))
+        self.tested.report_churn(nr_changed=5, nr_total=10)
+        self.assertEquals(self.tested.wait_for_next_tick(), (1050, 0))
+        self.tested.report_churn(nr_changed=5, nr_total=10)
+        self.tested.report_churn(nr_changed=5, nr_total=10)
+        self.assertEquals(self.tested.interval, 15)
+        self.assertEquals(self.tested.wait_for_next_tick(), (1065, 0))
+        self.tested.report_churn(nr_changed=1, nr_total=100)
+        self.assertEquals(self.tested.wait_for_next_tick(), (1080, 0))
+        self.tested.report_churn(nr_changed=0, nr_total=100)
+        self.tested.report_churn(nr_changed=0, nr_total=100)
+        self.assertEquals(self.tested.interval, 120)
+        self.assertEquals(self.tested.wait_for_next_tick(), (1200, 0))
+        for _ in xrange(3):
+            self.tested.report_churn(nr_changed=0, nr_total=100)
+        self.assertEquals(self.tested.interval, 240)
+
+    def test_the_adaptive_interval_is_kept_when_nothing_was_sampled(self):
+        self.tested = scheduler.AdaptiveScheduler(60, 15, 240, clock=self.clock.time, sleep=self.clock.sleep)
+        self.tested.report_churn(nr_changed=0, nr_total=0)
+        self.assertEquals(self.tested.interval, 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
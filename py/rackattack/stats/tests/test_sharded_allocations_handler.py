@@ -0,0 +1,136 @@
+import os
+import mock
+import signal
+import threading
+import unittest
+from rackattack.stats import main_allocation_stats
+from rackattack.stats.main_allocation_stats import AllocationsHandler, ShardedAllocationsHandler
+
+
+class SubscribeMock(object):
+    def __init__(self):
+        self.all_allocations_callback = None
+        self.inaugurations_callbacks = dict()
+        self._lock = threading.Lock()
+
+    def registerForAllAllocations(self, callback):
+        self.all_allocations_callback = callback
+
+    def registerForInagurator(self, host_id, callback):
+        with self._lock:
+            assert host_id not in self.inaugurations_callbacks, host_id
+            self.inaugurations_callbacks[host_id] = callback
+
+    def unregisterForInaugurator(self, host_id):
+        with self._lock:
+            del self.inaugurations_callbacks[host_id]
+
+
+class DBMock(object):
+    def __init__(self):
+        self.records = dict()
+        self._lock = threading.Lock()
+
+    def create(self, index, doc_type, body, id=None):
+        with self._lock:
+            record_id = len(self.records)
+            self.records[record_id] = dict(body, _index=index)
+        return dict(_id=record_id)
+
+    def update(self, index, doc_type, id, body):
+        with self._lock:
+            self.records[id].update(body["doc"])
+
+    def flush(self):
+        return list()
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.mgr = SubscribeMock()
+        self.db = DBMock()
+        self.tested = ShardedAllocationsHandler(self.mgr, self.db, mock.Mock(), nr_shards=2)
+        self.thread = threading.Thread(target=self.tested.run)
+        self.thread.start()
+
+    def tearDown(self):
+        self.tested.stop()
+        self.thread.join()
+
+    def allocate(self, allocation_id, hosts):
+        requirements = dict(('node{}'.format(host_nr), dict(pool="default"))
+                            for host_nr in xrange(len(hosts)))
+        self.mgr.all_allocations_callback(dict(event="requested", requirements=requirements,
+                                               allocationInfo=dict(user="someone")))
+        allocated = dict(('node{}'.format(host_nr), host_id) for host_nr, host_id in enumerate(hosts))
+        self.mgr.all_allocations_callback(dict(event="created", allocationID=allocation_id,
+                                               allocated=allocated))
+
+    def inaugurate(self, host_id):
+        self.mgr.inaugurations_callbacks[host_id](dict(id=host_id, status="done"))
+
+    def records_of_index(self, index):
+        return [record for record in self.db.records.itervalues() if record["_index"] == index]
+
+    def test_allocations_are_handled_by_their_shards(self):
+        for allocation_id in xrange(1, 5):
+            self.allocate(allocation_id, ["host-{}".format(allocation_id)])
+        self.tested.finish_all_commands_in_queue()
+        for shard in self.tested._shards:
+            self.assertEquals(len(shard._allocation_subscriptions), 2)
+        for allocation_id in xrange(1, 5):
+            self.inaugurate("host-{}".format(allocation_id))
+            self.mgr.all_allocations_callback(dict(event="done", allocationID=allocation_id))
+            self.mgr.all_allocations_callback(dict(event="dead", allocationID=allocation_id, reason="freed"))
+        self.tested.finish_all_commands_in_queue()
+        for shard in self.tested._shards:
+            self.assertFalse(shard._allocation_subscriptions)
+        allocations = self.records_of_index(AllocationsHandler.ALLOCATIONS_INDEX)
+        self.assertEquals(sorted(record["allocation_id"] for record in allocations), range(1, 5))
+        self.assertTrue(all(record["highest_phase_reached"] == "dead" for record in allocations))
+        self.assertEquals(len(self.records_of_index(AllocationsHandler.INAUGURATIONS_INDEX)), 4)
+        self.assertFalse(self.mgr.inaugurations_callbacks)
+
+    def test_a_host_held_by_an_allocation_of_another_shard(self):
+        self.allocate(1, ["alpha", "bravo"])
+        self.tested.finish_all_commands_in_queue()
+        self.inaugurate("alpha")
+        self.allocate(2, ["bravo", "charlie"])
+        self.tested.finish_all_commands_in_queue()
+        self.assertEquals(set(self.tested._shard_of(1)._allocation_subscriptions), set())
+        self.assertEquals(set(self.tested._shard_of(2)._allocation_subscriptions), set([2]))
+        self.assertEquals(sorted(self.mgr.inaugurations_callbacks), ["bravo", "charlie"])
+        inaugurations = self.records_of_index(AllocationsHandler.INAUGURATIONS_INDEX)
+        self.assertEquals(sorted((record["host_id"], record["inauguration_done"])
+                                 for record in inaugurations),
+                          [("alpha", True), ("bravo", False)])
+
+    def test_a_stuck_shard_fails_the_release_of_its_host_instead_of_hanging(self):
+        self.allocate(1, ["alpha"])
+        self.tested.finish_all_commands_in_queue()
+        owner = self.tested._shard_of(1)
+        other = self.tested._shard_of(2)
+        self.assertIsNot(owner, other)
+        unstuck = threading.Event()
+        owner._release_host = lambda host_id: unstuck.wait()
+        try:
+            with mock.patch.object(main_allocation_stats, "TASK_COMPLETION_TIMEOUT_NR_SECONDS", 0.1):
+                self.assertRaises(Exception, self.tested._release_host_from_other_shards, "alpha", other)
+        finally:
+            unstuck.set()
+
+    def test_a_termination_signal_stops_the_handler_after_its_pending_tasks(self):
+        previous_handler = signal.getsignal(signal.SIGTERM)
+        try:
+            main_allocation_stats.install_termination_handler(self.tested)
+            self.allocate(1, ["alpha"])
+            os.kill(os.getpid(), signal.SIGTERM)
+            self.thread.join(10)
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+        self.assertFalse(self.thread.is_alive())
+        self.assertEquals(len(self.records_of_index(AllocationsHandler.ALLOCATIONS_INDEX)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import json
+import mock
+import time
+import Queue
+import shutil
+import tempfile
+import unittest
+from rackattack.stats import spool
+from rackattack.stats import taskqueue
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.tested = taskqueue.TaskQueue()
+
+    def get_all(self):
+        tasks = list()
+        while not self.tested.empty():
+            tasks.append(self.tested.get(block=False))
+        return tasks
+
+    def test_a_pending_task_is_replaced_by_the_latest_one_with_the_same_key(self):
+        self.tested.put_latest("alpha", "alpha-progress-1")
+        self.tested.put_latest("bravo", "bravo-progress-1")
+        self.tested.put_latest("alpha", "alpha-progress-2")
+        self.assertEquals(self.get_all(), ["alpha-progress-2", "bravo-progress-1"])
+        self.assertEquals(self.tested.nr_coalesced(), 1)
+        self.assertEquals(self.tested.nr_processed(), 2)
+
+    def test_a_task_which_was_taken_is_not_replaced(self):
+        self.tested.put_latest("alpha", "alpha-progress-1")
+        self.tested.get()
+        self.tested.put_latest("alpha", "alpha-progress-2")
+        self.assertEquals(self.get_all(), ["alpha-progress-2"])
+
+    def test_tasks_are_not_moved_before_a_task_of_the_same_key(self):
+        self.tested.put_latest("alpha", "alpha-progress-1")
+        self.tested.put_latest("bravo", "bravo-progress-1")
+        self.tested.put("alpha-done", key="alpha")
+        self.tested.put_latest("alpha", "alpha-progress-2")
+        self.tested.put_latest("bravo", "bravo-progress-2")
+        self.assertEquals(self.get_all(), ["alpha-progress-1", "bravo-progress-2", "alpha-done",
+                                           "alpha-progress-2"])
+
+    def test_tasks_are_not_moved_before_a_task_without_a_key(self):
+        self.tested.put_latest("alpha", "alpha-progress-1")
+        self.tested.put("allocation-dead")
+        self.tested.put_latest("alpha", "alpha-progress-2")
+        self.assertEquals(self.get_all(), ["alpha-progress-1", "allocation-dead", "alpha-progress-2"])
+
+    def test_get_from_an_empty_queue(self):
+        self.assertRaises(Queue.Empty, self.tested.get, block=False)
+        self.assertRaises(Queue.Empty, self.tested.get, timeout=0.01)
+
+    def test_a_full_queue_does_not_accept_more_tasks(self):
+        self.tested = taskqueue.TaskQueue(max_size=2)
+        self.tested.put("allocation-requested")
+        self.tested.put_latest("alpha", "alpha-progress-1")
+        self.assertRaises(Queue.Full, self.tested.put, "allocation-created", block=False)
+        self.assertRaises(Queue.Full, self.tested.put, "allocation-created", timeout=0.01)
+        self.tested.put_latest("alpha", "alpha-progress-2")
+        self.tested.put("stop", unbounded=True)
+        self.assertEquals(self.get_all(), ["allocation-requested", "alpha-progress-2", "stop"])
+
+    def test_progress_tasks_are_shed_when_the_queue_is_full(self):
+        self.tested = taskqueue.TaskQueue(max_size=2, overflow_policy=taskqueue.OVERFLOW_POLICY_SHED)
+        self.tested.put_latest("alpha", "alpha-progress-1")
+        self.tested.put_latest("bravo", "bravo-progress-1")
+        self.tested.put_latest("charlie", "charlie-progress-1")
+        self.tested.put("alpha-done", key="alpha")
+        self.assertEquals(self.tested.qsize(), 2)
+        self.assertEquals(self.get_all(), ["bravo-progress-1", "alpha-done"])
+        self.assertEquals(self.tested.stats()["nr_shed"], 2)
+
+    def test_tasks_are_spilled_to_disk_when_the_queue_is_full(self):
+        spool_dirpath = tempfile.mkdtemp()
+        try:
+            self.tested = taskqueue.TaskQueue(max_size=2, overflow_policy=taskqueue.OVERFLOW_POLICY_SPILL,
+                                              spool=spool.Spool(spool_dirpath), encode_func=json.dumps,
+                                              decode_func=json.loads)
+            for task_nr in xrange(5):
+                self.tested.put("task-{}".format(task_nr))
+            self.assertEquals(self.tested.qsize(), 5)
+            self.assertEquals(self.tested.get(), "task-0")
+            self.tested.put("task-5")
+            self.assertEquals(self.get_all(), ["task-{}".format(task_nr) for task_nr in xrange(1, 6)])
+            self.assertEquals(self.tested.stats()["nr_spilled"], 4)
+            self.assertTrue(spool.Spool(spool_dirpath).is_empty())
+        finally:
+            shutil.rmtree(spool_dirpath)
+
+    def test_spilled_tasks_are_written_to_disk_in_batches(self):
+        spool_dirpath = tempfile.mkdtemp()
+        try:
+            tasks_spool = spool.Spool(spool_dirpath)
+            self.tested = taskqueue.TaskQueue(max_size=1, overflow_policy=taskqueue.OVERFLOW_POLICY_SPILL,
+                                              spool=tasks_spool, encode_func=json.dumps,
+                                              decode_func=json.loads)
+            with mock.patch.object(tasks_spool, "append", wraps=tasks_spool.append) as append:
+                with mock.patch.object(taskqueue, "SPILL_BATCH_MAX_NR_TASKS", 4):
+                    for task_nr in xrange(10):
+                        self.tested.put("task-{}".format(task_nr))
+                self.assertEquals(append.call_count, 2)
+                self.assertEquals(self.get_all(), ["task-{}".format(task_nr) for task_nr in xrange(10)])
+                self.assertEquals(append.call_count, 3)
+        finally:
+            shutil.rmtree(spool_dirpath)
+
+    def test_a_batch_of_spilled_tasks_is_read_after_a_restart_once_flushed(self):
+        spool_dirpath = tempfile.mkdtemp()
+        try:
+            self.tested = taskqueue.TaskQueue(max_size=1, overflow_policy=taskqueue.OVERFLOW_POLICY_SPILL,
+                                              spool=spool.Spool(spool_dirpath), encode_func=json.dumps,
+                                              decode_func=json.loads)
+            for task_nr in xrange(3):
+                self.tested.put("task-{}".format(task_nr))
+            self.tested.flush_spilled()
+            self.tested = taskqueue.TaskQueue(max_size=1, overflow_policy=taskqueue.OVERFLOW_POLICY_SPILL,
+                                              spool=spool.Spool(spool_dirpath), encode_func=json.dumps,
+                                              decode_func=json.loads)
+            self.assertEquals(self.get_all(), ["task-1", "task-2"])
+        finally:
+            shutil.rmtree(spool_dirpath)
+
+    def test_wait_and_handling_times_are_exported(self):
+        _, total_wait_time_before = taskqueue.wait_durations.labels().snapshot()
+        _, total_handling_time_before = taskqueue.handling_durations.labels().snapshot()
+        self.tested.put("allocation-requested")
+        time.sleep(0.02)
+        self.tested.get()
+        time.sleep(0.02)
+        self.tested.task_done()
+        _, total_wait_time = taskqueue.wait_durations.labels().snapshot()
+        _, total_handling_time = taskqueue.handling_durations.labels().snapshot()
+        self.assertGreaterEqual(total_wait_time - total_wait_time_before, 0.02)
+        self.assertGreaterEqual(total_handling_time - total_handling_time_before, 0.02)
+
+    def test_wait_and_handling_times_are_measured(self):
+        self.tested.put("allocation-requested")
+        time.sleep(0.02)
+        self.tested.get()
+        time.sleep(0.02)
+        self.tested.task_done()
+        stats = self.tested.stats()
+        self.assertGreaterEqual(stats["max_wait_time"], 0.02)
+        self.assertGreaterEqual(stats["total_handling_time"], 0.02)
+        self.assertEquals(stats["max_depth"], 1)
+        self.assertEquals(self.tested.stats()["max_wait_time"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
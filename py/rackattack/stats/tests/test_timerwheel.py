@@ -0,0 +1,62 @@
+import mock
+import unittest
+import threading
+from rackattack.stats import timerwheel
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.clock = mock.Mock(return_value=1000.0)
+        self.tested = timerwheel.TimerWheel(resolution=1.0, nr_slots=8, clock=self.clock)
+        self.fired = list()
+
+    def schedule(self, delay, name):
+        return self.tested.schedule(delay, self.fired.append, name)
+
+    def advance_to(self, now):
+        self.clock.return_value = now
+        self.tested.advance()
+
+    def test_timers_fire_at_their_deadlines_in_order(self):
+        self.schedule(2.5, "b")
+        self.schedule(1, "a")
+        self.schedule(20, "c")
+        self.advance_to(1000.9)
+        self.assertEquals(self.fired, [])
+        self.advance_to(1003)
+        self.assertEquals(self.fired, ["a", "b"])
+        # In the same slot as "c", but a round of the wheel earlier
+        self.advance_to(1012)
+        self.assertEquals(self.fired, ["a", "b"])
+        self.advance_to(1020)
+        self.assertEquals(self.fired, ["a", "b", "c"])
+        self.assertEquals(len(self.tested), 0)
+
+    def test_timers_are_fired_after_the_clock_jumps(self):
+        for delay in xrange(1, 100, 7):
+            self.schedule(delay, delay)
+        self.advance_to(2000)
+        self.assertEquals(self.fired, range(1, 100, 7))
+
+    def test_cancelled_timers_do_not_fire(self):
+        timer = self.schedule(1, "a")
+        self.schedule(1, "b")
+        self.tested.cancel(timer)
+        self.advance_to(1001)
+        self.assertEquals(self.fired, ["b"])
+        self.tested.cancel(timer)
+        self.assertEquals(len(self.tested), 0)
+
+    def test_thread(self):
+        tested = timerwheel.TimerWheel(resolution=0.01)
+        fired = threading.Event()
+        tested.schedule(0.02, fired.set)
+        tested.start()
+        try:
+            self.assertTrue(fired.wait(5))
+        finally:
+            tested.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import json
+import mock
+import signal
+import shutil
+import tempfile
+import unittest
+from rackattack.stats import tracing
+from rackattack.stats.main_allocation_stats import AllocationsHandler
+
+
+class Test(unittest.TestCase):
+    def setUp(self):
+        self.clock = mock.Mock(return_value=100.0)
+        self.tested = tracing.Tracer(capacity=2, clock=self.clock)
+        self.db = mock.Mock()
+        self.traced_db = tracing.TracingDB(self.db, self.tested)
+
+    def trace_event(self, name):
+        task = [name]
+        span = self.tested.start(name)
+        self.clock.return_value += 1
+        self.tested.enqueued(task, span)
+        self.clock.return_value += 2
+        self.assertIs(self.tested.dequeued(task), span)
+        self.traced_db.create(index="index", doc_type="type", body=dict())
+        self.clock.return_value += 3
+        self.tested.finish(span)
+        return span
+
+    def test_stages_of_an_event(self):
+        self.traced_db.update(index="index", doc_type="type", id=1, body=dict())
+        span = self.trace_event("allocations:requested")
+        self.assertEquals(self.db.create.call_count, 1)
+        self.assertEquals(self.db.update.call_count, 1)
+        expected_stages = [dict(name="receive", start_time=100.0, duration=1.0),
+                           dict(name="queue", start_time=101.0, duration=2.0),
+                           dict(name="db.create", start_time=103.0, duration=0.0),
+                           dict(name="handle", start_time=103.0, duration=3.0)]
+        self.assertEquals(span.to_dict(), dict(name="allocations:requested", start_time=100.0, duration=6.0,
+                                               stages=expected_stages))
+        self.assertIsNone(self.tested.current_span())
+        self.assertIsNone(self.tested.dequeued(["untraced"]))
+
+    def test_only_the_latest_spans_are_kept(self):
+        for name in ("a", "b", "c"):
+            self.trace_event(name)
+        self.assertEquals([span.name for span in self.tested.spans()], ["b", "c"])
+
+    def test_dumps(self):
+        self.trace_event("a")
+        dirpath = tempfile.mkdtemp()
+        try:
+            with open(self.tested.dump(dirpath, tracing.FORMAT_JSON)) as dump_file:
+                self.assertEquals([span["name"] for span in json.load(dump_file)["spans"]], ["a"])
+            with open(self.tested.dump(dirpath, tracing.FORMAT_CHROME)) as dump_file:
+                events = json.load(dump_file)["traceEvents"]
+            self.assertEquals([(event["name"], event["ts"], event["dur"]) for event in events],
+                              [("a", 100000000, 6000000), ("receive", 100000000, 1000000),
+                               ("queue", 101000000, 2000000), ("db.create", 103000000, 0),
+                               ("handle", 103000000, 3000000)])
+        finally:
+            shutil.rmtree(dirpath)
+
+    def test_dump_on_signal(self):
+        self.trace_event("a")
+        dirpath = tempfile.mkdtemp()
+        previous_handler = signal.getsignal(signal.SIGUSR1)
+        try:
+            tracing.install_signal_handler(self.tested, dirpath, tracing.FORMAT_JSON)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            self.assertEquals(len(os.listdir(dirpath)), 1)
+        finally:
+            signal.signal(signal.SIGUSR1, previous_handler)
+            shutil.rmtree(dirpath)
+
+    def test_events_of_the_allocations_handler(self):
+        subscription_mgr = mock.Mock()
+        db = mock.Mock()
+        db.create.return_value = dict(_id=1)
+        tracer = tracing.Tracer()
+        handler = AllocationsHandler(subscription_mgr, db, mock.Mock(), tracer=tracer)
+        callback = subscription_mgr.registerForAllAllocations.call_args[0][0]
+        callback(dict(event="requested", requirements=dict(node0=dict()), allocationInfo=dict()))
+        handler.handle_pending_tasks()
+        spans = tracer.spans()
+        self.assertEquals([span.name for span in spans], ["allocations:requested"])
+        self.assertEquals([stage[0] for stage in spans[0].stages],
+                          ["receive", "queue", "db.create", "handle"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import math
+import time
+import logging
+import threading
+
+
+class Timer(object):
+    __slots__ = ("deadline", "deadline_tick", "callback", "args")
+
+    def __init__(self, deadline, deadline_tick, callback, args):
+        self.deadline = deadline
+        self.deadline_tick = deadline_tick
+        self.callback = callback
+        self.args = args
+
+
+class TimerWheel:
+    """Calls callbacks at their deadlines, all from a single thread.
+
+    Timers are hashed into a wheel of nr_slots slots, by the tick (of the given resolution, in seconds) of
+    their deadline. Each tick, only the slot of that tick is visited, and the timers in it which are due
+    are fired (the others are due in a later round of the wheel). Scheduling and cancelling a timer take
+    O(1), so thousands of deadlines can be kept. Timers never fire early, and fire up to a tick late.
+
+    Callbacks run in the thread of the wheel, and should not block (e.g., enqueue a task and return).
+    """
+    def __init__(self, resolution=1.0, nr_slots=512, clock=time.time):
+        self._resolution = resolution
+        self._slots = [set() for _ in xrange(nr_slots)]
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._current_tick = self._tick_of(clock())
+        self._nr_timers = 0
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="timer-wheel")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def schedule(self, delay, callback, *args):
+        """Returns a timer, which can be given to cancel()."""
+        with self._lock:
+            deadline = self._clock() + delay
+            # Ticks which were already visited would only be visited again in the next round
+            deadline_tick = max(int(math.ceil(deadline / self._resolution)), self._current_tick + 1)
+            timer = Timer(deadline, deadline_tick, callback, args)
+            self._slot_of(deadline_tick).add(timer)
+            self._nr_timers += 1
+        return timer
+
+    def cancel(self, timer):
+        """Does nothing if the timer has already fired or was cancelled."""
+        with self._lock:
+            slot = self._slot_of(timer.deadline_tick)
+            if timer in slot:
+                slot.remove(timer)
+                self._nr_timers -= 1
+
+    def advance(self):
+        """Fire the timers which are due; Called by the thread of the wheel. Returns how many were fired."""
+        due_timers = self._pop_due_timers()
+        for timer in due_timers:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logging.exception("A timer callback has failed.")
+        return len(due_timers)
+
+    def __len__(self):
+        return self._nr_timers
+
+    def _pop_due_timers(self):
+        due_timers = list()
+        with self._lock:
+            tick = self._tick_of(self._clock())
+            # After a whole round of the wheel (e.g. the clock jumped), all slots were visited
+            nr_ticks = min(tick - self._current_tick, len(self._slots))
+            for slot_tick in xrange(tick - nr_ticks + 1, tick + 1):
+                slot = self._slot_of(slot_tick)
+                due_in_slot = [timer for timer in slot if timer.deadline_tick <= tick]
+                slot.difference_update(due_in_slot)
+                due_timers.extend(due_in_slot)
+            self._current_tick = max(self._current_tick, tick)
+            self._nr_timers -= len(due_timers)
+        due_timers.sort(key=lambda timer: timer.deadline)
+        return due_timers
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._stop_event.wait(self._resolution)
+            self.advance()
+
+    def _tick_of(self, timestamp):
+        return int(math.floor(timestamp / self._resolution))
+
+    def _slot_of(self, tick):
+        return self._slots[tick % len(self._slots)]
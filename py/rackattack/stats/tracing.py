@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import signal
+import logging
+import threading
+import collections
+
+
+DEFAULT_CAPACITY = 10000
+FORMAT_JSON = "json"
+FORMAT_CHROME = "chrome"
+
+
+class Span(object):
+    """The stages an event went through, each with its start and end times."""
+    __slots__ = ("name", "start_time", "stages", "_time_of_last_stage_end")
+
+    def __init__(self, name, start_time):
+        self.name = name
+        self.start_time = start_time
+        self.stages = list()
+        self._time_of_last_stage_end = start_time
+
+    def add_stage(self, name, start_time, end_time):
+        """Add a stage within the current one (e.g. a call made while handling the event)."""
+        self.stages.append((name, start_time, end_time))
+
+    def end_stage(self, name, end_time):
+        """Add a stage which started when the previous one ended."""
+        self.stages.append((name, self._time_of_last_stage_end, end_time))
+        self._time_of_last_stage_end = end_time
+
+    def end_time(self):
+        return self._time_of_last_stage_end
+
+    def to_dict(self):
+        return dict(name=self.name,
+                    start_time=self.start_time,
+                    duration=self.end_time() - self.start_time,
+                    stages=[dict(name=name, start_time=start_time, duration=end_time - start_time)
+                            for name, start_time, end_time in self.stages])
+
+
+class Tracer:
+    """Keeps the spans of the latest events in a ring buffer.
+
+    A span is started when an event is received, and is tracked by the task which carries it until the
+    task is taken from the queue. It then becomes the current span of the thread which handles the task
+    (so that DB calls made while handling it are added to it), and is kept once the task was handled.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY, clock=time.time):
+        self._clock = clock
+        self._spans = collections.deque(maxlen=capacity)
+        self._max_nr_queued_spans = capacity
+        # Tasks are kept (not only their IDs), so that an ID is never reused by another task while tracked
+        self._queued_spans = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self, name):
+        return Span(name, self._clock())
+
+    def enqueued(self, task, span):
+        span.end_stage("receive", self._clock())
+        with self._lock:
+            # Tasks which were replaced in the queue (or spilled from it) are never taken
+            if len(self._queued_spans) >= self._max_nr_queued_spans:
+                self._queued_spans.popitem(last=False)
+            self._queued_spans[id(task)] = (task, span)
+
+    def dequeued(self, task):
+        """Returns the span of the task, if it is traced, and makes it the current span of this thread."""
+        with self._lock:
+            queued = self._queued_spans.pop(id(task), None)
+        if queued is None or queued[0] is not task:
+            return None
+        span = queued[1]
+        span.end_stage("queue", self._clock())
+        self._local.span = span
+        return span
+
+    def finish(self, span):
+        span.end_stage("handle", self._clock())
+        self._local.span = None
+        self._spans.append(span)
+
+    def current_span(self):
+        return getattr(self._local, "span", None)
+
+    def clock(self):
+        return self._clock()
+
+    def spans(self):
+        return list(self._spans)
+
+    def dump_json(self, fileobj):
+        json.dump(dict(spans=[span.to_dict() for span in self.spans()]), fileobj)
+
+    def dump_chrome_trace(self, fileobj):
+        """In the Trace Event Format, which can be loaded by chrome://tracing; Each span in a row."""
+        events = list()
+        for span_idx, span in enumerate(self.spans()):
+            events.append(_chrome_trace_event(span.name, span.start_time, span.end_time(), span_idx))
+            for name, start_time, end_time in span.stages:
+                events.append(_chrome_trace_event(name, start_time, end_time, span_idx))
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), fileobj)
+
+    def dump(self, dirpath, format=FORMAT_CHROME):
+        """Returns the path of the dump file."""
+        if not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        filepath = os.path.join(dirpath, "trace-{}.{}.json".format(time.strftime("%Y%m%d-%H%M%S"), format))
+        with open(filepath, "w") as dump_file:
+            if format == FORMAT_JSON:
+                self.dump_json(dump_file)
+            else:
+                self.dump_chrome_trace(dump_file)
+        return filepath
+
+
+class TracingDB:
+    """Adds the DB calls made while handling a traced event to its span."""
+    def __init__(self, db, tracer):
+        self._db = db
+        self._tracer = tracer
+
+    def create(self, *args, **kwargs):
+        return self._call("db.create", self._db.create, args, kwargs)
+
+    def update(self, *args, **kwargs):
+        return self._call("db.update", self._db.update, args, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def _call(self, name, func, args, kwargs):
+        span = self._tracer.current_span()
+        if span is None:
+            return func(*args, **kwargs)
+        start_time = self._tracer.clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            span.add_stage(name, start_time, self._tracer.clock())
+
+
+def install_signal_handler(tracer, dirpath, format=FORMAT_CHROME, signum=signal.SIGUSR1):
+    """Dump the spans to a new file in dirpath whenever the signal is received."""
+    def handler(*args):
+        try:
+            filepath = tracer.dump(dirpath, format)
+            logging.info("Traces were dumped to {}.".format(filepath))
+        except Exception:
+            logging.exception("Failed dumping the traces.")
+    signal.signal(signum, handler)
+
+
+def _chrome_trace_event(name, start_time, end_time, tid):
+    return dict(name=name, ph="X", ts=int(start_time * 1000000), dur=int((end_time - start_time) * 1000000),
+                pid=0, tid=tid)